@@ -3,6 +3,7 @@ import argparse
 from lib.hybrid_commands import (
     normalize_command,
     rrf_search_command,
+    sync_index_command,
     weighted_search_command,
 )
 
@@ -81,6 +82,11 @@ def main() -> None:
         help="Rerank method"
     )
 
+    subparsers.add_parser(
+        "sync-index",
+        help="Bring the keyword index up to date with the movies",
+    )
+
     args = parser.parse_args()
 
     match args.command:
@@ -94,6 +100,9 @@ def main() -> None:
                 args.enhance,
                 args.rerank_method,
             )
+        case "sync-index":
+            count = sync_index_command()
+            print(f"Keyword index holds {count} movies")
         case "weighted-search":
             weighted_search_command(args.query, args.alpha, args.limit)
         case _:
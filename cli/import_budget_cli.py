@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import argparse
+import sys
+
+from lib.constants import IMPORT_BUDGETS, LAZY_MODULES
+from lib.import_budget import profile_imports
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check how long each CLI entry point takes to import",
+    )
+    parser.add_argument(
+        "entry_points",
+        nargs="*",
+        choices=sorted(IMPORT_BUDGETS),
+        help="Entry points to check, all of them by default",
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=3,
+        help="Imports per entry point, the fastest of which is reported",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=5,
+        help="Number of slowest imported modules to show per entry point",
+    )
+
+    args = parser.parse_args()
+
+    failed = False
+    for entry_point in args.entry_points or sorted(IMPORT_BUDGETS):
+        profile = profile_imports(entry_point, args.runs)
+        budget = IMPORT_BUDGETS[entry_point]
+        eager = profile.imported(LAZY_MODULES)
+
+        status = "ok"
+        if profile.total > budget or len(eager) > 0:
+            status = "OVER BUDGET"
+            failed = True
+
+        print(f"{entry_point}: {profile.total * 1000:.0f}ms of {budget * 1000:.0f}ms, {status}")
+        if len(eager) > 0:
+            print(f"  imports {', '.join(eager)} eagerly")
+        for module, seconds in profile.slowest(args.top):
+            print(f"  {seconds * 1000:8.1f}ms  {module}")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
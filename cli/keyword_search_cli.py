@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
-import json
+import os
 
 from lib.constants import BM25_B, BM25_K1
 from lib.index_commands import (
@@ -13,14 +13,19 @@ from lib.index_commands import (
     bm25idf_command,
     bm25_tf_command,
     bm25_search_command,
+    bm25_search_batch_command,
+    add_command,
+    update_command,
+    delete_command,
+    merge_command,
+    proximity_search_command,
 )
+from lib.search_utils import iter_movies
 
 
 def title_search(query: str) -> list:
-    with open("data/movies.json") as f:
-        data = json.load(f)
     found = []
-    for movie in data["movies"]:
+    for movie in iter_movies():
         if query in movie["title"]:
             found.append(movie)
 
@@ -36,18 +41,72 @@ def main() -> None:
 
     search_parser = subparsers.add_parser(
         "search",
-        help="Search movies using BM25",
+        help="Search movies with a boolean query (AND, OR, NOT, parentheses)",
     )
     search_parser.add_argument(
         "query",
         type=str,
         help="Search query",
     )
+    search_parser.add_argument(
+        "--limit",
+        type=int,
+        default=5,
+        help="Maximum number of results to return",
+    )
 
-    subparsers.add_parser(
+    build_parser = subparsers.add_parser(
         "build",
         help="Build search index",
     )
+    build_parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes used to index movies",
+    )
+    build_parser.add_argument(
+        "--no-positions",
+        dest="positions",
+        action="store_false",
+        help="Do not record token positions (disables phrase and proximity queries)",
+    )
+
+    add_parser = subparsers.add_parser(
+        "add",
+        help="Add movies from a JSON file to the search index",
+    )
+    add_parser.add_argument(
+        "path",
+        type=str,
+        help="JSON file with a list of movies",
+    )
+
+    update_parser = subparsers.add_parser(
+        "update",
+        help="Add or replace movies from a JSON file in the search index",
+    )
+    update_parser.add_argument(
+        "path",
+        type=str,
+        help="JSON file with a list of movies",
+    )
+
+    delete_parser = subparsers.add_parser(
+        "delete",
+        help="Delete movies from the search index",
+    )
+    delete_parser.add_argument(
+        "doc_ids",
+        type=int,
+        nargs="+",
+        help="Document IDs",
+    )
+
+    subparsers.add_parser(
+        "merge",
+        help="Merge search index segments",
+    )
 
     tf_parser = subparsers.add_parser(
         "tf",
@@ -143,21 +202,89 @@ def main() -> None:
         default=5,
         help="Maximum number of results to return",
     )
+    bm25search_parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="Only score the postings that can reach the top results",
+    )
+    bm25search_parser.add_argument(
+        "--proximity",
+        action="store_true",
+        help="Boost documents where the query terms occur close together",
+    )
+
+    near_parser = subparsers.add_parser(
+        "near",
+        help="Search movies containing all query terms within a few words",
+    )
+    near_parser.add_argument(
+        "query",
+        type=str,
+        help="Search query",
+    )
+    near_parser.add_argument(
+        "--distance",
+        type=int,
+        default=5,
+        help="Maximum number of words between the first and last query term",
+    )
+    near_parser.add_argument(
+        "--limit",
+        type=int,
+        default=5,
+        help="Maximum number of results to return",
+    )
+
+    bm25batch_parser = subparsers.add_parser(
+        "bm25batch",
+        help="Search movies with BM25 for every query in a file",
+    )
+    bm25batch_parser.add_argument(
+        "path",
+        type=str,
+        help="Text file with one query per line",
+    )
+    bm25batch_parser.add_argument(
+        "--limit",
+        type=int,
+        default=5,
+        help="Maximum number of results to return per query",
+    )
 
     args = parser.parse_args()
 
     match args.command:
+        case "add":
+            added = add_command(args.path)
+            print(f"Added {added} movies")
         case "bm25idf":
             bm25idf = bm25idf_command(args.term)
             print(f"BM25 IDF score of '{args.term}': {bm25idf:.2f}")
         case "bm25search":
-            results = bm25_search_command(args.query, args.limit)
+            results = bm25_search_command(
+                args.query,
+                args.limit,
+                args.prune,
+                args.proximity,
+            )
             for i, result in enumerate(results, 1):
                 print(
                     "%d. (%d) %s - Score: %0.2f" %
                     (i, result.movie["id"],
                      result.movie["title"], result.score)
                 )
+        case "bm25batch":
+            with open(args.path) as f:
+                queries = [line.strip() for line in f if line.strip()]
+            batches = bm25_search_batch_command(queries, args.limit)
+            for query, results in zip(queries, batches):
+                print(f"Query: {query}")
+                for i, result in enumerate(results, 1):
+                    print(
+                        "  %d. (%d) %s - Score: %0.2f" %
+                        (i, result.movie["id"],
+                         result.movie["title"], result.score)
+                    )
         case "bm25tf":
             bm25tf = bm25_tf_command(args.doc_id, args.term, args.k1, args.b)
             print(
@@ -165,13 +292,31 @@ def main() -> None:
                 (args.term, args.doc_id, bm25tf)
             )
         case "build":
-            build_command()
+            build_command(args.workers, args.positions)
+        case "delete":
+            deleted = delete_command(args.doc_ids)
+            print(f"Deleted {deleted} movies")
+        case "merge":
+            segments = merge_command()
+            print(f"Index has {segments} segments")
         case "idf":
             idf = idf_command(args.term)
             print(f"Inverse document frequency of '{args.term}': {idf:.2f}")
+        case "near":
+            results = proximity_search_command(
+                args.query,
+                args.distance,
+                args.limit,
+            )
+            for i, result in enumerate(results, 1):
+                print(
+                    "%d. (%d) %s - Score: %0.2f" %
+                    (i, result.movie["id"],
+                     result.movie["title"], result.score)
+                )
         case "search":
             print(f"Searching for: {args.query}")
-            results = search_command(args.query)
+            results = search_command(args.query, args.limit)
             for i, movie in enumerate(results, 1):
                 print(f"{i}. {movie['title']}")
         case "tf":
@@ -182,6 +327,9 @@ def main() -> None:
                 "TF-IDF score of '%s' in document '%d': %0.2f" %
                 (args.term, args.doc_id, tf_idf)
             )
+        case "update":
+            updated = update_command(args.path)
+            print(f"Updated {updated} movies")
         case _:
             parser.print_help()
 
@@ -0,0 +1,292 @@
+import bisect
+import re
+
+from .query_utils import clean
+from .wand import NO_MORE_DOCS
+
+
+# Query syntax: words are ANDed together unless joined by OR, NOT excludes
+# the next word or group, and parentheses group. Operators must be upper
+# case; lower case "and", "or" and "not" are ordinary words.
+QUERY_TOKENS = re.compile(r"\(|\)|[^\s()]+")
+OPERATORS = {"AND", "OR", "NOT"}
+
+
+def parse_query(query: str):
+    """
+    Parses a boolean query into a tree of ("term", token), ("and", children),
+    ("or", children) and ("not", child) nodes. Returns None when nothing in
+    the query can be searched for, e.g. when it only has stop words.
+    """
+
+    tokens = QUERY_TOKENS.findall(query)
+    if len(tokens) == 0:
+        return None
+
+    parser = QueryParser(tokens)
+    node = parser.parse_or()
+    if parser.peek() is not None:
+        raise RuntimeError(f"unexpected '{parser.peek()}' in query: {query}")
+    return node
+
+
+class QueryParser:
+    def __init__(self, tokens: list[str]):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self) -> str | None:
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def take(self) -> str:
+        token = self.peek()
+        if token is None:
+            raise RuntimeError("query ends unexpectedly")
+
+        self.pos += 1
+        return token
+
+    def parse_or(self):
+        children = [self.parse_and()]
+        while self.peek() == "OR":
+            self.take()
+            children.append(self.parse_and())
+        return combine("or", children)
+
+    def parse_and(self):
+        children = [self.parse_not()]
+        while self.peek() not in (None, "OR", ")"):
+            if self.peek() == "AND":
+                self.take()
+            children.append(self.parse_not())
+        return combine("and", children)
+
+    def parse_not(self):
+        if self.peek() != "NOT":
+            return self.parse_primary()
+
+        self.take()
+        child = self.parse_not()
+        return None if child is None else ("not", child)
+
+    def parse_primary(self):
+        token = self.take()
+        if token == "(":
+            node = self.parse_or()
+            if self.take() != ")":
+                raise RuntimeError("unbalanced parentheses in query")
+            return node
+
+        if token == ")" or token in OPERATORS:
+            raise RuntimeError(f"unexpected '{token}' in query")
+
+        # Stop words analyze to nothing and are left out of the query
+        terms = [("term", t) for t in clean(token) if t]
+        return combine("and", terms)
+
+
+def combine(op: str, children: list):
+    children = [child for child in children if child is not None]
+    if len(children) == 0:
+        return None
+    if len(children) == 1:
+        return children[0]
+    return (op, children)
+
+
+def gallop(values: list, target, lo: int) -> int:
+    """
+    Returns the first index at or after lo whose value is at least target,
+    probing exponentially growing steps before binary searching
+    """
+
+    step = 1
+    hi = lo
+    while hi < len(values) and values[hi] < target:
+        lo = hi + 1
+        hi += step
+        step *= 2
+    return bisect.bisect_left(values, target, lo, min(hi, len(values)))
+
+
+class TermIterator:
+    """
+    Walks the document numbers of a term in a segment, using the last
+    document number of each block as skip pointers so that only the blocks
+    holding the documents it lands on are decoded
+    """
+
+    def __init__(self, seg, term: int):
+        self.seg = seg
+        self.term = term
+        blocks = slice(seg.block_offsets[term], seg.block_offsets[term + 1])
+        self.block_last = seg.block_last[blocks].tolist()
+        self.cost = int(seg.offsets[term + 1] - seg.offsets[term])
+
+        self.block = -1
+        self.docs = []
+        self.pos = 0
+        self.doc = -1
+
+    def __load_block(self, block: int) -> None:
+        self.block = block
+        self.pos = 0
+        if block >= len(self.block_last):
+            self.docs = []
+            self.doc = NO_MORE_DOCS
+            return
+
+        self.docs = self.seg.get_block_docs(self.term, block).tolist()
+        self.doc = self.docs[0]
+
+    def next(self) -> int:
+        self.pos += 1
+        if self.pos < len(self.docs):
+            self.doc = self.docs[self.pos]
+        else:
+            self.__load_block(self.block + 1)
+        return self.doc
+
+    def advance(self, target: int) -> int:
+        """
+        Moves to the first document number of at least target
+        """
+
+        if self.doc >= target:
+            return self.doc
+
+        if self.block < 0 or target > self.block_last[self.block]:
+            block = gallop(self.block_last, target, max(self.block, 0))
+            self.__load_block(block)
+            if self.doc >= target:
+                return self.doc
+
+        self.pos = gallop(self.docs, target, self.pos)
+        self.doc = self.docs[self.pos]
+        return self.doc
+
+
+class AllDocsIterator:
+    """
+    Walks every document number of a segment
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.cost = size
+        self.doc = -1
+
+    def next(self) -> int:
+        return self.advance(self.doc + 1)
+
+    def advance(self, target: int) -> int:
+        if self.doc < target:
+            self.doc = target if target < self.size else NO_MORE_DOCS
+        return self.doc
+
+
+class EmptyIterator:
+    def __init__(self):
+        self.cost = 0
+        self.doc = -1
+
+    def next(self) -> int:
+        self.doc = NO_MORE_DOCS
+        return self.doc
+
+    def advance(self, target: int) -> int:
+        return self.next()
+
+
+class AndIterator:
+    """
+    Intersects iterators by leapfrogging from the rarest one, skipping
+    documents any excluded iterator matches
+    """
+
+    def __init__(self, required: list, excluded: list):
+        self.required = sorted(required, key=lambda it: it.cost)
+        self.excluded = excluded
+        self.cost = self.required[0].cost
+        self.doc = -1
+
+    def next(self) -> int:
+        return self.advance(self.doc + 1)
+
+    def advance(self, target: int) -> int:
+        if self.doc >= target:
+            return self.doc
+
+        lead, others = self.required[0], self.required[1:]
+        doc = lead.advance(target)
+        while doc != NO_MORE_DOCS:
+            for it in others:
+                found = it.advance(doc)
+                if found > doc:
+                    doc = lead.advance(found)
+                    break
+            else:
+                if any(it.advance(doc) == doc for it in self.excluded):
+                    doc = lead.next()
+                    continue
+                break
+
+        self.doc = doc
+        return doc
+
+
+class OrIterator:
+    """
+    Unions iterators in document number order
+    """
+
+    def __init__(self, children: list):
+        self.children = children
+        self.cost = sum(it.cost for it in children)
+        self.doc = -1
+
+    def next(self) -> int:
+        return self.advance(self.doc + 1)
+
+    def advance(self, target: int) -> int:
+        if self.doc >= target:
+            return self.doc
+
+        self.doc = min(it.advance(target) for it in self.children)
+        return self.doc
+
+
+def query_iterator(node, seg):
+    """
+    Builds the iterator evaluating a parsed query over the documents of a
+    segment
+    """
+
+    match node:
+        case ("term", token):
+            term = seg.vocab.get(token)
+            if term is None:
+                return EmptyIterator()
+            return TermIterator(seg, term)
+        case ("and", children):
+            required = []
+            excluded = []
+            for child in children:
+                if child[0] == "not":
+                    excluded.append(query_iterator(child[1], seg))
+                else:
+                    required.append(query_iterator(child, seg))
+            if not required:
+                required.append(AllDocsIterator(len(seg)))
+            return AndIterator(required, excluded)
+        case ("or", children):
+            return OrIterator([query_iterator(child, seg) for child in children])
+        case ("not", child):
+            return AndIterator(
+                [AllDocsIterator(len(seg))],
+                [query_iterator(child, seg)],
+            )
+
+    raise RuntimeError(f"unknown query node: {node}")
@@ -0,0 +1,140 @@
+import json
+import os
+
+import numpy as np
+
+from .index_format import IndexFile, write_index_file
+from .search_utils import CACHE_PATH
+
+
+class CacheManifest:
+    """
+    Records, for every artifact built from the documents into the cache, the
+    parameters it was built with and the ID and content hash of each
+    document it was built from, in the order of its rows. Comparing them to
+    the current documents tells which rows of an artifact can be kept and
+    which documents have to be processed again.
+
+    The manifest is an index file whose meta section holds the parameters
+    of every artifact, with the IDs and hashes of each in its own pair of
+    sections, so opening it maps them instead of parsing them.
+    """
+
+    def __init__(self, path: str | None = None):
+        self.path = path or os.path.join(CACHE_PATH, "cache_manifest.bin")
+
+    def __read(self) -> dict:
+        """
+        Returns every recorded artifact, with its IDs and hashes as arrays
+        viewed out of the file. A JSON manifest left by older versions is
+        converted first.
+        """
+
+        legacy_path = f"{os.path.splitext(self.path)[0]}.json"
+        if not os.path.exists(self.path):
+            if not os.path.exists(legacy_path):
+                return {}
+
+            with open(legacy_path) as f:
+                manifest = json.load(f)
+            for entry in manifest.values():
+                entry["ids"] = np.array(entry["ids"], dtype=np.int64)
+                entry["hashes"] = np.array(entry["hashes"], dtype=np.uint64)
+            self.__write(manifest)
+            os.remove(legacy_path)
+
+        f = IndexFile(self.path)
+        manifest = f.json("meta")
+        for i, entry in enumerate(manifest.values()):
+            entry["ids"] = f.array(f"ids_{i}")
+            entry["hashes"] = f.array(f"hashes_{i}")
+        return manifest
+
+    def __write(self, manifest: dict) -> None:
+        meta = {}
+        sections = {}
+        for i, (artifact, entry) in enumerate(manifest.items()):
+            meta[artifact] = {
+                key: value
+                for key, value in entry.items()
+                if key not in ("ids", "hashes")
+            }
+            sections[f"ids_{i}"] = np.asarray(entry["ids"], dtype=np.int64)
+            sections[f"hashes_{i}"] = np.asarray(entry["hashes"], dtype=np.uint64)
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        write_index_file(self.path, {
+            "meta": np.frombuffer(json.dumps(meta).encode("utf-8"), dtype=np.uint8),
+            **sections,
+        })
+
+    def get(self, artifact: str) -> dict | None:
+        return self.__read().get(artifact)
+
+    def match_rows(
+        self,
+        artifact: str,
+        params: dict,
+        doc_ids: np.ndarray,
+        hashes: np.ndarray,
+    ) -> np.ndarray | None:
+        """
+        Returns, for every document, the row it had when the artifact was
+        recorded, or -1 when it is new or its content changed. Returns None
+        when the artifact was not recorded or was built with other params,
+        so none of it can be kept.
+        """
+
+        entry = self.get(artifact)
+        if entry is None or entry["params"] != params:
+            return None
+
+        return match_documents(entry["ids"], entry["hashes"], doc_ids, hashes)
+
+    def record(
+        self,
+        artifact: str,
+        params: dict,
+        doc_ids: np.ndarray,
+        hashes: np.ndarray,
+        **extra,
+    ) -> None:
+        """
+        Records what an artifact was just built from, along with any extra
+        values, replacing the manifest file atomically
+        """
+
+        manifest = self.__read()
+        manifest[artifact] = {
+            "params": params,
+            **extra,
+            "ids": doc_ids,
+            "hashes": hashes,
+        }
+        self.__write(manifest)
+
+
+def match_documents(
+    old_ids: np.ndarray,
+    old_hashes: np.ndarray,
+    doc_ids: np.ndarray,
+    hashes: np.ndarray,
+) -> np.ndarray:
+    """
+    Returns the position of every document among the old documents, or -1
+    when it is not one of them or its content hash differs
+    """
+
+    rows = np.full(len(doc_ids), -1, dtype=np.int64)
+    if len(old_ids) == 0:
+        return rows
+
+    order = np.argsort(old_ids, kind="stable")
+    sorted_ids = old_ids[order]
+    pos = np.searchsorted(sorted_ids, doc_ids)
+    pos[pos == len(sorted_ids)] = 0
+
+    found = sorted_ids[pos] == doc_ids
+    found[found] = old_hashes[order[pos[found]]] == hashes[found]
+    rows[found] = order[pos[found]]
+    return rows
@@ -3,10 +3,27 @@ import numpy as np
 import os.path
 import re
 
-from .constants import SCORE_PRECISION
-from .query_utils import cosine_similarity
+from .constants import EMBEDDING_RESCORE, IVF_NPROBE, SCORE_PRECISION
+from .document_store import DocumentStore
+from .embedding_file import EmbeddingMatrix, open_embeddings, write_embeddings
+from .embedding_index import file_source
+from .index_format import IndexFile, write_index_file
+from .ivf import open_ivf
+from .quantization import open_quantized
+from .query_utils import normalize_rows, top_k
 from .search_utils import CACHE_PATH
-from .semantic_search import SemanticSearch
+from .semantic_search import SemanticSearch, score_candidates_batch
+
+
+# Fields of the documents that are chunked, and the fields of results, which
+# only show the start of the description
+CHUNK_FIELDS = {"description": None}
+RESULT_FIELDS = {"id": None, "title": None, "description": 100}
+
+# Number of sentences per chunk, and how many sentences consecutive chunks
+# share
+SEMANTIC_CHUNK_SIZE = 4
+SEMANTIC_CHUNK_OVERLAP = 1
 
 
 class ChunkedResult:
@@ -21,64 +38,221 @@ class ChunkedResult:
 class ChunkedSemanticSearch(SemanticSearch):
     def __init__(self, model_name: str = "all-MiniLM-L6-v2"):
         super().__init__(model_name)
+        # Unit-length embedding of each chunk, stored like the embeddings
         self.chunk_embeddings = None
-        self.chunk_metadata = None
+
+        # Movie of each chunk row, the position of the chunk among the
+        # movie's chunks and the number of chunks of the movie, stored as
+        # the sections of an index file
+        self.chunk_movies = None
+        self.chunk_numbers = None
+        self.chunk_counts = None
         self.chunk_embeddings_path = os.path.join(
-            CACHE_PATH, "chunk_embeddings.npy")
+            CACHE_PATH, "chunk_embeddings.bin")
+
+        # Approximate nearest neighbour index of the chunk embeddings, see
+        # SemanticSearch.ann
+        self.chunk_ann = None
+        self.chunk_ann_path = os.path.join(CACHE_PATH, "chunk_embeddings.ivf")
+
+        # Compressed codes of the chunk embeddings, see
+        # SemanticSearch.quantized
+        self.chunk_quantized = None
+        self.chunk_quantized_path = os.path.join(CACHE_PATH, "chunk_embeddings.codes")
         self.chunk_metadata_path = os.path.join(
-            CACHE_PATH, "chunk_metadata.json")
+            CACHE_PATH, "chunk_metadata.bin")
+
+    def build_chunk_embeddings(
+        self,
+        documents: DocumentStore,
+        reuse: np.ndarray | None = None,
+    ) -> EmbeddingMatrix:
+        """
+        Splits the description of every document into chunks of sentences
+        and embeds them. Documents with a reuse entry other than -1 keep the
+        chunks that document had in the current chunk embeddings instead of
+        being chunked and encoded again.
+        """
 
-    def build_chunk_embeddings(self, documents: list[dict]) -> np.ndarray:
         self.documents = documents
+        if reuse is None:
+            reuse = np.full(len(documents), -1, dtype=np.int64)
 
-        for doc in documents:
-            self.document_map[doc["id"]] = doc
+        # Current chunk rows of each document, which are in document order
+        old_starts = None
+        if (reuse >= 0).any():
+            old_starts = np.searchsorted(
+                self.chunk_movies,
+                np.arange(reuse.max() + 2),
+            )
 
         all_chunks = []
-        self.chunk_metadata = []
-        for doc_idx, doc in enumerate(documents):
+        rows = []
+        movies = []
+        numbers = []
+        counts = []
+        for doc_idx, old_idx in enumerate(reuse.tolist()):
+            if old_idx >= 0:
+                old_rows = range(old_starts[old_idx], old_starts[old_idx + 1])
+                rows.extend(old_rows)
+                movies.extend([doc_idx] * len(old_rows))
+                numbers.extend(self.chunk_numbers[old_rows].tolist())
+                counts.extend(self.chunk_counts[old_rows].tolist())
+                continue
+
+            doc = documents.document(doc_idx, CHUNK_FIELDS)
             if doc["description"] == "":
                 continue
-            chunks = self.semantic_chunk(doc["description"], 4, 1)
+            chunks = self.semantic_chunk(
+                doc["description"],
+                SEMANTIC_CHUNK_SIZE,
+                SEMANTIC_CHUNK_OVERLAP,
+            )
             all_chunks.extend(chunks)
 
-            for chunk_idx, chunk in enumerate(chunks):
-                self.chunk_metadata.append({
-                    "movie_idx": doc_idx,
-                    "chunk_idx": chunk_idx,
-                    "total_chunks": len(chunks),
-                })
+            rows.extend([-1] * len(chunks))
+            movies.extend([doc_idx] * len(chunks))
+            numbers.extend(range(len(chunks)))
+            counts.extend([len(chunks)] * len(chunks))
+
+        rows = np.array(rows, dtype=np.int64)
+        stale = np.flatnonzero(rows < 0)
+        if len(stale) == len(rows):
+            chunk_embeddings = normalize_rows(
+                self.encode_batches(all_chunks, "chunk_embeddings"),
+            )
+        else:
+            chunk_embeddings = self.chunk_embeddings[np.maximum(rows, 0)]
+            if len(stale) > 0:
+                chunk_embeddings[stale] = normalize_rows(
+                    self.encode_batches(all_chunks, "chunk_embeddings"),
+                )
 
-        self.chunk_embeddings = self.model.encode(
-            all_chunks,
-            show_progress_bar=True,
+        old_source = file_source(self.chunk_embeddings_path)
+        write_embeddings(
+            self.chunk_embeddings_path,
+            chunk_embeddings,
+            self.embedding_dtype,
         )
+        write_index_file(self.chunk_metadata_path, {
+            "movies": np.array(movies, dtype=np.int64),
+            "numbers": np.array(numbers, dtype=np.int64),
+            "counts": np.array(counts, dtype=np.int64),
+        })
+        self.chunk_embeddings = open_embeddings(
+            self.chunk_embeddings_path,
+            self.embedding_dtype,
+        )
+        self.__open_chunks()
+        self.__open_derived(rows, old_source)
 
-        np.save(self.chunk_embeddings_path, self.chunk_embeddings)
-        with open(self.chunk_metadata_path, "w") as f:
-            json.dump({
-                "chunks": self.chunk_metadata,
-                "total_chunks": len(all_chunks),
-            }, f, indent=2)
+        self.cache_manifest.record(
+            "chunk_embeddings",
+            self.__chunk_params(),
+            documents.doc_ids,
+            documents.hashes,
+        )
 
         return self.chunk_embeddings
 
-    def load_or_create_chunk_embeddings(self, documents: list[dict]) -> np.ndarray:
-        self.documents = documents
+    def __open_chunks(self) -> bool:
+        """
+        Maps the chunk metadata file, returning False when there is none. A
+        JSON file left by older versions is converted first.
+        """
 
-        for doc in documents:
-            self.document_map[doc["id"]] = doc
+        legacy_path = f"{os.path.splitext(self.chunk_metadata_path)[0]}.json"
+        if not os.path.exists(self.chunk_metadata_path):
+            if not os.path.exists(legacy_path):
+                return False
 
-        if os.path.exists(self.chunk_embeddings_path) and os.path.exists(self.chunk_metadata_path):
-            self.chunk_embeddings = np.load(self.chunk_embeddings_path)
+            with open(legacy_path) as f:
+                chunks = json.load(f)["chunks"]
+            write_index_file(self.chunk_metadata_path, {
+                name: np.array([c[key] for c in chunks], dtype=np.int64)
+                for name, key in [
+                    ("movies", "movie_idx"),
+                    ("numbers", "chunk_idx"),
+                    ("counts", "total_chunks"),
+                ]
+            })
+            os.remove(legacy_path)
+
+        f = IndexFile(self.chunk_metadata_path)
+        self.chunk_movies = f.array("movies")
+        self.chunk_numbers = f.array("numbers")
+        self.chunk_counts = f.array("counts")
+        return True
 
-            with open(self.chunk_metadata_path) as f:
-                metadata = json.load(f)
-                self.chunk_metadata = metadata["chunks"]
+    def __open_derived(
+        self,
+        rows: np.ndarray | None = None,
+        old_source: list | None = None,
+    ) -> None:
+        """
+        Opens the ANN index and codes of the chunk embeddings, bringing them
+        up to date with the chunk embeddings file
+        """
 
-            return self.chunk_embeddings
+        source = file_source(self.chunk_embeddings_path)
+        self.chunk_ann = open_ivf(
+            self.chunk_ann_path,
+            self.chunk_embeddings,
+            source,
+            rows,
+            old_source,
+        )
+        self.chunk_quantized = open_quantized(
+            self.chunk_quantized_path,
+            self.quantization,
+            self.chunk_embeddings,
+            source,
+            rows,
+            old_source,
+        )
 
-        return self.build_chunk_embeddings(documents)
+    def __chunk_params(self) -> dict:
+        return {
+            "model": self.model_name,
+            "fields": list(CHUNK_FIELDS),
+            "chunk_size": SEMANTIC_CHUNK_SIZE,
+            "overlap": SEMANTIC_CHUNK_OVERLAP,
+        }
+
+    def load_or_create_chunk_embeddings(
+        self,
+        documents: DocumentStore,
+    ) -> EmbeddingMatrix:
+        """
+        Loads the cached chunk embeddings, chunking and embedding again only
+        the documents that were added or changed since they were built, and
+        everything when they were built with another model or chunk size
+        """
+
+        self.documents = documents
+
+        reuse = None
+        embeddings = open_embeddings(self.chunk_embeddings_path, self.embedding_dtype)
+        if embeddings is not None and self.__open_chunks():
+            reuse = self.cache_manifest.match_rows(
+                "chunk_embeddings",
+                self.__chunk_params(),
+                documents.doc_ids,
+                documents.hashes,
+            )
+
+        if reuse is not None:
+            self.chunk_embeddings = embeddings
+            if len(self.chunk_movies) != len(self.chunk_embeddings):
+                reuse = None
+            elif np.array_equal(reuse, np.arange(len(reuse))) and (
+                len(self.chunk_movies) == 0 or
+                self.chunk_movies[-1] < len(reuse)
+            ):
+                self.__open_derived()
+                return self.chunk_embeddings
+
+        return self.build_chunk_embeddings(documents, reuse)
 
     def semantic_chunk(
         self,
@@ -111,46 +285,82 @@ class ChunkedSemanticSearch(SemanticSearch):
 
         return chunks
 
-    def search_chunks(self, query: str, limit: int = 10) -> list[ChunkedResult]:
+    def search_chunks(
+        self,
+        query: str,
+        limit: int = 10,
+        nprobe: int | None = IVF_NPROBE,
+    ) -> list[ChunkedResult]:
+        """
+        Returns the movies whose best chunk is closest to the query, see
+        score_candidates. Only the chunks left after re-scoring count, so a
+        movie is ranked by its best of them.
+        """
+
+        return self.search_chunks_batch([query], limit, nprobe)[0]
+
+    def search_chunks_batch(
+        self,
+        queries: list[str],
+        limit: int = 10,
+        nprobe: int | None = IVF_NPROBE,
+    ) -> list[list[ChunkedResult]]:
+        """
+        Returns the search_chunks results of every query, in query order,
+        encoding the queries together and scoring them with matrix products
+        """
+
         if self.chunk_embeddings is None:
             raise ValueError(
                 "not initialized, did you call load_or_create_chunk_embeddings"
             )
 
-        query_embedding = self.generate_embedding(query)
-        scores = []
-        for i, embedding in enumerate(self.chunk_embeddings):
-            scores.append({
-                "chunk_idx": self.chunk_metadata[i]["chunk_idx"],
-                "movie_idx": self.chunk_metadata[i]["movie_idx"],
-                "score": cosine_similarity(query_embedding, embedding),
-            })
-
-        movie_scores = {}
-        for score in scores:
-            movie_idx = score["movie_idx"]
-            if movie_idx not in movie_scores:
-                movie_scores[movie_idx] = score
-                continue
+        query_embeddings = normalize_rows(self.generate_embeddings(queries))
+        return [
+            self.__movie_results(rows, scores, limit)
+            for rows, scores in score_candidates_batch(
+                self.chunk_embeddings,
+                query_embeddings,
+                self.chunk_ann,
+                self.chunk_quantized,
+                nprobe,
+                limit * EMBEDDING_RESCORE if EMBEDDING_RESCORE else None,
+            )
+        ]
 
-            if movie_scores[movie_idx]["score"] < score["score"]:
-                movie_scores[movie_idx] = score
+    def __movie_results(
+        self,
+        rows: np.ndarray,
+        scores: np.ndarray,
+        limit: int,
+    ) -> list[ChunkedResult]:
+        if len(scores) == 0:
+            return []
 
-        sorted_scores = sorted(
-            movie_scores.values(),
-            key=lambda item: item["score"],
-            reverse=True,
-        )
+        # A movie scores as its best chunk. Rows are in ascending order and
+        # chunks in movie order, so each movie's scored chunks are a
+        # contiguous run.
+        starts = np.flatnonzero(np.diff(self.chunk_movies[rows], prepend=-1))
+        ends = np.append(starts[1:], len(rows))
+        movie_scores = np.maximum.reduceat(scores, starts)
 
         results = []
-        for score in sorted_scores[:limit]:
-            doc = self.documents[score["movie_idx"]]
+        for i in top_k(movie_scores, limit).tolist():
+            best = starts[i] + int(np.argmax(scores[starts[i]:ends[i]]))
+            row = int(rows[best])
+            score = {
+                "chunk_idx": int(self.chunk_numbers[row]),
+                "movie_idx": int(self.chunk_movies[row]),
+                "score": float(scores[best]),
+            }
+
+            doc = self.documents.document(score["movie_idx"], RESULT_FIELDS)
             results.append(ChunkedResult(
                 doc["id"],
                 doc["title"],
-                doc["description"][:100],
+                doc["description"],
                 score["score"],
-                score or {},
+                score,
             ))
 
         return results
@@ -2,3 +2,75 @@ BM25_B = 0.75
 BM25_K1 = 1.50
 DEFAULT_SEARCH_LIMIT = 5
 SCORE_PRECISION = 4
+
+# Number of similarly sized index segments that are merged into one
+MERGE_FACTOR = 10
+
+# Number of scores accumulated at once when searching a batch of queries,
+# bounding the dense queries-by-documents block to a few dozen megabytes
+BATCH_SCORES = 1 << 22
+
+# Score added per additional query term when the query terms in a document
+# are as close together as in the query, and how many times the search limit of the best documents
+# are considered for the boost
+PROXIMITY_BOOST = 1.0
+PROXIMITY_CANDIDATES = 10
+
+# Number of recent keyword search results kept, and for how many seconds
+RESULT_CACHE_SIZE = 1024
+RESULT_CACHE_TTL = 300.0
+
+# Number of query embeddings kept in memory by each process, and on disk
+# in the cache shared between processes
+QUERY_EMBEDDING_CACHE_SIZE = 1024
+QUERY_EMBEDDING_DISK_SIZE = 100_000
+
+# Number of documents indexed or embedded at a time when building from a
+# stream of documents
+BUILD_BATCH_SIZE = 10000
+
+# Number of texts the embedding model pads to the same length and encodes
+# at once when building embeddings
+ENCODE_BATCH_SIZE = 64
+
+# Semantic searches use an IVF index once there are this many embeddings,
+# probing IVF_NPROBE of its lists per query by default
+IVF_MIN_ROWS = 50_000
+IVF_NPROBE = 32
+
+# k-means iterations when training IVF centroids and PQ codebooks
+KMEANS_ITERATIONS = 10
+
+# Sample rows per list when training IVF centroids, which are retrained once
+# the rows grow by IVF_RETRAIN_GROWTH times
+IVF_TRAIN_PER_LIST = 64
+IVF_RETRAIN_GROWTH = 2
+
+# Type embedding rows are stored as: "float32", "float16" or "bfloat16"
+EMBEDDING_DTYPE = "float16"
+
+# How stored embeddings are compressed for scanning: None keeps only the
+# float32 rows, "int8" stores a byte per dimension and "pq" a byte per
+# subspace. The top limit * EMBEDDING_RESCORE candidates by their codes are
+# scored again against the stored rows, or none with EMBEDDING_RESCORE None.
+EMBEDDING_QUANTIZATION = None
+EMBEDDING_RESCORE = 4
+
+# Product quantization subspaces, centroids per subspace and sample rows per
+# centroid when training them. Quantizers are retrained once the rows grow
+# by QUANTIZER_RETRAIN_GROWTH times.
+PQ_SUBSPACES = 48
+PQ_CENTROIDS = 256
+PQ_TRAIN_PER_CENTROID = 64
+QUANTIZER_RETRAIN_GROWTH = 2
+
+# Seconds each CLI entry point may take to import, and the libraries none of
+# them may import before a command uses them
+IMPORT_BUDGETS = {
+    "evaluation_cli": 0.5,
+    "hybrid_search_cli": 0.5,
+    "keyword_search_cli": 0.5,
+    "search_daemon_cli": 0.5,
+    "semantic_search_cli": 0.5,
+}
+LAZY_MODULES = ["dotenv", "google.genai", "nltk", "sentence_transformers", "torch"]
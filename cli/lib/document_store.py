@@ -0,0 +1,228 @@
+import hashlib
+import json
+import os
+from collections.abc import Iterable, Iterator
+
+import numpy as np
+
+from .index_format import IndexFile, offset_dtype, write_index_file
+from .search_utils import CACHE_PATH, DATA_PATH, iter_movies
+
+
+class DocumentStore:
+    """
+    Read-only documents stored field by field in packed sections of a
+    memory-mapped file. Documents are looked up by position or by ID, and
+    only the requested fields are decoded.
+
+    Fields are projected with a mapping of field names to the maximum length
+    of their values, or None to keep them whole.
+    """
+
+    # Bump whenever the file layout changes, so that stores written by older
+    # versions are rebuilt
+    VERSION = 2
+
+    def __init__(
+        self,
+        names: list[str],
+        columns: list[tuple[np.ndarray, np.ndarray]],
+        doc_ids: np.ndarray,
+        hashes: np.ndarray,
+        sorted_numbers: np.ndarray,
+        source: dict | None = None,
+    ):
+        # Names of the fields other than "id", in the order documents list
+        # them, and for each field the offsets and data of its JSON-encoded
+        # values. Documents without a field have an empty value.
+        self.names = names
+        self.columns = dict(zip(names, columns))
+
+        # Document IDs by position, and the positions in document ID order
+        # to look IDs up by
+        self.doc_ids = doc_ids
+        self.sorted_numbers = sorted_numbers
+        self.sorted_ids = doc_ids[sorted_numbers]
+
+        # Content hash of every document by position, see content_hash
+        self.hashes = hashes
+
+        # Path, modification time and size of the file the documents were
+        # read from
+        self.source = source
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def __iter__(self) -> Iterator[dict]:
+        return self.iter()
+
+    def __contains__(self, doc_id: int) -> bool:
+        return self.number(doc_id) is not None
+
+    def iter(self, fields: dict[str, int | None] | None = None) -> Iterator[dict]:
+        """
+        Yields the documents in order
+        """
+
+        for doc_number in range(len(self)):
+            yield self.document(doc_number, fields)
+
+    def get(self, doc_id: int, fields: dict[str, int | None] | None = None) -> dict:
+        doc_number = self.number(doc_id)
+        if doc_number is None:
+            raise KeyError(doc_id)
+
+        return self.document(doc_number, fields)
+
+    def document(
+        self,
+        doc_number: int,
+        fields: dict[str, int | None] | None = None,
+    ) -> dict:
+        """
+        Decodes the requested fields of the document with the given position
+        """
+
+        if fields is None:
+            fields = dict.fromkeys(["id", *self.names])
+
+        doc = {}
+        for name, limit in fields.items():
+            if name == "id":
+                doc["id"] = int(self.doc_ids[doc_number])
+                continue
+
+            column = self.columns.get(name)
+            if column is None:
+                continue
+
+            offsets, data = column
+            start, end = offsets[doc_number], offsets[doc_number + 1]
+            if start == end:
+                continue
+
+            value = json.loads(data[start:end].tobytes())
+            if limit is not None:
+                value = value[:limit]
+            doc[name] = value
+
+        return doc
+
+    def number(self, doc_id: int) -> int | None:
+        """
+        Returns the position of the document ID, or None when it is not in
+        the store
+        """
+
+        i = int(np.searchsorted(self.sorted_ids, doc_id))
+        if i < len(self.sorted_ids) and self.sorted_ids[i] == doc_id:
+            return int(self.sorted_numbers[i])
+        return None
+
+    @classmethod
+    def build(cls, documents: Iterable[dict]) -> "DocumentStore":
+        doc_ids = []
+        hashes = []
+        names = []
+        values = {}
+        for doc in documents:
+            for name, value in doc.items():
+                if name == "id":
+                    continue
+                if name not in values:
+                    names.append(name)
+                    values[name] = [b""] * len(doc_ids)
+                values[name].append(json.dumps(value).encode("utf-8"))
+
+            doc_ids.append(doc["id"])
+            hashes.append(content_hash(doc))
+            for name in names:
+                if len(values[name]) < len(doc_ids):
+                    values[name].append(b"")
+
+        columns = []
+        for name in names:
+            lengths = [len(value) for value in values[name]]
+            offsets = np.zeros(len(lengths) + 1, dtype=offset_dtype(sum(lengths)))
+            np.cumsum(lengths, out=offsets[1:])
+            data = np.frombuffer(b"".join(values[name]), dtype=np.uint8)
+            columns.append((offsets, data))
+
+        doc_ids = np.array(doc_ids, dtype=np.int64)
+        sorted_numbers = np.argsort(doc_ids, kind="stable").astype(np.int64)
+        hashes = np.array(hashes, dtype=np.uint64)
+        return cls(names, columns, doc_ids, hashes, sorted_numbers)
+
+    @classmethod
+    def load(cls, path: str) -> "DocumentStore":
+        f = IndexFile(path)
+        meta = f.json("meta")
+        columns = [
+            (f.array(f"f{i}_offsets"), f.array(f"f{i}_data"))
+            for i in range(len(meta["fields"]))
+        ]
+        return cls(
+            meta["fields"],
+            columns,
+            f.array("doc_ids"),
+            f.array("hashes"),
+            f.array("sorted_numbers"),
+            meta["source"],
+        )
+
+    def save(self, path: str) -> None:
+        meta = json.dumps({
+            "version": self.VERSION,
+            "fields": self.names,
+            "source": self.source,
+        })
+        sections = {
+            "meta": np.frombuffer(meta.encode("utf-8"), dtype=np.uint8),
+            "doc_ids": self.doc_ids,
+            "hashes": self.hashes,
+            "sorted_numbers": self.sorted_numbers,
+        }
+        for i, name in enumerate(self.names):
+            offsets, data = self.columns[name]
+            sections[f"f{i}_offsets"] = offsets
+            sections[f"f{i}_data"] = data
+
+        write_index_file(path, sections)
+
+
+def content_hash(doc: dict) -> int:
+    """
+    Returns a 64-bit hash of every field of a document, which changes
+    whenever any of its contents do
+    """
+
+    encoded = json.dumps(doc, sort_keys=True).encode("utf-8")
+    digest = hashlib.blake2b(encoded, digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def open_documents(path: str = DATA_PATH) -> DocumentStore:
+    """
+    Memory-maps the document store of a movies file, building it in the
+    cache first when it is missing or the movies file has changed since
+    """
+
+    st = os.stat(path)
+    source = {
+        "path": os.path.abspath(path),
+        "mtime_ns": st.st_mtime_ns,
+        "size": st.st_size,
+    }
+
+    store_path = os.path.join(CACHE_PATH, "documents.bin")
+    if os.path.exists(store_path):
+        meta = IndexFile(store_path).json("meta")
+        if meta.get("version") == DocumentStore.VERSION and meta["source"] == source:
+            return DocumentStore.load(store_path)
+
+    store = DocumentStore.build(iter_movies(path))
+    store.source = source
+    os.makedirs(CACHE_PATH, exist_ok=True)
+    store.save(store_path)
+    return DocumentStore.load(store_path)
@@ -0,0 +1,128 @@
+import json
+import os
+
+import numpy as np
+
+from .index_format import IndexFile, write_index_file
+from .query_utils import normalize_rows
+
+
+# Bump whenever the layout of embedding files changes, so that files written
+# by older versions are converted
+VERSION = 1
+
+# Number of rows decoded to float32 at a time when scoring
+DECODE_BATCH = 8192
+
+# Storage types of embedding rows. NumPy has no bfloat16, so bfloat16 rows
+# are stored as the upper 16 bits of their float32 values.
+STORAGE_DTYPES = {
+    "float32": np.dtype(np.float32),
+    "float16": np.dtype(np.float16),
+    "bfloat16": np.dtype(np.uint16),
+}
+
+
+class EmbeddingMatrix:
+    """
+    Read-only matrix of unit-length embeddings viewed straight out of a
+    memory-mapped embedding file, so processes opening the same file share
+    its pages and nothing is read until rows are used. Indexing and matrix
+    products decode the stored rows to float32 a block at a time.
+    """
+
+    def __init__(self, rows: np.ndarray, dtype: str):
+        self.rows = rows
+        self.dtype = dtype
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        return self.rows.shape
+
+    @property
+    def itemsize(self) -> int:
+        return self.rows.itemsize
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        return self[:] if dtype is None else self[:].astype(dtype)
+
+    def __getitem__(self, index) -> np.ndarray:
+        return decode(self.rows[index], self.dtype)
+
+    def __matmul__(self, other: np.ndarray) -> np.ndarray:
+        if self.dtype == "float32":
+            return self.rows @ other
+
+        blocks = [
+            self[start:start + DECODE_BATCH] @ other
+            for start in range(0, len(self), DECODE_BATCH)
+        ]
+        if len(blocks) == 0:
+            return self[:] @ other
+        return np.concatenate(blocks)
+
+
+def encode(vectors: np.ndarray, dtype: str) -> np.ndarray:
+    """
+    Converts float32 rows to a storage type, rounding bfloat16 to nearest
+    even
+    """
+
+    if dtype != "bfloat16":
+        return vectors.astype(STORAGE_DTYPES[dtype])
+
+    bits = np.ascontiguousarray(vectors, dtype=np.float32).view(np.uint32)
+    rounded = bits + np.uint32(0x7FFF) + ((bits >> 16) & np.uint32(1))
+    return (rounded >> 16).astype(np.uint16)
+
+
+def decode(rows: np.ndarray, dtype: str) -> np.ndarray:
+    if dtype != "bfloat16":
+        return rows.astype(np.float32, copy=False)
+
+    return (rows.astype(np.uint32) << 16).view(np.float32)
+
+
+def write_embeddings(path: str, vectors: np.ndarray, dtype: str) -> None:
+    # Encoding no texts may give a flat empty array
+    meta = json.dumps({
+        "version": VERSION,
+        "dtype": dtype,
+        "count": len(vectors),
+        "dimensions": vectors.shape[1] if vectors.ndim == 2 else 0,
+    })
+    write_index_file(path, {
+        "meta": np.frombuffer(meta.encode("utf-8"), dtype=np.uint8),
+        "rows": encode(vectors, dtype).ravel(),
+    })
+
+
+def open_embeddings(path: str, dtype: str) -> EmbeddingMatrix | None:
+    """
+    Memory-maps the embedding file at path, or returns None when there is
+    none. A file of another type or version is converted first, and so is
+    a NumPy file of the same name left by older versions, so cached
+    embeddings never have to be encoded again.
+    """
+
+    legacy_path = f"{os.path.splitext(path)[0]}.npy"
+    if not os.path.exists(path):
+        if not os.path.exists(legacy_path):
+            return None
+
+        write_embeddings(path, normalize_rows(np.load(legacy_path)), dtype)
+        os.remove(legacy_path)
+
+    f = IndexFile(path)
+    meta = f.json("meta")
+    if meta.get("version") != VERSION or meta["dtype"] != dtype:
+        rows = f.array("rows").reshape(meta["count"], meta["dimensions"])
+        write_embeddings(path, decode(rows, meta["dtype"]), dtype)
+        f = IndexFile(path)
+        meta = f.json("meta")
+
+    rows = f.array("rows").reshape(meta["count"], meta["dimensions"])
+    return EmbeddingMatrix(rows, dtype)
@@ -0,0 +1,163 @@
+import os
+import time
+from collections.abc import Callable
+
+import numpy as np
+
+from .constants import KMEANS_ITERATIONS
+from .query_utils import normalize_rows, top_k
+
+
+# Number of rows compared to the centroids at a time, bounding the
+# rows-by-centroids score block
+ASSIGN_BATCH = 4096
+
+
+def sample_rows(vectors: np.ndarray, size: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Returns size random rows of the vectors in ascending order, or all of
+    them when there are not that many
+    """
+
+    if len(vectors) <= size:
+        return vectors[:]
+
+    return vectors[np.sort(rng.choice(len(vectors), size, replace=False))]
+
+
+def nearest(
+    centroids: np.ndarray,
+    vectors: np.ndarray,
+    spherical: bool = False,
+) -> np.ndarray:
+    """
+    Returns the centroid closest in Euclidean distance to every vector,
+    the one maximizing vector @ centroid - |centroid|^2 / 2. With spherical,
+    the centroids are unit-length and the closest is the one with the
+    highest dot product.
+    """
+
+    bias = None if spherical else (centroids * centroids).sum(axis=1) / 2
+    found = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), ASSIGN_BATCH):
+        block = vectors[start:start + ASSIGN_BATCH] @ centroids.T
+        if bias is not None:
+            block -= bias
+        found[start:start + ASSIGN_BATCH] = np.argmax(block, axis=1)
+    return found
+
+
+def kmeans(
+    sample: np.ndarray,
+    k: int,
+    rng: np.random.Generator,
+    spherical: bool = False,
+) -> np.ndarray:
+    """
+    Returns k centroids of the sample rows found by Lloyd's algorithm. With
+    spherical, the centroids are scaled back to unit length after every
+    step, clustering the rows by direction.
+    """
+
+    centroids = sample[rng.choice(len(sample), k, replace=False)]
+    for _ in range(KMEANS_ITERATIONS):
+        assigned = nearest(centroids, sample, spherical)
+        counts = np.bincount(assigned, minlength=k)
+        filled = np.flatnonzero(counts)
+        starts = np.zeros(len(filled), dtype=np.int64)
+        np.cumsum(counts[filled][:-1], out=starts[1:])
+
+        sums = np.zeros_like(centroids)
+        order = np.argsort(assigned, kind="stable")
+        sums[filled] = np.add.reduceat(sample[order], starts)
+
+        # Centroids left without rows restart from a random sample row
+        centroids = (sums / np.maximum(counts, 1)[:, None]).astype(np.float32)
+        empty = np.flatnonzero(counts == 0)
+        centroids[empty] = sample[rng.choice(len(sample), len(empty))]
+        if spherical:
+            centroids = normalize_rows(centroids)
+
+    return centroids
+
+
+def file_source(path: str) -> list | None:
+    """
+    Returns the modification time and size of a file, or None when it does
+    not exist
+    """
+
+    if not os.path.exists(path):
+        return None
+
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def open_derived(
+    path: str,
+    load: Callable,
+    fits: Callable,
+    train: Callable,
+    growth: float,
+    vectors: np.ndarray,
+    source: list,
+    rows: np.ndarray | None = None,
+    old_source: list | None = None,
+):
+    """
+    Returns an index derived from vectors read from a file with the given
+    source, such as an IVFIndex or QuantizedEmbeddings. The index saved at
+    path is used as is when it was built for that file, followed with rows
+    (see IVFIndex.update) when it was built for the file's old_source, and
+    trained again when it does not fit the vectors or they have grown more
+    than growth times since it was trained.
+    """
+
+    derived = None
+    if os.path.exists(path):
+        derived = load(path)
+        if not fits(derived):
+            derived = None
+
+    if derived is None or len(vectors) > growth * derived.trained_size:
+        derived = train()
+    elif derived.source == source and len(derived) == len(vectors):
+        return derived
+    else:
+        if (
+            rows is None or
+            derived.source != old_source or
+            len(derived) <= rows.max(initial=-1)
+        ):
+            rows = np.full(len(vectors), -1, dtype=np.int64)
+        derived.update(vectors, rows)
+
+    derived.source = source
+    derived.save(path)
+    return derived
+
+
+def recall_at_k(
+    vectors: np.ndarray,
+    queries: np.ndarray,
+    k: int,
+    search: Callable[[np.ndarray], np.ndarray],
+) -> tuple[float, float]:
+    """
+    Returns the fraction of the exact k nearest rows of each query among the
+    rows search returns for it, and the average search time in milliseconds
+    """
+
+    found = 0
+    elapsed = 0.0
+    for query in queries:
+        exact = set(top_k(vectors @ query, k).tolist())
+
+        start = time.perf_counter()
+        approx = search(query)
+        elapsed += time.perf_counter() - start
+
+        found += len(exact.intersection(approx.tolist()))
+
+    return found / (k * len(queries)), elapsed * 1000 / len(queries)
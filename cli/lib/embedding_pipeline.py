@@ -0,0 +1,197 @@
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import shutil
+from collections.abc import Callable
+
+import numpy as np
+
+from .constants import BUILD_BATCH_SIZE, ENCODE_BATCH_SIZE
+
+
+class EmbeddingPipeline:
+    """
+    Encodes a corpus of texts for building embeddings. Identical texts are
+    encoded once, and the distinct texts are sorted by length so that each
+    batch the model pads holds texts of about the same length. They are
+    encoded in shards of BUILD_BATCH_SIZE texts, each saved as a checkpoint
+    under checkpoint_path as soon as it is done, so an interrupted build
+    resumes from the last finished shard when it is run again on the same
+    texts. With more than one worker, shards are encoded in a process pool,
+    each worker loading its own copy of the model.
+
+    Texts are strings, or lists of strings that the model encodes together.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        load_model: Callable,
+        checkpoint_path: str,
+        workers: int = 1,
+    ):
+        self.model_name = model_name
+        self.load_model = load_model
+        self.checkpoint_path = checkpoint_path
+        self.workers = workers
+
+    def encode(self, texts: list) -> np.ndarray:
+        """
+        Returns the embedding of every text, one row each, in order
+        """
+
+        if len(texts) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+
+        # Row of each text among the distinct texts
+        distinct = {}
+        unique_texts = []
+        inverse = np.empty(len(texts), dtype=np.int64)
+        for i, text in enumerate(texts):
+            key = text if isinstance(text, str) else tuple(text)
+            row = distinct.setdefault(key, len(unique_texts))
+            if row == len(unique_texts):
+                unique_texts.append(text)
+            inverse[i] = row
+
+        lengths = np.array([text_length(text) for text in unique_texts])
+        order = np.argsort(lengths, kind="stable")
+        shards = [
+            order[start:start + BUILD_BATCH_SIZE]
+            for start in range(0, len(order), BUILD_BATCH_SIZE)
+        ]
+
+        done = self.__open_checkpoint(unique_texts)
+        todo = [i for i in range(len(shards)) if i not in done]
+        if self.workers > 1 and len(todo) > 1:
+            self.__encode_in_pool(unique_texts, shards, todo)
+        else:
+            for i in todo:
+                embeddings = self.load_model().encode(
+                    [unique_texts[row] for row in shards[i].tolist()],
+                    batch_size=ENCODE_BATCH_SIZE,
+                    show_progress_bar=True,
+                )
+                self.__save_shard(i, embeddings)
+
+        sorted_embeddings = np.concatenate([
+            np.load(self.__shard_path(i))
+            for i in range(len(shards))
+        ])
+        unique_embeddings = np.empty_like(sorted_embeddings)
+        unique_embeddings[order] = sorted_embeddings
+
+        shutil.rmtree(self.checkpoint_path)
+        return unique_embeddings[inverse]
+
+    def __open_checkpoint(self, unique_texts: list) -> set[int]:
+        """
+        Returns the shards already encoded by an interrupted run on the same
+        texts, starting a new checkpoint when there is none
+        """
+
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(self.model_name.encode("utf-8"))
+        digest.update(json.dumps(unique_texts).encode("utf-8"))
+        progress = {
+            "fingerprint": digest.hexdigest(),
+            "shard_size": BUILD_BATCH_SIZE,
+        }
+
+        progress_path = os.path.join(self.checkpoint_path, "progress.json")
+        if os.path.exists(progress_path):
+            with open(progress_path) as f:
+                if json.load(f) == progress:
+                    return {
+                        int(name[len("shard_"):-len(".npy")])
+                        for name in os.listdir(self.checkpoint_path)
+                        if name.startswith("shard_") and name.endswith(".npy")
+                    }
+
+        shutil.rmtree(self.checkpoint_path, ignore_errors=True)
+        os.makedirs(self.checkpoint_path)
+        with open(progress_path, "w") as f:
+            json.dump(progress, f)
+        return set()
+
+    def __encode_in_pool(
+        self,
+        unique_texts: list,
+        shards: list[np.ndarray],
+        todo: list[int],
+    ) -> None:
+        """
+        Encodes shards in worker processes sharing the CPU cores, with at
+        most one shard per worker waiting to be saved
+        """
+
+        threads = max(1, (os.cpu_count() or 1) // self.workers)
+        with concurrent.futures.ProcessPoolExecutor(
+            self.workers,
+            initializer=load_worker_model,
+            initargs=(self.model_name, threads),
+        ) as pool:
+            pending = collections.deque()
+            for i in todo:
+                if len(pending) == self.workers:
+                    self.__save_shard(*pending.popleft())
+                pending.append((i, pool.submit(
+                    encode_shard,
+                    [unique_texts[row] for row in shards[i].tolist()],
+                )))
+            while pending:
+                self.__save_shard(*pending.popleft())
+
+    def __save_shard(
+        self,
+        i: int,
+        embeddings: np.ndarray | concurrent.futures.Future,
+    ) -> None:
+        if isinstance(embeddings, concurrent.futures.Future):
+            embeddings = embeddings.result()
+
+        # Written next to the shard first, so that a shard file is always
+        # complete
+        path = self.__shard_path(i)
+        with open(f"{path}.tmp", "wb") as f:
+            np.save(f, np.asarray(embeddings, dtype=np.float32))
+        os.replace(f"{path}.tmp", path)
+
+    def __shard_path(self, i: int) -> str:
+        return os.path.join(self.checkpoint_path, f"shard_{i}.npy")
+
+
+def text_length(text) -> int:
+    """
+    Returns the number of characters of a text, which orders texts about
+    the same way as their number of tokens
+    """
+
+    if isinstance(text, str):
+        return len(text)
+    return sum(len(part) for part in text)
+
+
+# Model of a worker process of the encoding pool
+worker_model = None
+
+
+def load_worker_model(model_name: str, threads: int) -> None:
+    global worker_model
+
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    # Each worker gets its share of the cores instead of all of them
+    torch.set_num_threads(threads)
+    worker_model = SentenceTransformer(model_name)
+
+
+def encode_shard(texts: list) -> np.ndarray:
+    return worker_model.encode(
+        texts,
+        batch_size=ENCODE_BATCH_SIZE,
+        show_progress_bar=False,
+    )
@@ -1,7 +1,6 @@
 import json
 
-from .search_utils import load_movies
-from .hybrid_search import HybridSearch
+from .search_daemon import open_engine
 
 
 def default_command(dataset_path: str, limit: int) -> None:
@@ -10,15 +9,16 @@ def default_command(dataset_path: str, limit: int) -> None:
     with open(dataset_path) as f:
         data = json.load(f)
 
-    movies = load_movies()
-    search = HybridSearch(movies)
+    search = open_engine("hybrid")
+    tests = data["test_cases"]
+    batch = search.rrf_search_batch([test["query"] for test in tests], 60, limit)
 
-    for test in data["test_cases"]:
+    for test, results in zip(tests, batch):
         query = test["query"]
         relevant = test["relevant_docs"]
 
         found = []
-        for result in search.rrf_search(query, 60, limit):
+        for result in results:
             found.append(result.doc["title"])
 
         relevant_set = set(relevant)
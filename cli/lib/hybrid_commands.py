@@ -2,13 +2,8 @@ import json
 import os
 import time
 
-from dotenv import load_dotenv
-from google import genai
-from sentence_transformers import CrossEncoder
-
-from .hybrid_search import HybridSearch
 from .hybrid_utils import normalize
-from .search_utils import load_movies
+from .search_daemon import open_engine
 
 
 model = "gemini-2.5-flash"
@@ -26,10 +21,6 @@ def rrf_search_command(
     enhance: str,
     rerank_method: str,
 ) -> None:
-    load_dotenv()
-    api_key = os.environ.get("GEMINI_API_KEY")
-    client = genai.Client(api_key=api_key)
-
     contents = None
     if enhance == "expand":
         contents = f"""
@@ -83,6 +74,16 @@ def rrf_search_command(
 
     print(f"LOG: Original query: {query}")
 
+    # The Gemini client is only needed to enhance queries or rerank with
+    # the LLM, and its libraries are slow to import
+    client = None
+    if contents is not None or rerank_method in ("individual", "batch"):
+        from dotenv import load_dotenv
+        from google import genai
+
+        load_dotenv()
+        client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
+
     if contents is not None:
         response = client.models.generate_content(
             model=model,
@@ -100,8 +101,7 @@ def rrf_search_command(
         original_limit = limit
         limit = limit * 5
 
-    movies = load_movies()
-    search = HybridSearch(movies)
+    search = open_engine("hybrid")
     results = search.rrf_search(query, k, limit)
 
     print("LOG: search.rrf_search results")
@@ -198,6 +198,8 @@ def rrf_search_command(
                 f"{result.doc['title']} {result.doc['description']}",
             ])
 
+        from sentence_transformers import CrossEncoder
+
         cross_encoder = CrossEncoder("cross-encoder/ms-marco-TinyBERT-L2-v2")
         scores = cross_encoder.predict(pairs)
 
@@ -225,9 +227,25 @@ def rrf_search_command(
         print(f"   {result.doc['description'][:50]}")
 
 
+def sync_index_command() -> int:
+    """
+    Brings the keyword index up to date with the movies, returning the
+    number of documents it holds
+    """
+
+    from .cache_manifest import CacheManifest
+    from .document_store import open_documents
+    from .hybrid_search import sync_index
+    from .inverted_index import InvertedIndex
+
+    index = InvertedIndex()
+    index.load()
+    sync_index(index, open_documents(), CacheManifest())
+    return len(index.docmap)
+
+
 def weighted_search_command(query: str, alpha: float, limit: int) -> None:
-    movies = load_movies()
-    search = HybridSearch(movies)
+    search = open_engine("hybrid")
     for i, result in enumerate(search.weighted_search(query, alpha, limit), 1):
         print(f"{i}. {result.doc['title']}")
         print(f"   Hybrid Score: {result.weighted_score:.4f}")
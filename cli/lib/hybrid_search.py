@@ -1,12 +1,18 @@
+import itertools
 import os
 
+import numpy as np
+
+from .cache_manifest import CacheManifest, match_documents
 from .inverted_index import BM25SearchResult, InvertedIndex
 from .chunked_semantic_search import ChunkedSemanticSearch
+from .document_store import DocumentStore, content_hash
 from .hybrid_utils import (
     hybrid_score,
     normalize,
     rrf_score,
 )
+from .query_utils import Analyzer
 
 
 class RRFResult:
@@ -36,18 +42,32 @@ class WeightedResult:
 
 
 class HybridSearch:
-    def __init__(self, documents: list[dict]):
+    def __init__(
+        self,
+        documents: DocumentStore,
+        semantic_search: ChunkedSemanticSearch | None = None,
+    ):
+        # Shared store the semantic search also fetches results from
         self.documents = documents
-        self.semantic_search = ChunkedSemanticSearch()
-        self.semantic_search.load_or_create_chunk_embeddings(documents)
 
+        # A semantic search with chunk embeddings loaded may be shared so that
+        # its model is only loaded once
+        self.semantic_search = semantic_search
+        if self.semantic_search is None:
+            self.semantic_search = ChunkedSemanticSearch()
+            self.semantic_search.load_or_create_chunk_embeddings(documents)
+
+        # Built and saved when missing, and otherwise loaded once and only
+        # reloaded when the index on disk changes. Searches never write to
+        # it; sync_index brings it up to date with the documents.
         self.idx = InvertedIndex()
-        if not os.path.exists(self.idx.index_file):
-            self.idx.build(documents)
-            self.idx.save()
+        if os.path.exists(self.idx.index_file):
+            self.idx.load()
+        else:
+            rebuild_index(self.idx, documents, CacheManifest())
 
     def _bm25_search(self, query: str, limit: int) -> list[BM25SearchResult]:
-        self.idx.load()
+        self.idx.refresh()
         return self.idx.bm25_search(query, limit)
 
     def rrf_search(self, query: str, k: int, limit: int) -> list[RRFResult]:
@@ -56,7 +76,37 @@ class HybridSearch:
             query,
             limit * 500,
         )
+        return self.__fuse_ranks(bm25_results, semantic_results, k, limit)
+
+    def rrf_search_batch(
+        self,
+        queries: list[str],
+        k: int,
+        limit: int,
+    ) -> list[list[RRFResult]]:
+        """
+        Returns the rrf_search results of every query, in query order, with
+        both the keyword and semantic searches run as batches
+        """
+
+        self.idx.refresh()
+        bm25_batch = self.idx.bm25_search_batch(queries, limit * 500)
+        semantic_batch = self.semantic_search.search_chunks_batch(
+            queries,
+            limit * 500,
+        )
+        return [
+            self.__fuse_ranks(bm25_results, semantic_results, k, limit)
+            for bm25_results, semantic_results in zip(bm25_batch, semantic_batch)
+        ]
 
+    def __fuse_ranks(
+        self,
+        bm25_results: list[BM25SearchResult],
+        semantic_results: list,
+        k: int,
+        limit: int,
+    ) -> list[RRFResult]:
         rank_map = {}
         for i, result in enumerate(bm25_results, 1):
             id = result.movie["id"]
@@ -64,9 +114,11 @@ class HybridSearch:
                 id,
                 i,
                 0,
-                self.semantic_search.document_map[id],
+                result.movie,
             )
 
+        # Documents added through the keyword index alone are not in the
+        # document store, so only semantic hits are looked up in it
         for i, result in enumerate(semantic_results, 1):
             id = result.doc_id
             if id in rank_map:
@@ -76,7 +128,7 @@ class HybridSearch:
                     id,
                     i,
                     0,
-                    self.semantic_search.document_map[id],
+                    self.documents.get(id),
                 )
 
             rank_map[id].calculate_score(k)
@@ -115,7 +167,7 @@ class HybridSearch:
                 result.normal_score,
                 0.0,
                 0.0,
-                self.semantic_search.document_map[id],
+                result.movie,
             )
 
         for result in semantic_results:
@@ -128,10 +180,11 @@ class HybridSearch:
                     0.0,
                     result.normal_score,
                     0.0,
-                    self.semantic_search.document_map[id],
+                    self.documents.get(id),
                 )
 
-            hs = score_map[id]
+        # Keyword hits the semantic search missed are scored too
+        for hs in score_map.values():
             hs.hybrid_score = hybrid_score(
                 hs.bm25_score,
                 hs.semantic_score,
@@ -143,3 +196,89 @@ class HybridSearch:
             key=lambda v: v.hybrid_score,
             reverse=True,
         )[:limit]
+
+
+def rebuild_index(
+    idx: InvertedIndex,
+    documents: DocumentStore,
+    cache_manifest: CacheManifest,
+    recorded: frozenset[int] = frozenset(),
+) -> None:
+    """
+    Builds the index from the documents, keeping any document already in it
+    that was not recorded as one of them, such as movies added with
+    keyword_search_cli.py add
+    """
+
+    kept = []
+    for id in idx.docmap:
+        if id not in documents and id not in recorded:
+            kept.append(idx.docmap[id])
+
+    idx.build(itertools.chain(documents, kept))
+    idx.save()
+    record_index(documents, cache_manifest)
+
+
+def record_index(documents: DocumentStore, cache_manifest: CacheManifest) -> None:
+    cache_manifest.record(
+        "index",
+        {"analyzer": Analyzer.VERSION},
+        documents.doc_ids,
+        documents.hashes,
+    )
+
+
+def sync_index(
+    idx: InvertedIndex,
+    documents: DocumentStore,
+    cache_manifest: CacheManifest,
+) -> None:
+    """
+    Reindexes the documents that were added or changed since the index was
+    last synced and deletes the ones removed since, comparing the documents
+    to those recorded in the cache manifest. Documents the manifest does not
+    record, such as movies added or updated through the keyword search CLI,
+    are never deleted. Before anything is recorded, the documents are
+    compared to what the index holds instead.
+    """
+
+    entry = cache_manifest.get("index")
+    if entry is None:
+        old_ids = np.fromiter(idx.docmap, dtype=np.int64)
+        old_hashes = np.array(
+            [content_hash(idx.docmap[id]) for id in old_ids.tolist()],
+            dtype=np.uint64,
+        )
+        removed = []
+    else:
+        old_ids = entry["ids"]
+        if entry["params"] != {"analyzer": Analyzer.VERSION}:
+            rebuild_index(
+                idx,
+                documents,
+                cache_manifest,
+                frozenset(old_ids.tolist()),
+            )
+            return
+
+        old_hashes = entry["hashes"]
+        removed = np.setdiff1d(old_ids, documents.doc_ids).tolist()
+
+    rows = match_documents(
+        old_ids,
+        old_hashes,
+        documents.doc_ids,
+        documents.hashes,
+    )
+    stale = np.flatnonzero(rows < 0).tolist()
+    if stale or removed:
+        if removed:
+            idx.delete_documents(removed)
+        if stale:
+            idx.update_documents([documents.document(i) for i in stale])
+        idx.save()
+        idx.merge()
+
+    if entry is None or stale or removed:
+        record_index(documents, cache_manifest)
@@ -0,0 +1,77 @@
+import os
+import subprocess
+import sys
+
+
+# Directory of the CLI entry points, which import the library as "lib"
+CLI_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class ImportProfile:
+    """
+    Modules imported by importing an entry point in a fresh interpreter,
+    with the time each took including the modules it imported
+    """
+
+    def __init__(self, module: str, cumulative: dict[str, float]):
+        self.module = module
+        self.cumulative = cumulative
+
+    @property
+    def total(self) -> float:
+        return self.cumulative.get(self.module, 0.0)
+
+    def slowest(self, count: int) -> list[tuple[str, float]]:
+        modules = [item for item in self.cumulative.items() if item[0] != self.module]
+        return sorted(modules, key=lambda item: item[1], reverse=True)[:count]
+
+    def imported(self, names: list[str]) -> list[str]:
+        """
+        Returns the names that were imported, themselves or any submodule
+        """
+
+        return [
+            name for name in names
+            if any(
+                module == name or module.startswith(f"{name}.")
+                for module in self.cumulative
+            )
+        ]
+
+
+def profile_imports(module: str, runs: int = 3) -> ImportProfile:
+    """
+    Imports a module in fresh interpreters with -X importtime and keeps the
+    fastest run, since the first may be slowed by a cold page cache
+    """
+
+    best = None
+    for _ in range(runs):
+        completed = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=CLI_PATH,
+            capture_output=True,
+            text=True,
+        )
+        if completed.returncode != 0:
+            raise RuntimeError(
+                f"importing {module} failed:\n{completed.stderr.strip()}"
+            )
+
+        # Lines are "import time: self [us] | cumulative | name", with the
+        # name indented by how deeply it was imported
+        cumulative = {}
+        for line in completed.stderr.splitlines():
+            if not line.startswith("import time:"):
+                continue
+
+            fields = line[len("import time:"):].split("|")
+            if len(fields) != 3 or not fields[1].strip().isdigit():
+                continue
+            cumulative[fields[2].strip()] = int(fields[1]) / 1e6
+
+        profile = ImportProfile(module, cumulative)
+        if best is None or profile.total < best.total:
+            best = profile
+
+    return best
@@ -1,23 +1,40 @@
 from .constants import BM25_B, BM25_K1, DEFAULT_SEARCH_LIMIT
 from .inverted_index import InvertedIndex, BM25SearchResult
-from .query_utils import clean
-from .search_utils import load_movies
+from .search_daemon import open_engine
+from .search_utils import iter_movies
 
 
-def bm25idf_command(term: str) -> float:
+def add_command(path: str) -> int:
+    movies = list(iter_movies(path))
     index = InvertedIndex()
     index.load()
+    index.add_documents(movies)
+    index.save()
+    index.merge(background=True)
+    return len(movies)
+
+
+def bm25idf_command(term: str) -> float:
+    index = open_engine("index")
     return index.get_bm25_idf(term)
 
 
 def bm25_search_command(
     query: str,
     limit: int = DEFAULT_SEARCH_LIMIT,
+    prune: bool = False,
+    proximity: bool = False,
 ) -> list[BM25SearchResult]:
-    index = InvertedIndex()
-    index.load()
-    return index.bm25_search(query, limit)
-    pass
+    index = open_engine("index")
+    return index.bm25_search(query, limit, prune, proximity)
+
+
+def bm25_search_batch_command(
+    queries: list[str],
+    limit: int = DEFAULT_SEARCH_LIMIT,
+) -> list[list[BM25SearchResult]]:
+    index = open_engine("index")
+    return index.bm25_search_batch(queries, limit)
 
 
 def bm25_tf_command(
@@ -26,48 +43,67 @@ def bm25_tf_command(
     k1: float = BM25_K1,
     b: float = BM25_B,
 ) -> float:
+    index = open_engine("index")
+    return index.get_bm25_tf(doc_id, term, k1, b)
+
+
+def delete_command(ids: list[int]) -> int:
     index = InvertedIndex()
     index.load()
-    return index.get_bm25_tf(doc_id, term, k1, b)
+    deleted = index.delete_documents(ids)
+    index.save()
+    index.merge(background=True)
+    return deleted
 
 
-def build_command() -> None:
-    movies = load_movies()
+def build_command(workers: int = 1, positions: bool = True) -> None:
     index = InvertedIndex()
-    index.build(movies)
+    index.positions = positions
+    index.build(iter_movies(), workers)
     index.save()
 
 
 def idf_command(term: str) -> float:
-    index = InvertedIndex()
-    index.load()
+    index = open_engine("index")
     return index.get_idf(term)
 
 
-def search_command(query: str, limit: int = DEFAULT_SEARCH_LIMIT) -> list[dict]:
+def merge_command() -> int:
     index = InvertedIndex()
     index.load()
+    index.merge()
+    return len(index.segments)
+
 
-    ids = []
-    for term in clean(query):
-        ids.extend(index.get_documents(term))
-        if len(ids) >= DEFAULT_SEARCH_LIMIT:
-            break
+def proximity_search_command(
+    query: str,
+    distance: int,
+    limit: int = DEFAULT_SEARCH_LIMIT,
+) -> list[BM25SearchResult]:
+    index = open_engine("index")
+    return index.proximity_search(query, distance, limit)
 
-    movies = []
-    for id in ids[:DEFAULT_SEARCH_LIMIT]:
-        movies.append(index.docmap[id])
 
-    return movies
+def search_command(query: str, limit: int = DEFAULT_SEARCH_LIMIT) -> list[dict]:
+    index = open_engine("index")
+    return index.boolean_search(query, limit)
 
 
 def term_command(doc_id: int, term: str) -> int:
-    index = InvertedIndex()
-    index.load()
+    index = open_engine("index")
     return index.get_tf(doc_id, term)
 
 
-def tfidf_command(doc_id: int, term: str) -> float:
+def update_command(path: str) -> int:
+    movies = list(iter_movies(path))
     index = InvertedIndex()
     index.load()
+    index.update_documents(movies)
+    index.save()
+    index.merge(background=True)
+    return len(movies)
+
+
+def tfidf_command(doc_id: int, term: str) -> float:
+    index = open_engine("index")
     return index.get_idf(term) * index.get_tf(doc_id, term)
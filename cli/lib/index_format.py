@@ -0,0 +1,398 @@
+import bisect
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+
+
+# Index files start with a fixed header followed by a table of sections:
+#
+#   header:  magic (8 bytes), format version (u32), section count (u32)
+#   section: name (16 bytes), NumPy dtype string (8 bytes),
+#            byte offset (u64), element count (u64)
+#
+# Every section is a flat little-endian array aligned to ALIGNMENT bytes, so
+# a memory-mapped file can be viewed as NumPy arrays without deserializing
+# anything. Bit-packed arrays (see BitPackedArray) are stored as four
+# sections sharing a name prefix.
+MAGIC = b"RAGINDEX"
+VERSION = 2
+ALIGNMENT = 64
+
+# Widest bit-packed value; wider values would not fit in the 8 bytes read to
+# decode one
+MAX_WIDTH = 56
+
+HEADER = struct.Struct("<8sII")
+SECTION = struct.Struct("<16s8sQQ")
+
+
+def encode_strings(strings: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Packs strings into a UTF-8 byte array and an offsets array, where string
+    i is data[offsets[i]:offsets[i + 1]]
+    """
+
+    encoded = [s.encode("utf-8") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    return offsets, data
+
+
+def write_index_file(path: str, sections: dict[str, np.ndarray]) -> None:
+    """
+    Writes the named arrays to path in the index file format. The file is
+    written next to path first and then moved into place, so readers never
+    see a partially written index.
+    """
+
+    table_size = HEADER.size + SECTION.size * len(sections)
+    offset = table_size
+
+    entries = []
+    for name, array in sections.items():
+        array = np.ascontiguousarray(array)
+        offset += -offset % ALIGNMENT
+        entries.append((name, array, offset))
+        offset += array.nbytes
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(entries)))
+        for name, array, offset in entries:
+            f.write(SECTION.pack(
+                name.encode("ascii"),
+                array.dtype.newbyteorder("<").str.encode("ascii"),
+                offset,
+                len(array),
+            ))
+
+        for name, array, offset in entries:
+            f.write(b"\0" * (offset - f.tell()))
+            f.write(array.astype(array.dtype.newbyteorder("<")).tobytes())
+
+    os.replace(tmp_path, path)
+
+
+class IndexFile:
+    """
+    A memory-mapped index file whose sections are exposed as read-only NumPy
+    arrays backed directly by the mapping
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, count = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            raise RuntimeError(f"not an index file: {path}")
+
+        if version != VERSION:
+            raise RuntimeError(
+                f"index file version {version} is not supported, "
+                f"expected {VERSION}; rebuild the index"
+            )
+
+        self.sections = {}
+        for i in range(count):
+            name, dtype, offset, length = SECTION.unpack_from(
+                self.mm,
+                HEADER.size + i * SECTION.size,
+            )
+            self.sections[name.rstrip(b"\0").decode("ascii")] = (
+                np.dtype(dtype.rstrip(b"\0").decode("ascii")),
+                offset,
+                length,
+            )
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.sections
+
+    def array(self, name: str) -> np.ndarray:
+        if name not in self.sections:
+            raise RuntimeError(f"index file has no {name} section: {self.path}")
+
+        dtype, offset, length = self.sections[name]
+        return np.frombuffer(self.mm, dtype=dtype, count=length, offset=offset)
+
+    def json(self, name: str):
+        return json.loads(self.array(name).tobytes())
+
+    def packed(self, name: str) -> "BitPackedArray":
+        return BitPackedArray(
+            self.array(f"{name}_starts"),
+            self.array(f"{name}_bytes"),
+            self.array(f"{name}_widths"),
+            self.array(f"{name}_data"),
+        )
+
+
+def offset_dtype(size: int) -> np.dtype:
+    """
+    Returns the smallest integer type that holds offsets up to size
+    """
+
+    if size <= np.iinfo(np.uint32).max:
+        return np.dtype(np.uint32)
+    return np.dtype(np.int64)
+
+
+class BitPackedArray:
+    """
+    Array of unsigned integers split into blocks, each packed with the fewest
+    bits that hold its largest value, so any range can be decoded without
+    touching the rest of the array.
+
+    Block i holds the values from starts[i] up to starts[i + 1], widths[i]
+    bits each, in data[byte_offsets[i]:byte_offsets[i + 1]].
+    """
+
+    def __init__(
+        self,
+        starts: np.ndarray,
+        byte_offsets: np.ndarray,
+        widths: np.ndarray,
+        data: np.ndarray,
+    ):
+        self.starts = starts
+        self.byte_offsets = byte_offsets
+        self.widths = widths
+        self.data = data
+
+        # The 8 bytes starting at every byte of data as one little-endian
+        # integer, so each value is decoded with a single gather
+        self.words = np.ndarray(
+            shape=(max(len(data) - 7, 0),),
+            dtype="<u8",
+            buffer=data,
+            strides=(1,),
+        )
+
+    @classmethod
+    def encode(cls, values: np.ndarray, starts: np.ndarray) -> "BitPackedArray":
+        """
+        Packs values into blocks beginning at the given ascending indexes,
+        the first of which must be 0
+        """
+
+        values = np.asarray(values, dtype=np.uint64)
+        starts = np.append(starts, len(values)).astype(np.int64)
+        counts = np.diff(starts)
+
+        widths = np.zeros(len(counts), dtype=np.uint8)
+        if len(values) > 0:
+            maxes = np.maximum.reduceat(values, starts[:-1])
+            widths = np.frexp(maxes.astype(np.float64))[1].astype(np.uint8)
+
+        if len(widths) > 0 and widths.max() > MAX_WIDTH:
+            raise RuntimeError(f"value too large to bit-pack: {values.max()}")
+
+        byte_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum((counts * widths + 7) // 8, out=byte_offsets[1:])
+
+        block = np.repeat(np.arange(len(counts)), counts)
+        width = widths[block].astype(np.int64)
+        index = np.arange(len(values)) - starts[block]
+        bit = byte_offsets[block] * 8 + index * width
+
+        bits = np.zeros(int(byte_offsets[-1]) * 8, dtype=np.uint8)
+        for w in np.unique(widths[widths > 0]).tolist():
+            selected = width == w
+            shifts = np.arange(w, dtype=np.uint64)
+            bits[bit[selected, None] + np.arange(w)] = (
+                values[selected, None] >> shifts
+            ) & 1
+
+        # Decoding reads 8 bytes from the start of each value, so pad the
+        # data to never read past its end
+        data = np.concatenate([
+            np.packbits(bits, bitorder="little"),
+            np.zeros(8, dtype=np.uint8),
+        ])
+
+        return cls(
+            starts.astype(offset_dtype(len(values))),
+            byte_offsets.astype(offset_dtype(len(data))),
+            widths,
+            data,
+        )
+
+    def __len__(self) -> int:
+        return int(self.starts[-1])
+
+    def decode(self, start: int = 0, stop: int | None = None) -> np.ndarray:
+        """
+        Unpacks the values from start up to stop
+        """
+
+        if stop is None:
+            stop = len(self)
+
+        if start >= stop:
+            return np.zeros(0, dtype=np.int64)
+
+        # Search with the type of the array, which NumPy would otherwise
+        # convert as a whole
+        index = self.starts.dtype.type
+        first = int(np.searchsorted(self.starts, index(start), "right")) - 1
+        last = int(np.searchsorted(self.starts, index(stop), "left"))
+
+        # Bit offset and width of each value: the bit offset of the block's
+        # data, extended back to where value 0 would be at the block's width
+        blocks = slice(first, last)
+        starts = self.starts[first:last + 1].astype(np.int64)
+        widths = self.widths[blocks].astype(np.int64)
+        origins = self.byte_offsets[blocks].astype(np.int64) * 8
+        origins -= starts[:-1] * widths
+
+        starts[0], starts[-1] = start, stop
+        counts = np.diff(starts)
+
+        width = np.repeat(widths, counts)
+        bit = np.repeat(origins, counts) + np.arange(start, stop) * width
+        return self.__unpack(bit, width)
+
+    def decode_blocks(self, blocks: np.ndarray) -> np.ndarray:
+        """
+        Unpacks the values of whole blocks, one block after the other in the
+        order given
+        """
+
+        first = self.starts[blocks].astype(np.int64)
+        counts = self.starts[blocks + 1].astype(np.int64) - first
+        widths = self.widths[blocks].astype(np.int64)
+        origins = self.byte_offsets[blocks].astype(np.int64) * 8
+
+        block_starts = np.cumsum(counts) - counts
+        index = np.arange(int(counts.sum())) - np.repeat(block_starts, counts)
+        width = np.repeat(widths, counts)
+        bit = np.repeat(origins, counts) + index * width
+        return self.__unpack(bit, width)
+
+    def __unpack(self, bit: np.ndarray, width: np.ndarray) -> np.ndarray:
+        """
+        Reads the values of the given widths starting at the given bit
+        offsets of data
+        """
+
+        width = width.astype(np.uint64)
+        words = self.words[bit >> 3]
+        mask = (np.uint64(1) << width) - np.uint64(1)
+        return ((words >> (bit & 7).astype(np.uint64)) & mask).astype(np.int64)
+
+    def sections(self, name: str) -> dict[str, np.ndarray]:
+        """
+        Returns the index file sections storing the array under name
+        """
+
+        return {
+            f"{name}_starts": self.starts,
+            f"{name}_bytes": self.byte_offsets,
+            f"{name}_widths": self.widths,
+            f"{name}_data": self.data,
+        }
+
+
+class Vocabulary:
+    """
+    Sorted table of terms, looked up by binary search over the packed UTF-8
+    bytes so it can be used straight out of a memory-mapped file
+    """
+
+    def __init__(self, offsets: np.ndarray, data: np.ndarray):
+        self.offsets = offsets
+        self.data = data
+        self.buffer = memoryview(data)
+
+    def __reduce__(self):
+        return (Vocabulary, (self.offsets, self.data))
+
+    @classmethod
+    def from_terms(cls, terms: list[str]) -> "Vocabulary":
+        return cls(*encode_strings(sorted(terms)))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> bytes:
+        return self.buffer[self.offsets[i]:self.offsets[i + 1]].tobytes()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i].decode("utf-8")
+
+    def __contains__(self, token: str) -> bool:
+        return self.get(token) is not None
+
+    def get(self, token: str) -> int | None:
+        """
+        Returns the term number of the token, or None when it is not in the
+        vocabulary
+        """
+
+        key = token.encode("utf-8")
+        i = bisect.bisect_left(self, key, 0, len(self))
+        if i < len(self) and self[i] == key:
+            return i
+        return None
+
+
+class DocumentMap:
+    """
+    Read-only mapping of document IDs to documents, decoding each JSON
+    document from the packed document section only when it is requested
+    """
+
+    def __init__(
+        self,
+        offsets: np.ndarray,
+        data: np.ndarray,
+        doc_ids: np.ndarray,
+        sorted_ids: np.ndarray,
+        sorted_numbers: np.ndarray,
+    ):
+        self.offsets = offsets
+        self.data = data
+        self.doc_ids = doc_ids
+        self.sorted_ids = sorted_ids
+        self.sorted_numbers = sorted_numbers
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def __iter__(self):
+        return iter(self.doc_ids.tolist())
+
+    def __contains__(self, doc_id: int) -> bool:
+        return self.number(doc_id) is not None
+
+    def __getitem__(self, doc_id: int) -> dict:
+        doc_number = self.number(doc_id)
+        if doc_number is None:
+            raise KeyError(doc_id)
+
+        return self.document(doc_number)
+
+    def document(self, doc_number: int) -> dict:
+        """
+        Decodes the document with the given document number
+        """
+
+        start, end = self.offsets[doc_number], self.offsets[doc_number + 1]
+        return json.loads(self.data[start:end].tobytes())
+
+    def number(self, doc_id: int) -> int | None:
+        """
+        Returns the document number of the document ID, or None when the
+        document is not in the index
+        """
+
+        i = int(np.searchsorted(self.sorted_ids, doc_id))
+        if i < len(self.sorted_ids) and self.sorted_ids[i] == doc_id:
+            return int(self.sorted_numbers[i])
+        return None
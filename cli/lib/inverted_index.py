@@ -1,12 +1,42 @@
+import bisect
 import collections
+import concurrent.futures
+import itertools
+import json
 import math
 import os
 import os.path
-import pickle
-
-from .constants import BM25_B, BM25_K1, DEFAULT_SEARCH_LIMIT
-from .query_utils import clean
+import re
+import threading
+from collections.abc import Iterable
+
+import numpy as np
+
+from .constants import (
+    BATCH_SCORES,
+    BM25_B,
+    BM25_K1,
+    BUILD_BATCH_SIZE,
+    DEFAULT_SEARCH_LIMIT,
+    MERGE_FACTOR,
+    PROXIMITY_BOOST,
+    PROXIMITY_CANDIDATES,
+    RESULT_CACHE_SIZE,
+    RESULT_CACHE_TTL,
+)
+from .boolean_query import NO_MORE_DOCS, parse_query, query_iterator
+from .lru_cache import LRUCache
+from .positions import min_span, phrase_frequency
+from .query_utils import analyzer, clean
 from .search_utils import CACHE_PATH
+from .segment import (
+    LiveDocumentMap,
+    PostingList,
+    Segment,
+    bm25_idf,
+    build_shard,
+)
+from .wand import block_max_top_k
 
 
 class BM25SearchResult:
@@ -16,54 +46,109 @@ class BM25SearchResult:
         self.normal_score = None
 
 
+class CollectionStats:
+    """
+    BM25 statistics over the live documents of every segment
+    """
+
+    def __init__(self, segments: list[Segment]):
+        self.num_docs = sum(seg.live_doc_count() for seg in segments)
+
+        self.avg_doc_length = 0.0
+        if self.num_docs > 0:
+            total = sum(seg.live_length_total() for seg in segments)
+            self.avg_doc_length = total / self.num_docs
+
+        # Index-wide number of the first document of each segment
+        self.bases = []
+        self.total_docs = 0
+        for seg in segments:
+            self.bases.append(self.total_docs)
+            self.total_docs += len(seg)
+
+        # A single segment without deletions is the whole collection, so the
+        # score bounds it stored when it was built are exact
+        self.stored_bounds = len(segments) == 1 and not segments[0].deleted.any()
+
+
 class InvertedIndex:
     def __init__(self):
 
-        # Dictionary mapping tokens to sets of document IDs
-        self.index = {}
+        # Immutable segments in the order their documents were added. The
+        # index-wide number of a document is its segment's base (see
+        # CollectionStats) plus its document number within the segment.
+        self.segments = []
 
-        # Dictionary mapping document IDs to their full document objects
-        self.docmap = {}
+        # Mapping of document IDs to their full document objects
+        self.docmap = LiveDocumentMap(self.segments)
 
-        # Dictionary mapping document IDs to their document lengths
-        self.doc_lengths = {}
+        # Incremented every time the manifest is saved
+        self.generation = 0
+        self.next_segment = 1
 
-        # Dictionary mapping document IDs to Counter objects
-        self.term_frequencies = {}
+        # Inode, modification time and size of the manifest when it was last
+        # loaded or saved, to notice when another process replaces it
+        self.manifest_stat = None
 
-        self.index_file = os.path.join(CACHE_PATH, "index.pkl")
-        self.docmap_file = os.path.join(CACHE_PATH, "docmap.pkl")
-        self.term_freq_file = os.path.join(CACHE_PATH, "term_frequencies.pkl")
-        self.doc_lengths_file = os.path.join(CACHE_PATH, "doc_lengths.pkl")
+        # Segment and tombstone files listed by the manifest this index was
+        # last loaded from or saved as, the only files a save may remove
+        self.manifest_files = set()
 
-    def __add_document(self, doc_id: int, text: str) -> None:
-        """
-        Tokenizes text, then adds each token to the index with the document ID
-        """
+        self.k1 = BM25_K1
+        self.b = BM25_B
 
-        tokens = clean(text)
-        self.term_frequencies[doc_id] = collections.Counter(tokens)
-        self.doc_lengths[doc_id] = len(tokens)
+        # Whether new segments record token positions, which phrase and
+        # proximity queries need
+        self.positions = True
 
-        for token in set(tokens):
-            if token not in self.index:
-                self.index[token] = []
-            self.index[token].append(doc_id)
+        self.index_dir = os.path.join(CACHE_PATH, "index")
+        self.index_file = os.path.join(self.index_dir, "manifest.json")
+        self.stems_file = os.path.join(self.index_dir, "stems.pkl")
 
-    def __get_avg_doc_length(self) -> float:
+        # Whether documents were analyzed since the analyzer's stem cache was
+        # warmed from, or last saved to, self.stems_file
+        self.analyzed = False
+
+        # Recent bm25_search results by analyzed query, emptied whenever the
+        # contents of the index change. Its hits and misses are counted.
+        self.results = LRUCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)
+
+        self.lock = threading.RLock()
+        self.merge_thread = None
+        self.__stats = None
+
+    def __get_stats(self) -> CollectionStats:
+        if self.__stats is None:
+            self.__stats = CollectionStats(self.segments)
+        return self.__stats
+
+    def __changed(self) -> None:
+        self.__stats = None
+        self.results.clear()
+
+    def __warm_analyzer(self) -> None:
+        if not self.analyzed:
+            analyzer.load_stems(self.stems_file)
+            self.analyzed = True
+
+    def __get_idf(self, token: str) -> float:
         """
-        Calculate the average document length of all documents
+        Calculates the BM25 IDF score of a token across all segments
         """
 
-        num_docs = len(self.doc_lengths)
-        if num_docs == 0:
-            return 0.0
+        docs = 0
+        for seg in self.segments:
+            docs += seg.get_document_frequency(token)
 
-        total = 0
-        for id in self.doc_lengths:
-            total += self.doc_lengths[id]
+        return float(bm25_idf(self.__get_stats().num_docs, docs))
 
-        return total / num_docs
+    def __get_impacts(
+        self,
+        seg: Segment,
+        postings: PostingList,
+        idf: float,
+    ) -> np.ndarray:
+        return seg.get_impacts(postings, idf, self.__get_stats().avg_doc_length)
 
     def bm25(self, doc_id: int, term: str) -> float:
         tf = self.get_bm25_tf(doc_id, term)
@@ -74,34 +159,447 @@ class InvertedIndex:
         self,
         query: str,
         limit: int = DEFAULT_SEARCH_LIMIT,
+        prune: bool = False,
+        proximity: bool = False,
     ) -> list[BM25SearchResult]:
+        """
+        Returns the limit highest scoring documents for the query, highest
+        score first with ties in the order documents were added. Parts of the
+        query in double quotes are phrases that matching documents must
+        contain exactly.
+
+        By default every posting of every query term is scored in one
+        vectorized pass. With prune, only the blocks of postings whose stored
+        score bounds can make it into the top-k are decoded and scored; the
+        results are identical.
+
+        With proximity, the best PROXIMITY_CANDIDATES times limit documents
+        are boosted by how close together the query terms occur in them.
+
+        Results are cached until the index changes; see self.results.
+        """
+
         tokens = clean(query)
-        scores = {}
+        terms, offsets = query_terms(query)
+        phrases = query_phrases(query)
+
+        # Scores only depend on the multiset of query tokens, not their order,
+        # unless the proximity boost compares their offsets
+        key = (
+            tuple(sorted(tokens)),
+            tuple(tuple(zip(*phrase)) for phrase in phrases),
+            limit,
+            tuple(zip(terms, offsets)) if proximity else None,
+            self.k1,
+            self.b,
+        )
+
+        with self.lock:
+            cached = self.results.get(key)
+            if cached is not None:
+                return [BM25SearchResult(dict(m), score) for m, score in cached]
+
+            allowed = self.__match_phrases(phrases)
+
+            candidates = limit
+            if proximity:
+                candidates = limit * PROXIMITY_CANDIDATES
+
+            if prune:
+                ranked = self.__rank_top_k(tokens, candidates, allowed)
+            else:
+                ranked = self.__rank_exhaustive(tokens, candidates, allowed)
+
+            if proximity:
+                ranked = self.__boost_proximity(terms, offsets, ranked)[:limit]
+
+            results = self.__get_results(ranked)
+            self.results.put(key, [(r.movie, r.score) for r in results])
+            return [BM25SearchResult(dict(r.movie), r.score) for r in results]
+
+    def proximity_search(
+        self,
+        query: str,
+        distance: int,
+        limit: int = DEFAULT_SEARCH_LIMIT,
+    ) -> list[BM25SearchResult]:
+        """
+        Returns the limit highest BM25 scoring documents that contain every
+        query term within a window of distance words, i.e. where the first
+        and last of the terms are at most distance positions apart
+        """
 
-        for token in tokens:
-            if token not in self.index:
+        tokens = clean(query)
+        terms, _ = query_terms(query)
+
+        with self.lock:
+            allowed = self.__match_positions(
+                terms,
+                lambda positions: min_span(positions) <= distance,
+            )
+            ranked = self.__rank_exhaustive(tokens, limit, allowed)
+            return self.__get_results(ranked)
+
+    def __match_phrases(
+        self,
+        phrases: list[tuple[list[str], list[int]]],
+    ) -> list[np.ndarray] | None:
+        """
+        Returns a mask per segment of the live documents containing every
+        phrase exactly, or None when there are no phrases to match
+        """
+
+        allowed = None
+        for phrase, phrase_offsets in phrases:
+            if len(phrase) == 0:
                 continue
 
-            for id in self.index[token]:
-                if id not in scores:
-                    scores[id] = 0
-                scores[id] += self.bm25(id, token)
+            matched = self.__match_positions(
+                phrase,
+                lambda positions: phrase_frequency(positions, phrase_offsets) > 0,
+            )
+            if allowed is None:
+                allowed = matched
+            else:
+                allowed = [a & m for a, m in zip(allowed, matched)]
 
-        ordered = dict(sorted(
-            scores.items(),
-            key=lambda item: item[1],
-            reverse=True,
-        ))
-        results = []
+        return allowed
+
+    def __match_positions(self, tokens: list[str], matches) -> list[np.ndarray]:
+        """
+        Returns a mask per segment of the live documents containing every
+        token for which matches(positions) holds, given the positions of each
+        token in the document. Positions are only decoded for documents
+        containing every token.
+        """
+
+        masks = []
+        for seg in self.segments:
+            mask = np.zeros(len(seg), dtype=bool)
+            masks.append(mask)
+
+            lists = [seg.get_postings(token) for token in tokens]
+            if not lists or any(len(postings) == 0 for postings in lists):
+                continue
+
+            candidates = lists[0].docs
+            for postings in lists[1:]:
+                candidates = np.intersect1d(
+                    candidates,
+                    postings.docs,
+                    assume_unique=True,
+                )
+            candidates = candidates[~seg.deleted[candidates]]
+
+            found = [
+                np.searchsorted(postings.docs, candidates).tolist()
+                for postings in lists
+            ]
+            for i, doc_number in enumerate(candidates.tolist()):
+                positions = [
+                    seg.get_positions(postings, f[i])
+                    for postings, f in zip(lists, found)
+                ]
+                mask[doc_number] = matches(positions)
+
+        return masks
+
+    def __boost_proximity(
+        self,
+        terms: list[str],
+        offsets: list[int],
+        ranked: list[tuple[int, float]],
+    ) -> list[tuple[int, float]]:
+        """
+        Adds PROXIMITY_BOOST for each additional query term to the score of
+        documents where the terms they contain are as close together as in
+        the query, given the offset of each term in the query, decaying as
+        the window holding them widens beyond that, and ranks them again
+        """
+
+        if len(terms) < 2:
+            return ranked
+
+        bases = self.__get_stats().bases
+        boosted = []
+        for doc_number, score in ranked:
+            i = bisect.bisect_right(bases, doc_number) - 1
+            seg, local = self.segments[i], doc_number - bases[i]
+
+            positions = []
+            found = []
+            for token, offset in zip(terms, offsets):
+                postings = seg.get_postings(token)
+                j = postings.find(local)
+                if j is not None:
+                    positions.append(seg.get_positions(postings, j))
+                    found.append(offset)
+
+            if len(positions) > 1:
+                gap = max(0, min_span(positions) - (max(found) - min(found)))
+                score += PROXIMITY_BOOST * (len(positions) - 1) / (1 + gap)
+            boosted.append((doc_number, score))
+
+        boosted.sort(key=lambda ranked: (-ranked[1], ranked[0]))
+        return boosted
+
+    def bm25_search_batch(
+        self,
+        queries: list[str],
+        limit: int = DEFAULT_SEARCH_LIMIT,
+    ) -> list[list[BM25SearchResult]]:
+        """
+        Returns the bm25_search results of every query, in query order,
+        phrases included.
+
+        The postings of each distinct term are gathered once for the whole
+        batch. Blocks of queries are then scored together by accumulating a
+        sparse query-term by term-document product into a dense block of
+        scores with np.bincount, and the top-k of each query is selected
+        from its row.
+        """
+
+        phrases = [query_phrases(query) for query in queries]
+        queries = [clean(query) for query in queries]
+
+        with self.lock:
+            stats = self.__get_stats()
+
+            # Documents and impacts of every posting of each distinct term,
+            # across all segments
+            terms = {}
+            for tokens in queries:
+                for token in tokens:
+                    if token not in terms:
+                        terms[token] = self.__get_term_scores(token)
+
+            live = np.ones(stats.total_docs, dtype=bool)
+            for seg, base in zip(self.segments, stats.bases):
+                live[base:base + len(seg)] = ~seg.deleted
+
+            results = []
+            rows = max(1, BATCH_SCORES // max(stats.total_docs, 1))
+            for start in range(0, len(queries), rows):
+                batch = queries[start:start + rows]
+                batch_phrases = phrases[start:start + rows]
+
+                # One (query, document, impact) entry per posting of every
+                # query term, in query term order so each document's score
+                # is summed in the same order as bm25_search
+                keys, weights = [], []
+                for row, tokens in enumerate(batch):
+                    for token in tokens:
+                        docs, impacts = terms[token]
+                        keys.append(docs + row * stats.total_docs)
+                        weights.append(impacts)
+
+                scores = np.bincount(
+                    np.concatenate(keys) if keys else np.empty(0, dtype=np.int64),
+                    np.concatenate(weights) if weights else None,
+                    minlength=len(batch) * stats.total_docs,
+                ).astype(np.float64, copy=False)
+                scores = scores.reshape(len(batch), stats.total_docs)
+                scores[:, ~live] = 0
+
+                for row, row_phrases in enumerate(batch_phrases):
+                    allowed = self.__match_phrases(row_phrases)
+                    if allowed is not None:
+                        scores[row, ~np.concatenate(allowed)] = 0
+
+                for ranked in self.__top_k_rows(scores, limit):
+                    results.append(self.__get_results(ranked))
 
-        for id in ordered:
-            if len(results) >= limit:
-                break
+        return results
+
+    def __top_k_rows(
+        self,
+        scores: np.ndarray,
+        limit: int,
+    ) -> list[list[tuple[int, float]]]:
+        """
+        Selects the top-k of every row of scores at once, ordered like
+        __top_k
+        """
+
+        if not 0 < limit < scores.shape[1]:
+            return [self.__top_k(row, limit) for row in scores]
+
+        # The limit-th highest score of each row; every document scoring at
+        # least that much is a candidate, so ties are broken by document
+        kth = -np.partition(-scores, limit - 1, axis=1)[:, limit - 1]
+        rows, docs = np.nonzero((scores >= kth[:, None]) & (scores > 0))
+        values = scores[rows, docs]
+        order = np.lexsort((docs, -values, rows))
+        rows, docs, values = rows[order], docs[order], values[order]
+
+        ranked = [[] for _ in range(len(scores))]
+        for row, doc, value in zip(rows.tolist(), docs.tolist(), values.tolist()):
+            if len(ranked[row]) < limit:
+                ranked[row].append((doc, value))
+        return ranked
+
+    def __get_term_scores(self, token: str) -> tuple[np.ndarray, np.ndarray]:
+        stats = self.__get_stats()
+        idf = self.__get_idf(token)
+
+        docs, impacts = [], []
+        for seg, base in zip(self.segments, stats.bases):
+            postings = seg.get_postings(token)
+            if len(postings) == 0:
+                continue
 
-            results.append(BM25SearchResult(self.docmap[id], ordered[id]))
+            docs.append(base + postings.docs)
+            impacts.append(self.__get_impacts(seg, postings, idf))
 
+        if not docs:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+        return (
+            np.concatenate(docs),
+            np.concatenate(impacts).astype(np.float64),
+        )
+
+    def __get_results(
+        self,
+        ranked: list[tuple[int, float]],
+    ) -> list[BM25SearchResult]:
+        bases = self.__get_stats().bases
+        results = []
+        for doc_number, score in ranked:
+            i = bisect.bisect_right(bases, doc_number) - 1
+            doc = self.segments[i].docmap.document(doc_number - bases[i])
+            results.append(BM25SearchResult(doc, score))
         return results
 
+    def __rank_top_k(
+        self,
+        tokens: list[str],
+        limit: int,
+        allowed: list[np.ndarray] | None = None,
+    ) -> list[tuple[int, float]]:
+        """
+        Ranks documents with Block-Max pruning, which relies on the score
+        bounds stored at build time and so falls back to ranking every
+        document once the index has several segments or deletions
+        """
+
+        stats = self.__get_stats()
+        if not stats.stored_bounds:
+            return self.__rank_exhaustive(tokens, limit, allowed)
+
+        seg = self.segments[0]
+        terms = []
+        idfs = []
+        block_lasts = []
+        block_maxes = []
+        term_maxes = []
+        for token in tokens:
+            term = seg.vocab.get(token)
+            if term is None:
+                continue
+
+            blocks = slice(seg.block_offsets[term], seg.block_offsets[term + 1])
+            terms.append(term)
+            idfs.append(self.__get_idf(token))
+            block_lasts.append(seg.block_last[blocks])
+            block_maxes.append(seg.block_max[blocks])
+            term_maxes.append(float(seg.term_max[term]))
+
+        def score_blocks(
+            i: int,
+            blocks: np.ndarray,
+        ) -> tuple[np.ndarray, np.ndarray]:
+            postings = seg.get_block_postings(terms[i], blocks)
+            return postings.docs, self.__get_impacts(seg, postings, idfs[i])
+
+        excluded = None if allowed is None else ~allowed[0]
+        return block_max_top_k(
+            block_lasts,
+            block_maxes,
+            term_maxes,
+            score_blocks,
+            len(seg),
+            excluded,
+            limit,
+        )
+
+    def __rank_exhaustive(
+        self,
+        tokens: list[str],
+        limit: int,
+        allowed: list[np.ndarray] | None = None,
+    ) -> list[tuple[int, float]]:
+        """
+        Ranks every document by its BM25 score, skipping deleted documents
+        and, per segment, documents not in the optional allowed mask
+        """
+
+        stats = self.__get_stats()
+        scores = np.zeros(stats.total_docs, dtype=np.float64)
+
+        for token in tokens:
+            idf = self.__get_idf(token)
+            for seg, base in zip(self.segments, stats.bases):
+                postings = seg.get_postings(token)
+                if len(postings) == 0:
+                    continue
+
+                impacts = self.__get_impacts(seg, postings, idf)
+                scores[base + postings.docs] += impacts
+
+        for i, (seg, base) in enumerate(zip(self.segments, stats.bases)):
+            if seg.deleted.any():
+                scores[base:base + len(seg)][seg.deleted] = 0
+            if allowed is not None:
+                scores[base:base + len(seg)][~allowed[i]] = 0
+
+        return self.__top_k(scores, limit)
+
+    def __top_k(
+        self,
+        scores: np.ndarray,
+        limit: int,
+    ) -> list[tuple[int, float]]:
+        matches = np.flatnonzero(scores)
+        if len(matches) > limit > 0:
+            top = np.argpartition(-scores[matches], limit - 1)[:limit]
+            threshold = scores[matches[top]].min()
+            matches = matches[scores[matches] >= threshold]
+
+        # Highest score first, ties in the order documents were added
+        ordered = matches[np.lexsort((matches, -scores[matches]))]
+
+        return [(int(d), float(scores[d])) for d in ordered[:limit]]
+
+    def boolean_search(
+        self,
+        query: str,
+        limit: int = DEFAULT_SEARCH_LIMIT,
+    ) -> list[dict]:
+        """
+        Returns the first limit documents, in the order they were added,
+        matching a boolean query of words combined with AND (the default),
+        OR, NOT and parentheses. Matching stops as soon as limit documents
+        are found.
+        """
+
+        node = parse_query(query)
+        if node is None:
+            return []
+
+        with self.lock:
+            matches = itertools.islice(self.__iter_matches(node), limit)
+            return [seg.docmap.document(doc) for seg, doc in matches]
+
+    def __iter_matches(self, node):
+        for seg in self.segments:
+            it = query_iterator(node, seg)
+            doc = it.next()
+            while doc != NO_MORE_DOCS:
+                if not seg.deleted[doc]:
+                    yield seg, doc
+                doc = it.next()
+
     def get_documents(self, term: str) -> list[int]:
         """
         Retrieves the set of document IDs for a given token and returns them as
@@ -110,11 +608,11 @@ class InvertedIndex:
         Assume the input term is a single token
         """
 
-        lower_term = term.lower()
-        if lower_term not in self.index:
-            return []
-
-        return self.index[lower_term]
+        ids = []
+        for seg in self.segments:
+            docs = seg.get_postings(term.lower()).docs
+            ids.extend(seg.doc_ids[docs[~seg.deleted[docs]]].tolist())
+        return ids
 
     def get_bm25_idf(self, term: str) -> float:
         """
@@ -129,13 +627,7 @@ class InvertedIndex:
         if len(tokens) > 1:
             raise RuntimeError(f"too many tokens in term: {term}")
 
-        docs = 0
-        if tokens[0] in self.index:
-            docs = len(self.index[tokens[0]])
-
-        total = len(self.docmap)
-
-        return math.log((total - docs + 0.5) / (docs + 0.5) + 1)
+        return self.__get_idf(tokens[0])
 
     def get_bm25_tf(
         self,
@@ -148,10 +640,11 @@ class InvertedIndex:
         Applies a saturation formula to the existing Term Frequency (TF)
         """
 
-        doc_length = self.doc_lengths[doc_id]
-        avg_doc_length = self.__get_avg_doc_length()
-        length_norm = 1 - b + b * (doc_length / avg_doc_length)
         tf = self.get_tf(doc_id, term)
+        seg, doc_number = self.docmap.locate(doc_id)
+        doc_length = seg.doc_lengths[doc_number]
+        avg_doc_length = self.__get_stats().avg_doc_length
+        length_norm = 1 - b + b * (doc_length / avg_doc_length)
         return (tf * (k1 + 1)) / (tf + k1 * length_norm)
 
     def get_idf(self, term: str) -> float:
@@ -170,10 +663,10 @@ class InvertedIndex:
             raise RuntimeError(f"too many tokens in term: {term}")
 
         matches = 0
-        if tokens[0] in self.index:
-            matches = len(self.index[tokens[0]])
+        for seg in self.segments:
+            matches += seg.get_document_frequency(tokens[0])
 
-        return math.log((len(self.docmap) + 1) / (matches + 1))
+        return math.log((self.__get_stats().num_docs + 1) / (matches + 1))
 
     def get_tf(self, doc_id: int, term: str) -> int:
         """
@@ -192,57 +685,392 @@ class InvertedIndex:
         if len(tokens) > 1:
             raise RuntimeError(f"too many tokens in term: {term}")
 
-        if doc_id not in self.term_frequencies:
+        location = self.docmap.locate(doc_id)
+        if location is None:
             raise RuntimeError(f"unknown document ID: {doc_id}")
 
-        return self.term_frequencies[doc_id][tokens[0]]
+        seg, doc_number = location
+        postings = seg.get_postings(tokens[0])
+        i = postings.find(doc_number)
+        if i is None:
+            return 0
+
+        return int(postings.tfs[i])
 
-    def build(self, movies: list[dict]) -> None:
+    def build(self, movies: Iterable[dict], workers: int = 1) -> None:
         """
-        Iterates over all the movies and adds them to both the index and the
-        doc map.
+        Replaces the contents of the index with the movies, as a single
+        segment.
 
         When adding the movie data to the index, concatenates the title and
         description to use as the input text.
+
+        The movies may be streamed: they are indexed in batches of
+        BUILD_BATCH_SIZE into partial segments that are merged in order,
+        which gives exactly the same segment as indexing them all at once.
+        With more than one worker, batches are indexed in a process pool,
+        with at most one batch per worker waiting to be merged. A list of
+        movies is split evenly between the workers when that makes for
+        smaller batches.
+        """
+
+        self.__warm_analyzer()
+
+        batch_size = BUILD_BATCH_SIZE
+        if workers > 1 and isinstance(movies, list) and len(movies) > workers:
+            batch_size = min(batch_size, math.ceil(len(movies) / workers))
+        batches = itertools.batched(movies, batch_size)
+
+        segments = []
+        if workers > 1:
+            with concurrent.futures.ProcessPoolExecutor(
+                workers,
+                initializer=analyzer.load_stems,
+                initargs=(self.stems_file,),
+            ) as pool:
+                pending = collections.deque()
+                for batch in batches:
+                    if len(pending) == workers:
+                        segments.append(self.__collect_shard(pending.popleft()))
+                    pending.append(pool.submit(
+                        build_shard,
+                        list(batch),
+                        self.positions,
+                    ))
+                while pending:
+                    segments.append(self.__collect_shard(pending.popleft()))
+        else:
+            for batch in batches:
+                segments.append(Segment.build(list(batch), self.positions))
+
+        if len(segments) == 0:
+            segment = Segment.build([], self.positions)
+        elif len(segments) == 1:
+            segment = segments[0]
+        else:
+            segment = Segment.merge(segments)
+
+        # The build replaces everything the index on disk holds, so the next
+        # save removes its files
+        replaced = set()
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                replaced = manifest_files(json.load(f))
+
+        with self.lock:
+            self.segments[:] = [segment]
+            self.manifest_files |= replaced
+            self.__changed()
+
+    def __collect_shard(self, future: concurrent.futures.Future) -> Segment:
+        segment, stems = future.result()
+        for part, token in stems:
+            analyzer.stems.put(part, token)
+        return segment
+
+    def add_documents(self, movies: list[dict]) -> None:
+        """
+        Indexes new movies into a new segment. Raises if a movie ID is already
+        in the index; use update_documents to replace movies.
         """
 
         for m in movies:
-            text = f"{m['title']} {m['description']}"
-            self.__add_document(m["id"], text)
-            self.docmap[m["id"]] = m
+            if m["id"] in self.docmap:
+                raise RuntimeError(f"document ID already indexed: {m['id']}")
 
-    def save(self) -> None:
+        self.__warm_analyzer()
+        segment = Segment.build(movies, self.positions)
+
+        with self.lock:
+            self.segments.append(segment)
+            self.__changed()
+
+    def update_documents(self, movies: list[dict]) -> None:
         """
-        Saves the index and the docmap to a cache directory inside of root_dir
-        in pickle format.
+        Replaces movies that are already in the index and adds the others
         """
 
-        os.makedirs(CACHE_PATH, exist_ok=True)
+        with self.lock:
+            self.delete_documents([m["id"] for m in movies])
+            self.add_documents(movies)
 
-        with open(self.index_file, "wb") as f:
-            pickle.dump(self.index, f)
+    def delete_documents(self, ids: list[int]) -> int:
+        """
+        Marks documents as deleted and returns how many were found. Their
+        postings are dropped the next time their segment is merged.
+        """
 
-        with open(self.docmap_file, "wb") as f:
-            pickle.dump(self.docmap, f)
+        deleted = 0
+        with self.lock:
+            for id in ids:
+                location = self.docmap.locate(id)
+                if location is None:
+                    continue
 
-        with open(self.term_freq_file, "wb") as f:
-            pickle.dump(self.term_frequencies, f)
+                seg, doc_number = location
+                seg.deleted[doc_number] = True
+                seg.deleted_file = None
+                deleted += 1
 
-        with open(self.doc_lengths_file, "wb") as f:
-            pickle.dump(self.doc_lengths, f)
+            self.__changed()
 
-    def load(self) -> None:
-        if not os.path.exists(CACHE_PATH):
-            raise RuntimeError(f"cache dir does not exist: {dir}")
+        return deleted
+
+    def __find_merge(self) -> tuple[int, int] | None:
+        """
+        Picks the run of segments to merge next, if any: MERGE_FACTOR
+        adjacent segments of the same size tier, or a single segment that is
+        mostly deleted documents
+        """
+
+        levels = []
+        for i, seg in enumerate(self.segments):
+            live = seg.live_doc_count()
+            if len(seg) > 0 and live < len(seg) / 2:
+                return i, i + 1
+            levels.append(int(math.log(max(live, 1), MERGE_FACTOR)))
 
-        with open(self.index_file, "rb") as f:
-            self.index = pickle.load(f)
+        start = 0
+        for end in range(1, len(levels) + 1):
+            if end < len(levels) and levels[end] == levels[start]:
+                continue
+            if end - start >= MERGE_FACTOR:
+                return start, start + MERGE_FACTOR
+            start = end
+
+        return None
+
+    def __merge_pending(self) -> None:
+        while True:
+            with self.lock:
+                run = self.__find_merge()
+                if run is None:
+                    return
+
+                sources = self.segments[run[0]:run[1]]
+                snapshots = [seg.deleted.copy() for seg in sources]
+
+            merged = Segment.merge(sources, snapshots)
+
+            with self.lock:
+                start = next(
+                    (i for i, seg in enumerate(self.segments) if seg is sources[0]),
+                    None,
+                )
+                end = None if start is None else start + len(sources)
+                if start is None or self.segments[start:end] != sources:
+                    # The index was rebuilt while merging
+                    return
+
+                # Carry over documents deleted while the merge was running
+                base = 0
+                for seg, snapshot in zip(sources, snapshots):
+                    live = ~snapshot
+                    renumber = np.cumsum(live) - 1 + base
+                    merged.deleted[renumber[seg.deleted & live]] = True
+                    base += int(np.count_nonzero(live))
+
+                self.segments[start:end] = [merged]
+                self.__changed()
+                self.save()
+
+    def merge(self, background: bool = False) -> None:
+        """
+        Merges segments according to the merge policy and saves the result.
+        With background, merging happens in a separate thread while the index
+        stays searchable; see wait_for_merge.
+        """
+
+        if not background:
+            self.__merge_pending()
+            return
+
+        with self.lock:
+            if self.merge_thread is not None and self.merge_thread.is_alive():
+                return
 
-        with open(self.docmap_file, "rb") as f:
-            self.docmap = pickle.load(f)
+            self.merge_thread = threading.Thread(target=self.__merge_pending)
+            self.merge_thread.start()
 
-        with open(self.term_freq_file, "rb") as f:
-            self.term_frequencies = pickle.load(f)
+    def wait_for_merge(self) -> None:
+        if self.merge_thread is not None:
+            self.merge_thread.join()
+
+    def save(self) -> None:
+        """
+        Writes segments and tombstones that changed since the last save to
+        the index directory in the cache, then atomically replaces the
+        manifest listing them. Files that the manifest this index was loaded
+        from or last saved as listed, and the new one does not, are removed.
+        Nothing else in the directory is touched, since other processes may
+        be writing there.
+        """
+
+        with self.lock:
+            os.makedirs(self.index_dir, exist_ok=True)
+
+            # Never reuse a generation or segment file name, even when this
+            # index was built rather than loaded from the manifest being
+            # replaced, or another process saved since it was loaded
+            if os.path.exists(self.index_file):
+                with open(self.index_file) as f:
+                    current = json.load(f)
+                self.generation = max(self.generation, current["generation"])
+                self.next_segment = max(self.next_segment, current["next_segment"])
+            self.generation += 1
+
+            for seg in self.segments:
+                if seg.name is None:
+                    path = self.__segment_path()
+                    while os.path.exists(path):
+                        self.next_segment += 1
+                        path = self.__segment_path()
+                    seg.save(path)
+                    self.next_segment += 1
+
+                if seg.deleted_file is None and seg.deleted.any():
+                    seg.save_deleted(os.path.join(
+                        self.index_dir,
+                        "%s_%d.del" % (seg.name[:-len(".bin")], self.generation),
+                    ))
+
+            manifest = {
+                "generation": self.generation,
+                "next_segment": self.next_segment,
+                "k1": self.k1,
+                "b": self.b,
+                "positions": self.positions,
+                "segments": [
+                    {"name": seg.name, "deleted": seg.deleted_file}
+                    for seg in self.segments
+                ],
+            }
+
+            # Named per process so concurrent saves never write to, or
+            # replace the manifest with, each other's file
+            tmp_path = f"{self.index_file}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(tmp_path, self.index_file)
+            self.manifest_stat = self.__stat_manifest()
+
+            if self.analyzed:
+                analyzer.save_stems(self.stems_file)
+
+            files = manifest_files(manifest)
+            for name in self.manifest_files - files:
+                path = os.path.join(self.index_dir, name)
+                if os.path.exists(path):
+                    os.remove(path)
+            self.manifest_files = files
+
+    def __segment_path(self) -> str:
+        return os.path.join(
+            self.index_dir,
+            "segment_%06d.bin" % self.next_segment,
+        )
+
+    def load(self) -> None:
+        """
+        Memory-maps the segments listed in the manifest. Nothing is read until
+        the index is searched, and documents are only decoded when they are
+        looked up.
+        """
+
+        if not os.path.exists(self.index_file):
+            raise RuntimeError(f"index does not exist: {self.index_file}")
+
+        # Taken before reading, so that a manifest replaced meanwhile is
+        # noticed by the next refresh
+        manifest_stat = self.__stat_manifest()
+        with open(self.index_file) as f:
+            manifest = json.load(f)
+
+        if manifest["k1"] != BM25_K1 or manifest["b"] != BM25_B:
+            raise RuntimeError(
+                "index was built with k1=%s, b=%s; rebuild it for k1=%s, b=%s" %
+                (manifest["k1"], manifest["b"], BM25_K1, BM25_B)
+            )
+
+        segments = []
+        for entry in manifest["segments"]:
+            seg = Segment.load(os.path.join(self.index_dir, entry["name"]))
+            if entry["deleted"] is not None:
+                seg.load_deleted(os.path.join(self.index_dir, entry["deleted"]))
+            segments.append(seg)
+
+        with self.lock:
+            self.segments[:] = segments
+            self.generation = manifest["generation"]
+            self.next_segment = manifest["next_segment"]
+            self.positions = manifest.get("positions", False)
+            self.manifest_stat = manifest_stat
+            self.manifest_files = manifest_files(manifest)
+            self.__changed()
+
+    def refresh(self) -> bool:
+        """
+        Reloads the index when its manifest was replaced since it was last
+        loaded or saved, and returns whether it did. Searches keep using the
+        previous segments until the new ones are swapped in.
+        """
 
-        with open(self.doc_lengths_file, "rb") as f:
-            self.doc_lengths = pickle.load(f)
+        manifest_stat = self.__stat_manifest()
+        if manifest_stat is None or manifest_stat == self.manifest_stat:
+            return False
+
+        with open(self.index_file) as f:
+            generation = json.load(f)["generation"]
+        if generation == self.generation:
+            self.manifest_stat = manifest_stat
+            return False
+
+        self.load()
+        return True
+
+    def __stat_manifest(self) -> tuple | None:
+        try:
+            st = os.stat(self.index_file)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def manifest_files(manifest: dict) -> set[str]:
+    """
+    Returns the names of the segment and tombstone files a manifest lists
+    """
+
+    files = set()
+    for entry in manifest["segments"]:
+        files.add(entry["name"])
+        if entry["deleted"] is not None:
+            files.add(entry["deleted"])
+    return files
+
+
+def query_terms(text: str, distinct: bool = True) -> tuple[list[str], list[int]]:
+    """
+    Returns the tokens of a query along with the position of each among the
+    words of the query, leaving out empty tokens and, when distinct, every
+    repeat of a token
+    """
+
+    terms, offsets = [], []
+    for token, offset in zip(*analyzer.analyze_positions(text)):
+        if token and not (distinct and token in terms):
+            terms.append(token)
+            offsets.append(offset)
+    return terms, offsets
+
+
+def query_phrases(query: str) -> list[tuple[list[str], list[int]]]:
+    """
+    Returns the query_terms of every part of a query in double quotes,
+    repeats included
+    """
+
+    return [
+        query_terms(phrase, distinct=False)
+        for phrase in re.findall(r'"([^"]*)"', query)
+    ]
@@ -0,0 +1,149 @@
+import json
+import math
+
+import numpy as np
+
+from .constants import IVF_MIN_ROWS, IVF_RETRAIN_GROWTH, IVF_TRAIN_PER_LIST
+from .embedding_index import kmeans, nearest, open_derived, sample_rows
+from .index_format import IndexFile, write_index_file
+from .query_utils import top_k
+
+
+class IVFIndex:
+    """
+    Inverted file index over unit-length vectors. Spherical k-means
+    centroids partition the rows into lists, and a search only scores the
+    rows of the nprobe lists whose centroids are closest to the query.
+    """
+
+    def __init__(
+        self,
+        centroids: np.ndarray,
+        assignments: np.ndarray,
+        trained_size: int,
+        source: list | None = None,
+    ):
+        # Unit-length centroid of each list, and the list of each row
+        self.centroids = centroids
+        self.assignments = assignments
+
+        # Number of rows the centroids were trained for
+        self.trained_size = trained_size
+
+        # Modification time and size of the file of the vectors the rows
+        # were assigned from, see file_source
+        self.source = source
+
+        # Rows of list i are list_rows[list_offsets[i]:list_offsets[i + 1]]
+        self.list_offsets = None
+        self.list_rows = None
+        self.__set_lists()
+
+    def __len__(self) -> int:
+        return len(self.assignments)
+
+    def __set_lists(self) -> None:
+        self.list_rows = np.argsort(self.assignments, kind="stable")
+        counts = np.bincount(self.assignments, minlength=len(self.centroids))
+        self.list_offsets = np.zeros(len(self.centroids) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.list_offsets[1:])
+
+    @classmethod
+    def train(cls, vectors: np.ndarray, seed: int = 0) -> "IVFIndex":
+        """
+        Clusters a sample of the vectors into about 4 * sqrt(rows) lists and
+        assigns every row to its closest centroid
+        """
+
+        rng = np.random.default_rng(seed)
+        nlist = max(1, min(len(vectors), round(4 * math.sqrt(len(vectors)))))
+        sample = sample_rows(vectors, nlist * IVF_TRAIN_PER_LIST, rng)
+        centroids = kmeans(sample, nlist, rng, spherical=True)
+        assignments = nearest(centroids, vectors, spherical=True)
+        return cls(centroids, assignments, len(vectors))
+
+    def update(self, vectors: np.ndarray, rows: np.ndarray) -> None:
+        """
+        Follows a change of the vectors without retraining: rows[i] is the
+        row vector i had when it was assigned, or -1 when it is new or
+        changed, in which case it is assigned to its closest centroid
+        """
+
+        assignments = self.assignments[np.maximum(rows, 0)]
+        stale = np.flatnonzero(rows < 0)
+        if len(stale) > 0:
+            assignments[stale] = nearest(
+                self.centroids,
+                vectors[stale],
+                spherical=True,
+            )
+
+        self.assignments = assignments
+        self.__set_lists()
+
+    def probe(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        """
+        Returns the rows of the nprobe lists closest to a unit-length query,
+        in ascending order
+        """
+
+        lists = top_k(self.centroids @ query, nprobe)
+        rows = [
+            self.list_rows[self.list_offsets[i]:self.list_offsets[i + 1]]
+            for i in lists.tolist()
+        ]
+        return np.sort(np.concatenate(rows))
+
+    @classmethod
+    def load(cls, path: str) -> "IVFIndex":
+        f = IndexFile(path)
+        meta = f.json("meta")
+        return cls(
+            f.array("centroids").reshape(-1, meta["dimensions"]),
+            f.array("assignments"),
+            meta["trained_size"],
+            meta["source"],
+        )
+
+    def save(self, path: str) -> None:
+        # Sections are flat, so the centroids are stored row after row
+        meta = json.dumps({
+            "dimensions": self.centroids.shape[1],
+            "trained_size": self.trained_size,
+            "source": self.source,
+        })
+        write_index_file(path, {
+            "meta": np.frombuffer(meta.encode("utf-8"), dtype=np.uint8),
+            "centroids": self.centroids.ravel(),
+            "assignments": self.assignments,
+        })
+
+
+def open_ivf(
+    path: str,
+    vectors: np.ndarray,
+    source: list,
+    rows: np.ndarray | None = None,
+    old_source: list | None = None,
+) -> IVFIndex | None:
+    """
+    Returns the IVF index of vectors read from a file with the given source,
+    or None when there are too few vectors to need one. The index saved at
+    path is kept up to date like any derived index, see open_derived, and
+    retrained when the vectors have another dimension.
+    """
+
+    if len(vectors) < IVF_MIN_ROWS:
+        return None
+
+    return open_derived(
+        path,
+        IVFIndex.load,
+        lambda ivf: ivf.centroids.shape[1] == vectors.shape[1],
+        lambda: IVFIndex.train(vectors),
+        IVF_RETRAIN_GROWTH,
+        vectors,
+        source,
+        rows,
+        old_source,
+    )
@@ -0,0 +1,60 @@
+import collections
+import time
+
+
+class LRUCache:
+    """
+    Dictionary bounded to maxsize entries that evicts the least recently used
+    entry when full, and counts lookup hits and misses. With a ttl, entries
+    also expire ttl seconds after they were put.
+    """
+
+    def __init__(self, maxsize: int, ttl: float | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        # Values and the monotonic time they expire at, or None
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key) -> bool:
+        entry = self.entries.get(key)
+        return entry is not None and not self.__expired(entry)
+
+    def __expired(self, entry: tuple) -> bool:
+        return entry[1] is not None and time.monotonic() >= entry[1]
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None or self.__expired(entry):
+            self.entries.pop(key, None)
+            self.misses += 1
+            return default
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value) -> None:
+        expires = None
+        if self.ttl is not None:
+            expires = time.monotonic() + self.ttl
+
+        self.entries[key] = (value, expires)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def items(self) -> list[tuple]:
+        """
+        Returns the entries from least to most recently used
+        """
+
+        return [(key, value) for key, (value, _) in self.entries.items()]
+
+    def clear(self) -> None:
+        self.entries.clear()
@@ -0,0 +1,81 @@
+import numpy as np
+
+
+def encode_positions(
+    positions: np.ndarray,
+    offsets: np.ndarray,
+) -> np.ndarray:
+    """
+    Delta-encodes the ascending token positions of every posting, where the
+    positions of posting i are positions[offsets[i]:offsets[i + 1]]. The first
+    position of each posting is kept as is and the others become the gap to
+    the previous one.
+    """
+
+    deltas = np.diff(positions, prepend=0)
+    starts = offsets[:-1][np.diff(offsets) > 0]
+    deltas[starts] = positions[starts]
+    return deltas.astype(np.uint32)
+
+
+def gather_ranges(offsets: np.ndarray, selected: np.ndarray) -> np.ndarray:
+    """
+    Returns the indexes of the elements of the selected ranges, in the order
+    the ranges are selected, where range i spans offsets[i]:offsets[i + 1]
+    """
+
+    lengths = np.diff(offsets)[selected]
+    starts = np.zeros(len(lengths), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    shift = np.repeat(offsets[:-1][selected] - starts, lengths)
+    return shift + np.arange(len(shift), dtype=np.int64)
+
+
+def phrase_frequency(positions: list[np.ndarray], offsets: list[int]) -> int:
+    """
+    Counts the places where every token of a phrase occurs at its offset in
+    the phrase relative to the first token, given the positions of each
+    phrase token in a document and the offset of each in the phrase
+    """
+
+    starts = positions[0]
+    for following, offset in zip(positions[1:], offsets[1:]):
+        shift = offset - offsets[0]
+        starts = starts[np.isin(starts + shift, following, assume_unique=True)]
+    return len(starts)
+
+
+def min_span(positions: list[np.ndarray]) -> int:
+    """
+    Returns the distance between the first and last token of the shortest
+    window containing at least one position of every list
+    """
+
+    merged = np.concatenate(positions)
+    tokens = np.repeat(np.arange(len(positions)), [len(p) for p in positions])
+    order = np.argsort(merged, kind="stable")
+    merged = merged[order].tolist()
+    tokens = tokens[order].tolist()
+
+    # Slide a window over the merged positions, shrinking it from the left
+    # whenever it still contains every token
+    counts = [0] * len(positions)
+    missing = len(positions)
+    best = None
+    left = 0
+    for right, token in enumerate(tokens):
+        if counts[token] == 0:
+            missing -= 1
+        counts[token] += 1
+
+        while missing == 0:
+            span = merged[right] - merged[left]
+            if best is None or span < best:
+                best = span
+
+            counts[tokens[left]] -= 1
+            if counts[tokens[left]] == 0:
+                missing += 1
+            left += 1
+
+    return best
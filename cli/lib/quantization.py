@@ -0,0 +1,298 @@
+import json
+import math
+
+import numpy as np
+
+from .constants import (
+    PQ_CENTROIDS,
+    PQ_SUBSPACES,
+    PQ_TRAIN_PER_CENTROID,
+    QUANTIZER_RETRAIN_GROWTH,
+)
+from .embedding_index import kmeans, nearest, open_derived, sample_rows
+from .index_format import IndexFile, write_index_file
+from .query_utils import top_k
+
+
+# Number of rows encoded or scored at a time, bounding the decoded block
+SCORE_BATCH = 8192
+
+
+class ScalarQuantizer:
+    """
+    Stores every dimension as one byte: value = low + code * step, with the
+    range of each dimension taken from the training vectors. A query scores
+    the codes directly, since the dot product with a decoded row is
+    codes @ (query * step) + query @ low.
+    """
+
+    mode = "int8"
+
+    def __init__(self, low: np.ndarray, step: np.ndarray):
+        self.low = low
+        self.step = step
+
+    @classmethod
+    def train(cls, vectors: np.ndarray) -> "ScalarQuantizer":
+        vectors = np.asarray(vectors)
+        low = vectors.min(axis=0)
+        step = (vectors.max(axis=0) - low) / 255
+        step[step == 0] = 1
+        return cls(low.astype(np.float32), step.astype(np.float32))
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        codes = np.rint((vectors - self.low) / self.step)
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    @property
+    def dimensions(self) -> int:
+        return len(self.low)
+
+    @property
+    def code_size(self) -> int:
+        return len(self.low)
+
+    def score(self, query: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        return codes @ (query * self.step) + query @ self.low
+
+    def meta(self) -> dict:
+        return {}
+
+    def sections(self) -> dict[str, np.ndarray]:
+        return {"low": self.low, "step": self.step}
+
+    @classmethod
+    def from_sections(cls, f: IndexFile, meta: dict) -> "ScalarQuantizer":
+        return cls(f.array("low"), f.array("step"))
+
+
+class ProductQuantizer:
+    """
+    Splits vectors into subspaces and stores each subvector as the number of
+    its closest centroid among those k-means found for that subspace. A
+    query scores the codes by asymmetric distance computation: its dot
+    product with every centroid of every subspace is computed once, and a
+    row's score is the sum of the entries its codes pick.
+    """
+
+    mode = "pq"
+
+    def __init__(self, codebooks: np.ndarray, dimensions: int):
+        # Centroids of each subspace, subspaces by centroids by width, over
+        # the vectors padded with zeros to a multiple of the subspaces
+        self.codebooks = codebooks
+        self.dimensions = dimensions
+
+    @classmethod
+    def train(cls, vectors: np.ndarray, seed: int = 0) -> "ProductQuantizer":
+        rng = np.random.default_rng(seed)
+        subspaces = min(PQ_SUBSPACES, vectors.shape[1])
+        centroids = min(PQ_CENTROIDS, len(vectors))
+
+        sample = sample_rows(vectors, centroids * PQ_TRAIN_PER_CENTROID, rng)
+        width = math.ceil(vectors.shape[1] / subspaces)
+        sample = pad(sample, subspaces * width).reshape(len(sample), subspaces, width)
+        codebooks = np.stack([
+            kmeans(sample[:, i], centroids, rng)
+            for i in range(subspaces)
+        ])
+        return cls(codebooks, vectors.shape[1])
+
+    @property
+    def code_size(self) -> int:
+        return len(self.codebooks)
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        subspaces, _, width = self.codebooks.shape
+        subvectors = pad(vectors, subspaces * width).reshape(len(vectors), subspaces, width)
+        codes = np.empty((len(vectors), subspaces), dtype=np.uint8)
+        for i in range(subspaces):
+            codes[:, i] = nearest(self.codebooks[i], subvectors[:, i])
+        return codes
+
+    def score(self, query: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        subspaces, _, width = self.codebooks.shape
+        query = pad(query[None], subspaces * width).reshape(subspaces, width)
+        table = np.einsum("ikw,iw->ik", self.codebooks, query)
+
+        # One lookup per subspace gathers from a table row that stays in
+        # cache, which is faster than a single gather over the whole table
+        scores = np.zeros(len(codes), dtype=np.float32)
+        for i in range(subspaces):
+            scores += table[i].take(codes[:, i])
+        return scores
+
+    def meta(self) -> dict:
+        return {"dimensions": self.dimensions, "codebooks": self.codebooks.shape}
+
+    def sections(self) -> dict[str, np.ndarray]:
+        return {"codebooks": self.codebooks.ravel()}
+
+    @classmethod
+    def from_sections(cls, f: IndexFile, meta: dict) -> "ProductQuantizer":
+        codebooks = f.array("codebooks").reshape(meta["codebooks"])
+        return cls(codebooks, meta["dimensions"])
+
+
+QUANTIZERS = {
+    ScalarQuantizer.mode: ScalarQuantizer,
+    ProductQuantizer.mode: ProductQuantizer,
+}
+
+
+class QuantizedEmbeddings:
+    """
+    Compressed codes of a matrix of unit-length embeddings, one row each,
+    scored against queries without decoding them
+    """
+
+    def __init__(
+        self,
+        quantizer: ScalarQuantizer | ProductQuantizer,
+        codes: np.ndarray,
+        trained_size: int,
+        source: list | None = None,
+    ):
+        self.quantizer = quantizer
+        self.codes = codes
+
+        # Number of rows the quantizer was trained on
+        self.trained_size = trained_size
+
+        # Modification time and size of the file of the embeddings the codes
+        # were encoded from, see file_source
+        self.source = source
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    @classmethod
+    def train(cls, mode: str, vectors: np.ndarray) -> "QuantizedEmbeddings":
+        quantizer = QUANTIZERS[mode].train(vectors)
+        return cls(quantizer, encode(quantizer, vectors), len(vectors))
+
+    def update(self, vectors: np.ndarray, rows: np.ndarray) -> None:
+        """
+        Follows a change of the embeddings without retraining: rows[i] is
+        the row embedding i had when it was encoded, or -1 when it is new or
+        changed, in which case it is encoded again
+        """
+
+        codes = self.codes[np.maximum(rows, 0)]
+        stale = np.flatnonzero(rows < 0)
+        if len(stale) > 0:
+            codes[stale] = encode(self.quantizer, vectors[stale])
+        self.codes = codes
+
+    def scores(self, query: np.ndarray, rows: np.ndarray | None = None) -> np.ndarray:
+        """
+        Returns the approximate dot product of a query with every row, or
+        with the given rows
+        """
+
+        count = len(self.codes) if rows is None else len(rows)
+        scores = np.empty(count, dtype=np.float32)
+        for start in range(0, count, SCORE_BATCH):
+            end = start + SCORE_BATCH
+            codes = self.codes[start:end] if rows is None else self.codes[rows[start:end]]
+            scores[start:end] = self.quantizer.score(query, codes)
+        return scores
+
+    @classmethod
+    def load(cls, path: str) -> "QuantizedEmbeddings":
+        f = IndexFile(path)
+        meta = f.json("meta")
+        return cls(
+            QUANTIZERS[meta["mode"]].from_sections(f, meta),
+            f.array("codes").reshape(-1, meta["code_size"]),
+            meta["trained_size"],
+            meta["source"],
+        )
+
+    def save(self, path: str) -> None:
+        # Sections are flat, so the codes and codebooks are stored row after
+        # row with their shapes in the meta section
+        meta = json.dumps({
+            **self.quantizer.meta(),
+            "mode": self.quantizer.mode,
+            "code_size": self.quantizer.code_size,
+            "trained_size": self.trained_size,
+            "source": self.source,
+        })
+        write_index_file(path, {
+            "meta": np.frombuffer(meta.encode("utf-8"), dtype=np.uint8),
+            **self.quantizer.sections(),
+            "codes": self.codes.ravel(),
+        })
+
+
+def pad(vectors: np.ndarray, width: int) -> np.ndarray:
+    """
+    Appends zero columns up to width, which leave dot products unchanged
+    """
+
+    if vectors.shape[1] == width:
+        return vectors
+    return np.pad(vectors, ((0, 0), (0, width - vectors.shape[1])))
+
+
+def encode(quantizer: ScalarQuantizer | ProductQuantizer, vectors: np.ndarray) -> np.ndarray:
+    codes = np.empty((len(vectors), quantizer.code_size), dtype=np.uint8)
+    for start in range(0, len(vectors), SCORE_BATCH):
+        end = start + SCORE_BATCH
+        codes[start:end] = quantizer.encode(vectors[start:end])
+    return codes
+
+
+def open_quantized(
+    path: str,
+    mode: str | None,
+    vectors: np.ndarray,
+    source: list,
+    rows: np.ndarray | None = None,
+    old_source: list | None = None,
+) -> QuantizedEmbeddings | None:
+    """
+    Returns the codes of vectors read from a file with the given source, or
+    None when mode is None. The codes saved at path are kept up to date like
+    any derived index, see open_derived, and retrained when the quantizer
+    has another mode or dimension.
+    """
+
+    if mode is None or len(vectors) == 0:
+        return None
+
+    return open_derived(
+        path,
+        QuantizedEmbeddings.load,
+        lambda quantized: (
+            quantized.quantizer.mode == mode and
+            quantized.quantizer.dimensions == vectors.shape[1]
+        ),
+        lambda: QuantizedEmbeddings.train(mode, vectors),
+        QUANTIZER_RETRAIN_GROWTH,
+        vectors,
+        source,
+        rows,
+        old_source,
+    )
+
+
+def rescore(
+    vectors: np.ndarray,
+    query: np.ndarray,
+    rows: np.ndarray,
+    scores: np.ndarray,
+    count: int | None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Keeps the count rows with the highest approximate scores, in ascending
+    order, and scores them exactly against the stored vectors. With
+    count None, returns the approximate scores unchanged.
+    """
+
+    if count is None:
+        return rows, scores
+
+    kept = np.sort(rows[top_k(scores, count)])
+    return kept, vectors[kept] @ query
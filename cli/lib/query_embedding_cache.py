@@ -0,0 +1,141 @@
+import os
+import sqlite3
+import time
+import unicodedata
+
+import numpy as np
+
+from .constants import QUERY_EMBEDDING_CACHE_SIZE, QUERY_EMBEDDING_DISK_SIZE
+from .lru_cache import LRUCache
+from .search_utils import CACHE_PATH
+
+
+class QueryEmbeddingCache:
+    """
+    Two-tier cache of query embeddings keyed on the normalized query text
+    and the model name: an in-process LRU in front of a SQLite table under
+    the cache directory, which every process shares and which outlives
+    them. The table keeps the disk_size most recently used embeddings.
+    Hits and misses of both tiers are counted.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        path: str | None = None,
+        memory_size: int = QUERY_EMBEDDING_CACHE_SIZE,
+        disk_size: int = QUERY_EMBEDDING_DISK_SIZE,
+    ):
+        self.model_name = model_name
+        self.path = path or os.path.join(CACHE_PATH, "query_embeddings.sqlite")
+        self.memory = LRUCache(memory_size)
+        self.disk_size = disk_size
+
+        # Connection to the table, opened on first use
+        self.db = None
+        self.disk_hits = 0
+        self.disk_misses = 0
+
+    def __connect(self) -> sqlite3.Connection:
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.db = sqlite3.connect(self.path, timeout=10)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings ("
+                "model TEXT NOT NULL, "
+                "query TEXT NOT NULL, "
+                "embedding BLOB NOT NULL, "
+                "used INTEGER NOT NULL, "
+                "PRIMARY KEY (model, query))"
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS query_embeddings_used "
+                "ON query_embeddings (used)"
+            )
+        return self.db
+
+    def get(self, query: str) -> np.ndarray | None:
+        """
+        Returns the cached embedding of a normalized query, or None
+        """
+
+        embedding = self.memory.get(query)
+        if embedding is not None:
+            return embedding
+
+        db = self.__connect()
+        with db:
+            row = db.execute(
+                "SELECT embedding FROM query_embeddings WHERE model = ? AND query = ?",
+                (self.model_name, query),
+            ).fetchone()
+            if row is None:
+                self.disk_misses += 1
+                return None
+
+            db.execute(
+                "UPDATE query_embeddings SET used = ? WHERE model = ? AND query = ?",
+                (time.time_ns(), self.model_name, query),
+            )
+
+        self.disk_hits += 1
+        embedding = np.frombuffer(row[0], dtype=np.float32)
+        self.memory.put(query, embedding)
+        return embedding
+
+    def put(self, query: str, embedding: np.ndarray) -> None:
+        """
+        Caches the embedding of a normalized query, evicting the least
+        recently used embeddings beyond disk_size from the table
+        """
+
+        embedding = np.asarray(embedding, dtype=np.float32).copy()
+        embedding.flags.writeable = False
+        self.memory.put(query, embedding)
+
+        db = self.__connect()
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?, ?)",
+                (self.model_name, query, embedding.tobytes(), time.time_ns()),
+            )
+
+            count = db.execute("SELECT COUNT(*) FROM query_embeddings").fetchone()[0]
+            if count > self.disk_size:
+                db.execute(
+                    "DELETE FROM query_embeddings WHERE rowid IN ("
+                    "SELECT rowid FROM query_embeddings ORDER BY used LIMIT ?)",
+                    (count - self.disk_size,),
+                )
+
+    def clear(self) -> None:
+        self.memory.clear()
+        db = self.__connect()
+        with db:
+            db.execute("DELETE FROM query_embeddings")
+
+    def stats(self) -> dict:
+        lookups = self.memory.hits + self.memory.misses
+        hits = self.memory.hits + self.disk_hits
+        disk_entries = self.__connect().execute(
+            "SELECT COUNT(*) FROM query_embeddings",
+        ).fetchone()[0]
+        return {
+            "memory_entries": len(self.memory),
+            "disk_entries": disk_entries,
+            "memory_hits": self.memory.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.disk_misses,
+            "hit_rate": hits / lookups if lookups > 0 else 0.0,
+        }
+
+
+def normalize_query(text: str) -> str:
+    """
+    Returns the query text with Unicode composed and whitespace collapsed,
+    which the model tokenizes the same way as the original
+    """
+
+    return " ".join(unicodedata.normalize("NFC", text).split())
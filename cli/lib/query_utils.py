@@ -1,71 +1,147 @@
-import re
+import functools
+import os
+import pickle
 import string
+import sys
 
 import numpy as np
 
-from nltk.stem import PorterStemmer
-
+from .lru_cache import LRUCache
 from .search_utils import load_stopwords
 
 
-punctuation_table = str.maketrans("", "", string.punctuation + "\u2019")
-whitespace_table = str.maketrans(
-    string.whitespace,
-    " " * len(string.whitespace),
-)
-stop_words = load_stopwords()
-stemmer = PorterStemmer()
+stop_words = frozenset(load_stopwords())
 
+# Maximum number of surface forms the analyzer remembers the stem of
+STEM_CACHE_SIZE = 200_000
 
-def cosine_similarity(vec1: list[float], vec2: list[float]) -> float:
-    dot_product = np.dot(vec1, vec2)
-    norm1 = np.linalg.norm(vec1)
-    norm2 = np.linalg.norm(vec2)
 
-    if norm1 == 0 or norm2 == 0:
-        return 0.0
+@functools.cache
+def get_stemmer():
+    """
+    Returns the Porter stemmer, importing NLTK on first use only, since
+    analyzers with a warm stem cache may never need it
+    """
 
-    return dot_product / (norm1 * norm2)
+    from nltk.stem import PorterStemmer
 
+    return PorterStemmer()
 
-def lower(s: str) -> str:
-    return s.lower()
 
+def normalize_rows(vectors) -> np.ndarray:
+    """
+    Scales every row to unit L2 norm in a contiguous float32 array, so that
+    dot products between rows are cosine similarities. Zero rows stay zero.
+    """
 
-def whitespace(s: str) -> str:
-    return re.sub(r"  +", " ", s.translate(whitespace_table))
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return np.ascontiguousarray(vectors / norms)
 
 
-def depunct(s: str) -> str:
-    return s.translate(punctuation_table)
+def top_k(scores: np.ndarray, limit: int) -> np.ndarray:
+    """
+    Returns the indexes of the limit highest scores, highest first and ties
+    in index order
+    """
 
+    candidates = np.arange(len(scores))
+    if len(scores) > limit > 0:
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        candidates = np.flatnonzero(scores >= scores[top].min())
 
-def tokenize(s: str) -> list[str]:
-    return s.split(" ")
+    ordered = candidates[np.lexsort((candidates, -scores[candidates]))]
+    return ordered[:limit]
 
 
-def unstop(tokens: list[str]) -> list[str]:
-    cleaned = []
-    for token in tokens:
-        if token in stop_words:
-            continue
-        cleaned.append(token)
-    return cleaned
+class Analyzer:
+    """
+    Turns text into index tokens: lowercases, strips punctuation, splits on
+    whitespace, drops stop words and stems, in a single translate and split,
+    with the stem of every surface form cached.
+    """
 
+    # Bump whenever the tokens produced for a text change, so anything built
+    # from older tokens can be detected as stale
+    VERSION = 1
 
-def stem(tokens: list[str]) -> list[str]:
-    for i in range(len(tokens)):
-        tokens[i] = stemmer.stem(tokens[i])
-    return tokens
+    def __init__(
+        self,
+        stop_words: frozenset[str] = stop_words,
+        cache_size: int = STEM_CACHE_SIZE,
+    ):
+        self.stop_words = stop_words
+        self.table = str.maketrans(
+            string.whitespace,
+            " " * len(string.whitespace),
+            string.punctuation + "\u2019",
+        )
+        self.stems = LRUCache(cache_size)
 
+    def analyze(self, s: str) -> list[str]:
+        return self.analyze_positions(s)[0]
 
-def clean(s: str) -> list[str]:
-    return stem(unstop(tokenize(whitespace(depunct(lower(s))))))
+    def analyze_positions(self, s: str) -> tuple[list[str], list[int]]:
+        """
+        Returns the tokens of a text along with the position of each among
+        the words of the text, counting the stop words that were dropped
+        """
+
+        parts = s.lower().translate(self.table).split(" ")
+
+        # Runs of spaces collapse into one, which only leaves empty tokens at
+        # the very start and end
+        if len(parts) > 2:
+            parts = [parts[0], *filter(None, parts[1:-1]), parts[-1]]
+
+        stems = self.stems
+        tokens = []
+        positions = []
+        for position, part in enumerate(parts):
+            if part in self.stop_words:
+                continue
+
+            token = stems.get(part)
+            if token is None:
+                token = sys.intern(get_stemmer().stem(part))
+                stems.put(part, token)
+            tokens.append(token)
+            positions.append(position)
+
+        return tokens, positions
+
+    def load_stems(self, path: str) -> None:
+        """
+        Warms the stem cache with surface forms saved by save_stems
+        """
+
+        if not os.path.exists(path):
+            return
 
+        with open(path, "rb") as f:
+            saved = pickle.load(f)
+
+        if saved["version"] != self.VERSION:
+            return
+
+        for part, token in saved["stems"]:
+            self.stems.put(part, sys.intern(token))
+
+    def save_stems(self, path: str) -> None:
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump({
+                "version": self.VERSION,
+                "stems": self.stems.items(),
+            }, f)
+
+        os.replace(tmp_path, path)
+
+
+analyzer = Analyzer()
+
+
+def clean(s: str) -> list[str]:
+    return analyzer.analyze(s)
 
-def match(query: list[str], against: list[str]) -> bool:
-    for a in against:
-        for q in query:
-            if q in a:
-                return True
-    return False
@@ -0,0 +1,259 @@
+import os
+import time
+
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+from .document_store import DocumentStore, open_documents
+from .search_utils import CACHE_PATH
+
+
+SOCKET_PATH = os.path.join(CACHE_PATH, "search_daemon.sock")
+KEY_PATH = os.path.join(CACHE_PATH, "search_daemon.key")
+
+# Methods clients may call on each engine the daemon keeps loaded. The
+# semantic and chunked engines share one model.
+ENGINE_METHODS = {
+    "index": {
+        "bm25_search",
+        "bm25_search_batch",
+        "boolean_search",
+        "get_bm25_idf",
+        "get_bm25_tf",
+        "get_idf",
+        "get_tf",
+        "proximity_search",
+    },
+    "semantic": {"search", "search_batch"},
+    "chunked": {"search_chunks", "search_chunks_batch"},
+    "hybrid": {"rrf_search", "rrf_search_batch", "weighted_search"},
+}
+
+
+def load_engine(name: str):
+    """
+    Loads an engine in this process. The semantic engines are imported here
+    so that keyword searches never load the embedding model's libraries.
+    """
+
+    match name:
+        case "index":
+            from .inverted_index import InvertedIndex
+
+            index = InvertedIndex()
+            index.load()
+            return index
+        case "semantic":
+            from .semantic_search import SemanticSearch
+
+            search = SemanticSearch()
+            search.load_or_create_embeddings(open_documents())
+            return search
+        case "chunked":
+            from .chunked_semantic_search import ChunkedSemanticSearch
+
+            search = ChunkedSemanticSearch()
+            search.load_or_create_chunk_embeddings(open_documents())
+            return search
+        case "hybrid":
+            from .hybrid_search import HybridSearch
+
+            return HybridSearch(open_documents())
+
+    raise RuntimeError(f"unknown search engine: {name}")
+
+
+def open_engine(name: str):
+    """
+    Returns the engine held by the search daemon when it is running, or
+    loads it in this process otherwise
+    """
+
+    if name not in ENGINE_METHODS:
+        raise RuntimeError(f"unknown search engine: {name}")
+
+    try:
+        request("daemon", "status")
+    except DaemonUnavailable:
+        return load_engine(name)
+    return RemoteEngine(name)
+
+
+class DaemonUnavailable(RuntimeError):
+    pass
+
+
+def request(engine: str, method: str, *args, **kwargs):
+    """
+    Calls a method of an engine in the search daemon and returns its result
+    """
+
+    try:
+        with open(KEY_PATH, "rb") as f:
+            key = f.read()
+        conn = Client(SOCKET_PATH, "AF_UNIX", authkey=key)
+    except (OSError, EOFError, AuthenticationError) as e:
+        raise DaemonUnavailable(f"search daemon is not running: {e}")
+
+    with conn:
+        conn.send((engine, method, args, kwargs))
+        try:
+            status, result = conn.recv()
+        except (OSError, EOFError) as e:
+            raise DaemonUnavailable(f"search daemon went away: {e}")
+
+    if status == "error":
+        raise RuntimeError(result)
+    return result
+
+
+class RemoteEngine:
+    """
+    Stands in for an engine loaded in the search daemon, forwarding calls to
+    its search methods
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __getattr__(self, method: str):
+        if method not in ENGINE_METHODS[self.name]:
+            raise AttributeError(f"{self.name} engine has no method {method}")
+
+        def call(*args, **kwargs):
+            return request(self.name, method, *args, **kwargs)
+        return call
+
+
+class SearchDaemon:
+    """
+    Serves search requests over a Unix socket from engines that stay loaded
+    between requests. Requests are handled one at a time, and the keyword
+    index is reloaded whenever its manifest is replaced.
+    """
+
+    def __init__(self):
+        self.documents = None
+        self.engines = {}
+        self.running = False
+        self.started = time.time()
+
+    def __get_documents(self) -> DocumentStore:
+        if self.documents is None:
+            self.documents = open_documents()
+        return self.documents
+
+    def get_engine(self, name: str):
+        if name in self.engines:
+            engine = self.engines[name]
+            if name == "index":
+                engine.refresh()
+            return engine
+
+        match name:
+            case "semantic" | "chunked":
+                from .chunked_semantic_search import ChunkedSemanticSearch
+
+                search = self.engines.get("semantic") or self.engines.get("chunked")
+                if search is None:
+                    search = ChunkedSemanticSearch()
+                if name == "semantic":
+                    search.load_or_create_embeddings(self.__get_documents())
+                else:
+                    search.load_or_create_chunk_embeddings(self.__get_documents())
+                engine = search
+            case "hybrid":
+                from .hybrid_search import HybridSearch
+
+                engine = HybridSearch(
+                    self.__get_documents(),
+                    self.get_engine("chunked"),
+                )
+            case _:
+                engine = load_engine(name)
+
+        self.engines[name] = engine
+        return engine
+
+    def status(self) -> dict:
+        status = {
+            "pid": os.getpid(),
+            "uptime": time.time() - self.started,
+            "engines": sorted(self.engines),
+        }
+
+        search = self.engines.get("semantic") or self.engines.get("chunked")
+        if search is not None:
+            status["query_cache"] = search.query_cache.stats()
+        return status
+
+    def handle(self, engine: str, method: str, args: tuple, kwargs: dict):
+        if engine == "daemon":
+            match method:
+                case "status":
+                    return self.status()
+                case "stop":
+                    self.running = False
+                    return self.status()
+
+        if method not in ENGINE_METHODS.get(engine, ()):
+            raise RuntimeError(f"unknown search method: {engine}.{method}")
+
+        return getattr(self.get_engine(engine), method)(*args, **kwargs)
+
+    def serve(self, warm: list[str]) -> None:
+        """
+        Loads the warm engines, then serves requests until stopped
+        """
+
+        try:
+            status = request("daemon", "status")
+        except DaemonUnavailable:
+            status = None
+        if status is not None:
+            raise RuntimeError(f"search daemon is already running: {status['pid']}")
+
+        for name in warm:
+            self.get_engine(name)
+
+        # Stale socket left by a daemon that did not shut down cleanly
+        if os.path.exists(SOCKET_PATH):
+            os.remove(SOCKET_PATH)
+
+        # Only clients that can read the key may connect
+        key = os.urandom(32)
+        os.makedirs(CACHE_PATH, exist_ok=True)
+        fd = os.open(KEY_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(key)
+
+        self.running = True
+        try:
+            with Listener(SOCKET_PATH, "AF_UNIX", authkey=key) as listener:
+                while self.running:
+                    try:
+                        conn = listener.accept()
+                    except (OSError, EOFError, AuthenticationError):
+                        continue
+
+                    with conn:
+                        try:
+                            engine, method, args, kwargs = conn.recv()
+                            response = ("ok", self.handle(engine, method, args, kwargs))
+                        except (OSError, EOFError):
+                            continue
+                        except Exception as e:
+                            # Failed searches are reported to the client
+                            # rather than stopping the daemon
+                            response = ("error", str(e))
+
+                        try:
+                            conn.send(response)
+                        except OSError:
+                            pass
+        finally:
+            # Neither the socket nor the key is any use once this daemon
+            # stops
+            for path in (SOCKET_PATH, KEY_PATH):
+                if os.path.exists(path):
+                    os.remove(path)
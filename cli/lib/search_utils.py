@@ -1,16 +1,128 @@
 import json
 import os
+from collections.abc import Iterator
 
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
 DATA_PATH = os.path.join(PROJECT_ROOT, "data", "movies.json")
 STOPWORD_PATH = os.path.join(PROJECT_ROOT, "data", "stopwords.txt")
 CACHE_PATH = os.path.join(PROJECT_ROOT, "cache")
 
+# Number of characters read from a JSON file at a time when streaming it
+READ_CHUNK_SIZE = 1 << 16
+NUMBER_CHARS = "0123456789+-.eE"
+
 
 def load_movies() -> list[dict]:
-    with open(DATA_PATH, "r") as f:
-        data = json.load(f)
-    return data["movies"]
+    return list(iter_movies())
+
+
+def iter_movies(path: str = DATA_PATH) -> Iterator[dict]:
+    """
+    Yields the movies in a file one at a time without reading the whole file
+    into memory. JSON Lines files (.jsonl) have a movie per line; JSON files
+    hold an array of movies, either on their own or as the "movies" key of an
+    object.
+    """
+
+    with open(path) as f:
+        if path.endswith(".jsonl"):
+            for line in f:
+                if line.strip() != "":
+                    yield json.loads(line)
+        else:
+            yield from JSONArrayReader(f, "movies")
+
+
+class JSONArrayReader:
+    """
+    Iterates over the elements of a JSON array read in chunks from a file,
+    decoding one element at a time. The array is either the whole document
+    or the value of the given key of the top-level object; other keys of the
+    object are decoded and skipped.
+    """
+
+    def __init__(self, f, key: str):
+        self.f = f
+        self.key = key
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def __iter__(self) -> Iterator:
+        if self.peek() == "{":
+            self.expect("{")
+            while True:
+                key = self.decode()
+                self.expect(":")
+                if key == self.key:
+                    break
+
+                self.decode()
+                if self.peek() != ",":
+                    raise RuntimeError(f"JSON object has no '{self.key}' array")
+                self.expect(",")
+
+        self.expect("[")
+        if self.peek() == "]":
+            return
+
+        while True:
+            yield self.decode()
+            if self.peek() == "]":
+                return
+            self.expect(",")
+
+    def __fill(self) -> None:
+        chunk = self.f.read(READ_CHUNK_SIZE)
+        if chunk == "":
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def peek(self) -> str | None:
+        """
+        Skips whitespace and returns the next character, or None at the end
+        of the file
+        """
+
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                return None
+            self.__fill()
+
+    def expect(self, char: str) -> None:
+        found = self.peek()
+        if found != char:
+            raise RuntimeError(f"expected '{char}' in JSON but found {found!r}")
+        self.pos += 1
+
+    def decode(self):
+        """
+        Decodes the next JSON value, reading more of the file until it is
+        complete. Numbers split across chunks would decode as a shorter
+        number, so a value must be followed by something other than a
+        character of a number before the end of the buffer.
+        """
+
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                if self.eof or (
+                    end < len(self.buffer) and
+                    self.buffer[end] not in NUMBER_CHARS
+                ):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.__fill()
 
 
 def load_stopwords() -> list[str]:
@@ -0,0 +1,768 @@
+import collections
+import json
+import os.path
+
+import numpy as np
+
+from .constants import BM25_B, BM25_K1
+from .index_format import (
+    BitPackedArray,
+    DocumentMap,
+    IndexFile,
+    Vocabulary,
+    encode_strings,
+    write_index_file,
+)
+from .positions import encode_positions, gather_ranges
+from .query_utils import analyzer, clean
+from .wand import BLOCK_SIZE, block_max_scores, posting_blocks
+
+
+# Bump whenever what token positions count changes, so that positions saved
+# by older versions are never matched against new ones
+POSITIONS_VERSION = 1
+
+
+def bm25_impacts(
+    tfs: np.ndarray,
+    doc_lengths: np.ndarray,
+    idf: np.ndarray | float,
+    avg_doc_length: float,
+    k1: float,
+    b: float,
+) -> np.ndarray:
+    """
+    Calculates the BM25 score of postings from their term frequencies and the
+    lengths of the documents they are in
+    """
+
+    tf = tfs.astype(np.float64)
+    length_norm = 1 - b + b * (doc_lengths / avg_doc_length)
+    return idf * (tf * (k1 + 1)) / (tf + k1 * length_norm)
+
+
+def bm25_idf(total: int, docs: np.ndarray | int) -> np.ndarray | float:
+    return np.log((total - docs + 0.5) / (docs + 0.5) + 1)
+
+
+def upper_bound(scores: np.ndarray) -> np.ndarray:
+    """
+    Rounds scores to float32 without ever rounding down, so they stay valid
+    upper bounds
+    """
+
+    bounds = scores.astype(np.float32)
+    below = bounds < scores
+    bounds[below] = np.nextafter(bounds[below], np.float32(np.inf))
+    return bounds
+
+
+class PostingList:
+    """
+    The decoded postings of a single term in a segment: ascending document
+    numbers and the term frequency in each document
+    """
+
+    def __init__(self, term: int | None, docs: np.ndarray, tfs: np.ndarray):
+        self.term = term
+        self.docs = docs
+        self.tfs = tfs
+        self.__position_offsets = None
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    def position_range(self, i: int) -> tuple[int, int]:
+        """
+        Returns where the positions of the i-th posting start and end,
+        relative to the first position of the term
+        """
+
+        if self.__position_offsets is None:
+            self.__position_offsets = np.zeros(len(self.tfs) + 1, dtype=np.int64)
+            np.cumsum(self.tfs, out=self.__position_offsets[1:])
+
+        offsets = self.__position_offsets
+        return int(offsets[i]), int(offsets[i + 1])
+
+    def find(self, doc_number: int) -> int | None:
+        """
+        Returns the index of the posting for the document number, or None
+        when the term is not in that document
+        """
+
+        i = int(np.searchsorted(self.docs, doc_number))
+        if i < len(self.docs) and self.docs[i] == doc_number:
+            return i
+        return None
+
+
+class Segment:
+    """
+    An immutable batch of indexed documents with its own vocabulary, columnar
+    postings and documents. Document numbers are local to the segment.
+
+    Only the tombstones in self.deleted change once a segment is built: a
+    deleted document keeps its postings until the segment is merged away.
+    """
+
+    def __init__(self):
+
+        # File name of the segment inside the index directory, or None when
+        # it has not been saved yet
+        self.name = None
+
+        # Sorted table of tokens; a token's position is its term number, which
+        # indexes self.offsets
+        self.vocab = Vocabulary.from_terms([])
+
+        # Postings in CSR layout: the postings of term number t are postings
+        # self.offsets[t] up to self.offsets[t + 1], sorted by document number,
+        # and are packed in the same blocks of BLOCK_SIZE postings as
+        # self.block_max, whose last document numbers in self.block_last
+        # double as skip data. Each block of postings is bit-packed as the
+        # gaps between consecutive document numbers of the term (minus one)
+        # followed by the term frequencies (minus one), so the postings of
+        # term t are values 2 * self.offsets[t] up to 2 * self.offsets[t + 1].
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.postings = BitPackedArray.encode([], [0])
+
+        # Optional delta-encoded token positions (see encode_positions) of
+        # every posting, one per occurrence of the term, bit-packed in blocks
+        # of BLOCK_SIZE positions. Positions count the dropped stop words, so
+        # phrases only match with the same words in between. The positions
+        # of term number t start at self.pos_offsets[t]. None when the
+        # segment was built without positions, or by a version that counted
+        # them differently.
+        self.pos_offsets = None
+        self.positions = None
+
+        # Upper bounds used to prune top-k searches: the highest impact of
+        # each term, and the highest impact and last document number of each
+        # block of postings. The blocks of term number t live in
+        # self.block_max[self.block_offsets[t]:self.block_offsets[t + 1]]
+        self.term_max = np.zeros(0, dtype=np.float32)
+        self.block_offsets = np.zeros(1, dtype=np.int64)
+        self.block_max = np.zeros(0, dtype=np.float32)
+        self.block_last = np.zeros(0, dtype=np.int32)
+
+        # Document numbers are dense positions into self.doc_ids and
+        # self.doc_lengths, assigned in the order documents were added
+        self.doc_ids = np.zeros(0, dtype=np.int32)
+        self.doc_lengths = np.zeros(0, dtype=np.int32)
+
+        # Mapping of document IDs to their full document objects, which also
+        # resolves document IDs to document numbers
+        self.docmap = DocumentMap(
+            *encode_strings([]),
+            self.doc_ids,
+            self.doc_ids,
+            self.doc_ids,
+        )
+
+        # BM25 parameters the score bounds were computed with, along with the
+        # IDF and average document length of this segment alone. The bounds
+        # are only exact while the segment is the whole index.
+        self.k1 = BM25_K1
+        self.b = BM25_B
+
+        # Tombstones of deleted documents by document number, and the file
+        # they were last saved to
+        self.deleted = np.zeros(0, dtype=bool)
+        self.deleted_file = None
+
+        # Length normalization of every document, cached for the average
+        # document length it was last requested with
+        self.__norms = (None, None)
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    @classmethod
+    def build(cls, movies: list[dict], positions: bool = True) -> "Segment":
+        """
+        Indexes the concatenated title and description of each movie, with
+        the positions of every token unless positions is False
+        """
+
+        documents = []
+        token_positions = [] if positions else None
+        for m in movies:
+            text = f"{m['title']} {m['description']}"
+            if positions:
+                tokens, found = analyzer.analyze_positions(text)
+                token_positions.append(found)
+            else:
+                tokens = clean(text)
+            documents.append(tokens)
+
+        segment = cls()
+        postings = segment.__build_postings(documents, token_positions)
+        segment.__set_documents(
+            np.array([m["id"] for m in movies], dtype=np.int32),
+            *encode_strings([json.dumps(m) for m in movies]),
+        )
+        segment.__set_postings(*postings)
+        return segment
+
+    @classmethod
+    def load(cls, path: str) -> "Segment":
+        """
+        Memory-maps a segment file. Nothing is read until it is searched, and
+        documents are only decoded when they are looked up.
+        """
+
+        f = IndexFile(path)
+
+        segment = cls()
+        segment.name = os.path.basename(path)
+
+        meta = f.json("meta")
+        segment.k1 = meta["k1"]
+        segment.b = meta["b"]
+
+        segment.vocab = Vocabulary(f.array("vocab_offsets"), f.array("vocab"))
+        segment.offsets = f.array("offsets")
+        segment.postings = f.packed("postings")
+        if "pos_offsets" in f and meta.get("positions") == POSITIONS_VERSION:
+            segment.pos_offsets = f.array("pos_offsets")
+            segment.positions = f.packed("positions")
+        segment.term_max = f.array("term_max")
+        segment.block_offsets = f.array("block_offsets")
+        segment.block_max = f.array("block_max")
+        segment.block_last = f.array("block_last")
+        segment.doc_ids = f.array("doc_ids")
+        segment.doc_lengths = f.array("doc_lengths")
+        segment.docmap = DocumentMap(
+            f.array("doc_offsets"),
+            f.array("docs"),
+            segment.doc_ids,
+            f.array("sorted_ids"),
+            f.array("sorted_numbers"),
+        )
+        segment.deleted = np.zeros(len(segment.doc_ids), dtype=bool)
+
+        return segment
+
+    def save(self, path: str) -> None:
+        meta = json.dumps({
+            "k1": self.k1,
+            "b": self.b,
+            "positions": POSITIONS_VERSION,
+        })
+
+        sections = {
+            "meta": np.frombuffer(meta.encode("utf-8"), dtype=np.uint8),
+            "vocab_offsets": self.vocab.offsets,
+            "vocab": self.vocab.data,
+            "offsets": self.offsets,
+            **self.postings.sections("postings"),
+            "term_max": self.term_max,
+            "block_offsets": self.block_offsets,
+            "block_max": self.block_max,
+            "block_last": self.block_last,
+            "doc_ids": self.doc_ids,
+            "doc_lengths": self.doc_lengths,
+            "sorted_ids": self.docmap.sorted_ids,
+            "sorted_numbers": self.docmap.sorted_numbers,
+            "doc_offsets": self.docmap.offsets,
+            "docs": self.docmap.data,
+        }
+        if self.positions is not None:
+            sections["pos_offsets"] = self.pos_offsets
+            sections.update(self.positions.sections("positions"))
+
+        write_index_file(path, sections)
+        self.name = os.path.basename(path)
+
+    def load_deleted(self, path: str) -> None:
+        with open(path, "rb") as f:
+            packed = np.frombuffer(f.read(), dtype=np.uint8)
+
+        self.deleted = np.unpackbits(packed, count=len(self)).astype(bool)
+        self.deleted_file = os.path.basename(path)
+
+    def save_deleted(self, path: str) -> None:
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(np.packbits(self.deleted).tobytes())
+
+        os.replace(tmp_path, path)
+        self.deleted_file = os.path.basename(path)
+
+    def __build_postings(
+        self,
+        documents: list[list[str]],
+        positions: list[list[int]] | None,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray | None]:
+        """
+        Turns the token lists of every document into the document numbers,
+        term frequencies and, optionally, encoded token positions of every
+        posting. Terms are numbered in sorted order and each posting list is
+        ordered by document number.
+
+        positions holds the position of every token of every document among
+        its words (see Analyzer.analyze_positions), or is None to leave
+        positions out.
+        """
+
+        postings = collections.defaultdict(list)
+        token_positions = collections.defaultdict(list)
+        for doc_number, tokens in enumerate(documents):
+            if positions is None:
+                for token, tf in collections.Counter(tokens).items():
+                    postings[token].append((doc_number, tf))
+                continue
+
+            doc_positions = collections.defaultdict(list)
+            for position, token in zip(positions[doc_number], tokens):
+                doc_positions[token].append(position)
+
+            for token, found in doc_positions.items():
+                postings[token].append((doc_number, len(found)))
+                token_positions[token].extend(found)
+
+        terms = sorted(postings)
+        self.vocab = Vocabulary.from_terms(terms)
+
+        lengths = np.fromiter(
+            (len(postings[token]) for token in terms),
+            dtype=np.int64,
+            count=len(terms),
+        )
+        self.offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+
+        total = int(self.offsets[-1])
+        docs = np.empty(total, dtype=np.int64)
+        tfs = np.empty(total, dtype=np.int64)
+        for i, token in enumerate(terms):
+            start, end = self.offsets[i], self.offsets[i + 1]
+            pairs = np.array(postings[token], dtype=np.int64)
+            docs[start:end] = pairs[:, 0]
+            tfs[start:end] = pairs[:, 1]
+
+        self.doc_lengths = np.fromiter(
+            (len(tokens) for tokens in documents),
+            dtype=np.int32,
+            count=len(documents),
+        )
+
+        if positions is None:
+            return docs, tfs, None
+
+        pos_offsets = np.zeros(total + 1, dtype=np.int64)
+        np.cumsum(tfs, out=pos_offsets[1:])
+        return docs, tfs, encode_positions(
+            np.fromiter(
+                (p for token in terms for p in token_positions[token]),
+                dtype=np.int64,
+                count=int(pos_offsets[-1]),
+            ),
+            pos_offsets,
+        )
+
+    def __set_documents(
+        self,
+        doc_ids: np.ndarray,
+        doc_offsets: np.ndarray,
+        docs: np.ndarray,
+    ) -> None:
+        self.doc_ids = doc_ids
+        self.deleted = np.zeros(len(doc_ids), dtype=bool)
+
+        sorted_numbers = np.argsort(doc_ids, kind="stable").astype(np.int32)
+        self.docmap = DocumentMap(
+            doc_offsets,
+            docs,
+            doc_ids,
+            doc_ids[sorted_numbers],
+            sorted_numbers,
+        )
+
+    def __set_postings(
+        self,
+        docs: np.ndarray,
+        tfs: np.ndarray,
+        positions: np.ndarray | None,
+    ) -> None:
+        """
+        Compresses the postings, laid out by self.offsets, and precomputes
+        the BM25 score bounds of every term and block using the statistics of
+        this segment alone, so top-k searches of an index made of a single
+        segment can use them as they are.
+
+        positions are the encoded token positions (see encode_positions) of
+        every posting, in posting order, or None to leave them out.
+        """
+
+        avg_doc_length = 0.0
+        if len(self.doc_lengths) > 0:
+            total = int(self.doc_lengths.sum(dtype=np.int64))
+            avg_doc_length = total / len(self.doc_lengths)
+
+        counts = np.diff(self.offsets)
+        impacts = bm25_impacts(
+            tfs,
+            self.doc_lengths[docs],
+            np.repeat(bm25_idf(len(self.doc_ids), counts), counts),
+            avg_doc_length,
+            self.k1,
+            self.b,
+        )
+
+        self.term_max = np.zeros(len(self.vocab), dtype=np.float32)
+        if len(impacts) > 0:
+            self.term_max = upper_bound(
+                np.maximum.reduceat(impacts, self.offsets[:-1])
+            )
+
+        self.block_offsets, block_max, self.block_last = block_max_scores(
+            self.offsets,
+            docs,
+            impacts,
+        )
+        self.block_max = upper_bound(block_max)
+
+        # Gaps restart at the first posting of every term, which is stored as
+        # the gap from document number -1
+        starts = self.offsets[:-1][counts > 0]
+        gaps = np.diff(docs, prepend=-1) - 1
+        gaps[starts] = docs[starts]
+
+        _, block_starts = posting_blocks(self.offsets)
+        counts = np.diff(np.append(block_starts, len(docs)))
+        block = np.repeat(np.arange(len(counts)), counts)
+        gap_index = np.arange(len(docs)) + block_starts[block]
+
+        values = np.empty(2 * len(docs), dtype=np.int64)
+        values[gap_index] = gaps
+        values[gap_index + counts[block]] = tfs - 1
+        self.postings = BitPackedArray.encode(
+            values,
+            np.column_stack([2 * block_starts, 2 * block_starts + counts]).ravel(),
+        )
+
+        self.pos_offsets = None
+        self.positions = None
+        if positions is not None:
+            pos_offsets = np.zeros(len(tfs) + 1, dtype=np.int64)
+            np.cumsum(tfs, out=pos_offsets[1:])
+            self.pos_offsets = pos_offsets[self.offsets]
+            self.positions = BitPackedArray.encode(
+                positions,
+                np.arange(0, len(positions), BLOCK_SIZE),
+            )
+
+    def __decode_all(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Decodes the document numbers and term frequencies of every posting
+        """
+
+        values = self.postings.decode()
+        starts = self.postings.starts
+        half = np.repeat(np.arange(len(starts) - 1) % 2, np.diff(starts))
+        gaps, tfs = values[half == 0], values[half == 1]
+
+        steps = np.cumsum(gaps + 1)
+        term_starts = np.concatenate([[0], steps])[self.offsets[:-1]]
+        docs = steps - np.repeat(term_starts, np.diff(self.offsets)) - 1
+        return docs, tfs + 1
+
+    @classmethod
+    def merge(
+        cls,
+        segments: list["Segment"],
+        deleted: list[np.ndarray] | None = None,
+    ) -> "Segment":
+        """
+        Combines segments into a single new segment holding their live documents
+        in order, dropping deleted documents and their postings. The score
+        bounds are recomputed for the statistics of the merged segment.
+        Positions are kept when every segment has them.
+
+        deleted optionally overrides the tombstones of each segment, so a
+        snapshot can be merged while documents keep being deleted.
+
+        Merging the segments built from consecutive batches of documents gives
+        exactly the same segment as building all the documents at once.
+        """
+
+        terms = sorted(set().union(*(seg.vocab for seg in segments)))
+        term_numbers = {token: i for i, token in enumerate(terms)}
+
+        term_parts = []
+        doc_parts = []
+        tf_parts = []
+        position_parts = []
+        id_parts = []
+        length_parts = []
+        doc_offset_parts = []
+        doc_data_parts = []
+        base = 0
+        if deleted is None:
+            deleted = [seg.deleted for seg in segments]
+        with_positions = all(seg.positions is not None for seg in segments)
+
+        for seg, seg_deleted in zip(segments, deleted):
+            live = ~seg_deleted
+            renumber = np.cumsum(live, dtype=np.int64) - 1 + base
+
+            local_terms = np.fromiter(
+                (term_numbers[token] for token in seg.vocab),
+                dtype=np.int64,
+                count=len(seg.vocab),
+            )
+            posting_terms = np.repeat(local_terms, np.diff(seg.offsets))
+            docs, tfs = seg.__decode_all()
+            keep = live[docs]
+            term_parts.append(posting_terms[keep])
+            doc_parts.append(renumber[docs[keep]])
+            tf_parts.append(tfs[keep])
+
+            # Positions are local to a document, so the encoded positions of
+            # kept postings are copied unchanged
+            if with_positions:
+                pos_offsets = np.zeros(len(tfs) + 1, dtype=np.int64)
+                np.cumsum(tfs, out=pos_offsets[1:])
+                position_parts.append(seg.positions.decode()[
+                    gather_ranges(pos_offsets, np.flatnonzero(keep))
+                ])
+
+            id_parts.append(seg.doc_ids[live])
+            length_parts.append(seg.doc_lengths[live])
+
+            doc_offsets = seg.docmap.offsets
+            doc_sizes = np.diff(doc_offsets)[live]
+            doc_offset_parts.append(doc_sizes)
+            doc_data_parts.append(
+                seg.docmap.data[np.repeat(live, np.diff(doc_offsets))]
+            )
+
+            base += int(np.count_nonzero(live))
+
+        posting_terms = np.concatenate(term_parts or [np.zeros(0, dtype=np.int64)])
+        order = np.argsort(posting_terms, kind="stable")
+
+        merged = cls()
+        merged.vocab = Vocabulary.from_terms(terms)
+        merged.offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(posting_terms, minlength=len(terms)),
+            out=merged.offsets[1:],
+        )
+        docs = np.concatenate(doc_parts or [np.zeros(0, dtype=np.int64)])[order]
+        tfs = np.concatenate(tf_parts or [np.zeros(0, dtype=np.int64)])[order]
+
+        positions = None
+        if with_positions:
+            unordered_tfs = np.concatenate(tf_parts or [np.zeros(0, dtype=np.int64)])
+            pos_offsets = np.zeros(len(unordered_tfs) + 1, dtype=np.int64)
+            np.cumsum(unordered_tfs, out=pos_offsets[1:])
+            positions = np.concatenate(
+                position_parts or [np.zeros(0, dtype=np.int64)]
+            )[gather_ranges(pos_offsets, order)]
+
+        merged.doc_lengths = np.concatenate(
+            length_parts or [np.zeros(0, dtype=np.int32)]
+        ).astype(np.int32)
+
+        doc_offsets = np.zeros(base + 1, dtype=np.int64)
+        np.cumsum(
+            np.concatenate(doc_offset_parts or [np.zeros(0, dtype=np.int64)]),
+            out=doc_offsets[1:],
+        )
+        merged.__set_documents(
+            np.concatenate(id_parts or [np.zeros(0, dtype=np.int32)]).astype(np.int32),
+            doc_offsets,
+            np.concatenate(doc_data_parts or [np.zeros(0, dtype=np.uint8)]),
+        )
+        merged.__set_postings(docs, tfs, positions)
+
+        return merged
+
+    def get_postings(self, token: str) -> PostingList:
+        """
+        Decodes the postings of the given token, which are empty if the token
+        is not in the segment
+        """
+
+        term = self.vocab.get(token)
+        if term is None:
+            empty = np.zeros(0, dtype=np.int64)
+            return PostingList(None, empty, empty)
+
+        start, end = int(self.offsets[term]), int(self.offsets[term + 1])
+        values = self.postings.decode(2 * start, 2 * end)
+
+        # Full blocks hold BLOCK_SIZE gaps then BLOCK_SIZE frequencies, and
+        # the last block the remaining gaps then frequencies
+        full = (end - start) // BLOCK_SIZE * BLOCK_SIZE
+        blocks = values[:2 * full].reshape(-1, 2, BLOCK_SIZE)
+        rest = values[2 * full:]
+        gaps = np.concatenate([blocks[:, 0].ravel(), rest[:len(rest) // 2]])
+        tfs = np.concatenate([blocks[:, 1].ravel(), rest[len(rest) // 2:]])
+
+        return PostingList(term, np.cumsum(gaps + 1) - 1, tfs + 1)
+
+    def get_block_docs(self, term: int, i: int) -> np.ndarray:
+        """
+        Decodes only the document numbers of the i-th block of postings of a
+        term, starting from the last document number of the block before it
+        """
+
+        start = int(self.offsets[term]) + i * BLOCK_SIZE
+        end = min(start + BLOCK_SIZE, int(self.offsets[term + 1]))
+        gaps = self.postings.decode(2 * start, start + end)
+
+        base = -1
+        if i > 0:
+            base = int(self.block_last[self.block_offsets[term] + i - 1])
+        return base + np.cumsum(gaps + 1)
+
+    def get_block_postings(self, term: int, blocks: np.ndarray) -> PostingList:
+        """
+        Decodes only the given ascending blocks of postings of a term,
+        numbered from 0 within the term. Postings decoded this way have no
+        position ranges.
+        """
+
+        blocks = np.asarray(blocks, dtype=np.int64)
+        packed = self.block_offsets[term] + blocks
+        values = self.postings.decode_blocks(
+            np.column_stack([2 * packed, 2 * packed + 1]).ravel(),
+        )
+
+        # Document numbers continue from the last one of the block before,
+        # or from -1 for the first block of the term
+        bases = np.where(blocks > 0, self.block_last[packed - 1], -1)
+        bases = bases.astype(np.int64)
+
+        # Blocks hold BLOCK_SIZE gaps then BLOCK_SIZE frequencies, except the
+        # last block of the term, which holds the remaining ones
+        full = len(values) // (2 * BLOCK_SIZE)
+        whole = values[:2 * BLOCK_SIZE * full].reshape(full, 2, BLOCK_SIZE)
+        rest = values[2 * BLOCK_SIZE * full:].reshape(2, -1)
+        docs = bases[:full, None] + np.cumsum(whole[:, 0] + 1, axis=1)
+        rest_docs = bases[full:] + np.cumsum(rest[0] + 1)
+
+        return PostingList(
+            term,
+            np.concatenate([docs.ravel(), rest_docs]),
+            np.concatenate([whole[:, 1].ravel(), rest[1]]) + 1,
+        )
+
+    def get_positions(self, postings: PostingList, i: int) -> np.ndarray:
+        """
+        Decodes the token positions of the i-th posting of a posting list
+        """
+
+        if self.positions is None:
+            raise RuntimeError(
+                f"segment has no token positions: {self.name}; "
+                "rebuild the index with positions"
+            )
+
+        base = int(self.pos_offsets[postings.term])
+        start, end = postings.position_range(i)
+        return np.cumsum(self.positions.decode(base + start, base + end))
+
+    def get_document_frequency(self, token: str) -> int:
+        """
+        Returns the number of live documents containing the token
+        """
+
+        term = self.vocab.get(token)
+        if term is None:
+            return 0
+
+        docs = int(self.offsets[term + 1] - self.offsets[term])
+        if self.deleted.any():
+            postings = self.get_postings(token)
+            docs -= int(np.count_nonzero(self.deleted[postings.docs]))
+        return docs
+
+    def get_impacts(
+        self,
+        postings: PostingList,
+        idf: float,
+        avg_doc_length: float,
+    ) -> np.ndarray:
+        """
+        Returns the BM25 scores of the given postings for collection-wide
+        statistics.
+
+        Scores are computed from the term frequencies rather than stored per
+        posting: decoding a block of postings costs about ten times as much
+        as scoring it, so stored impacts would barely speed up searches, and
+        storing them compactly enough to matter means quantizing them, which
+        changes rankings.
+        """
+
+        if self.__norms[0] != avg_doc_length:
+            self.__norms = (
+                avg_doc_length,
+                1 - self.b + self.b * (self.doc_lengths / avg_doc_length),
+            )
+
+        tf = postings.tfs.astype(np.float64)
+        length_norm = self.__norms[1][postings.docs]
+        return idf * (tf * (self.k1 + 1)) / (tf + self.k1 * length_norm)
+
+    def live_doc_count(self) -> int:
+        return len(self) - int(np.count_nonzero(self.deleted))
+
+    def live_length_total(self) -> int:
+        return int(self.doc_lengths[~self.deleted].sum(dtype=np.int64))
+
+
+def build_shard(
+    movies: list[dict],
+    positions: bool = True,
+) -> tuple[Segment, list[tuple[str, str]]]:
+    """
+    Builds a segment in a worker process, also returning the stems the
+    worker's analyzer knows so they can be persisted by the parent
+    """
+
+    return Segment.build(movies, positions), analyzer.stems.items()
+
+
+class LiveDocumentMap:
+    """
+    Read-only mapping of document IDs to the live copy of each document in a
+    list of segments
+    """
+
+    def __init__(self, segments: list[Segment]):
+        self.segments = segments
+
+    def __len__(self) -> int:
+        return sum(seg.live_doc_count() for seg in self.segments)
+
+    def __iter__(self):
+        for seg in self.segments:
+            yield from seg.doc_ids[~seg.deleted].tolist()
+
+    def __contains__(self, doc_id: int) -> bool:
+        return self.locate(doc_id) is not None
+
+    def __getitem__(self, doc_id: int) -> dict:
+        location = self.locate(doc_id)
+        if location is None:
+            raise KeyError(doc_id)
+
+        seg, doc_number = location
+        return seg.docmap.document(doc_number)
+
+    def locate(self, doc_id: int) -> tuple[Segment, int] | None:
+        """
+        Returns the segment and document number holding the live copy of the
+        document ID, or None when it is not in the index
+        """
+
+        for seg in reversed(self.segments):
+            doc_number = seg.docmap.number(doc_id)
+            if doc_number is not None and not seg.deleted[doc_number]:
+                return seg, doc_number
+        return None
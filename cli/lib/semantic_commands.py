@@ -1,7 +1,12 @@
-import re
+import numpy as np
 
 from .chunked_semantic_search import ChunkedSemanticSearch
-from .search_utils import load_movies
+from .document_store import open_documents
+from .embedding_index import recall_at_k
+from .ivf import IVFIndex
+from .quantization import QuantizedEmbeddings, rescore
+from .query_utils import top_k
+from .search_daemon import open_engine
 from .semantic_search import SemanticSearch
 
 
@@ -26,10 +31,11 @@ def verify_command():
     print(f"Max sequence length: {search.model.max_seq_length}")
 
 
-def embed_chunks_command():
-    movies = load_movies()
+def embed_chunks_command(workers: int = 1):
+    documents = open_documents()
     css = ChunkedSemanticSearch()
-    embeddings = css.load_or_create_chunk_embeddings(movies)
+    css.encode_workers = workers
+    embeddings = css.load_or_create_chunk_embeddings(documents)
     print(f"Generated {len(embeddings)} chunked embeddings")
 
 
@@ -49,22 +55,18 @@ def embedquery_command(text: str):
     print(f"Shape: {embedding.shape}")
 
 
-def search_command(query: str, limit: int):
-    movies = load_movies()
-    search = SemanticSearch()
-    search.load_or_create_embeddings(movies)
-    for i, result in enumerate(search.search(query, limit), 1):
-        print(f"{i}. {result['title']}")
-        print(f"   {result["description"]}")
+def search_command(query: str, limit: int, nprobe: int | None):
+    search = open_engine("semantic")
+    for i, result in enumerate(search.search(query, limit, nprobe), 1):
+        print(f"{i}. {result.title}")
+        print(f"   {result.description}")
 
 
-def search_chunked_command(query: str, limit: int):
-    movies = load_movies()
-    search = ChunkedSemanticSearch()
-    search.load_or_create_chunk_embeddings(movies)
-    for i, result in enumerate(search.search_chunks(query, limit), 1):
-        print(f"\n{i}. {result["title"]} (score: {result["score"]:.4f})")
-        print(f"    {result["document"]}")
+def search_chunked_command(query: str, limit: int, nprobe: int | None):
+    search = open_engine("chunked")
+    for i, result in enumerate(search.search_chunks(query, limit, nprobe), 1):
+        print(f"\n{i}. {result.title} (score: {result.score:.4f})")
+        print(f"    {result.description}")
 
 
 def semantic_chunk_command(text: str, chunk_size: int, overlap: int):
@@ -75,12 +77,99 @@ def semantic_chunk_command(text: str, chunk_size: int, overlap: int):
         print(f"{i}. {' '.join(chunk)}")
 
 
-def verify_embeddings_command():
-    movies = load_movies()
+def verify_embeddings_command(workers: int = 1):
+    documents = open_documents()
     search = SemanticSearch()
-    embeddings = search.load_or_create_embeddings(movies)
-    print(f"Number of docs:   {len(movies)}")
+    search.encode_workers = workers
+    embeddings = search.load_or_create_embeddings(documents)
+    print(f"Number of docs:   {len(documents)}")
     print(
         "Embeddings shape: %d vectors in %d dimensions" %
         (embeddings.shape[0], embeddings.shape[1])
     )
+
+
+def ann_recall_command(k: int, num_queries: int, nprobes: list[int]):
+    documents = open_documents()
+    css = ChunkedSemanticSearch()
+    css.load_or_create_embeddings(documents)
+    css.load_or_create_chunk_embeddings(documents)
+
+    rng = np.random.default_rng(0)
+    for name, vectors, ivf in [
+        ("Movies", css.embeddings, css.ann),
+        ("Chunks", css.chunk_embeddings, css.chunk_ann),
+    ]:
+        if len(vectors) == 0:
+            continue
+
+        # Below the size the engines index, train a throwaway index so the
+        # trade-off can still be measured
+        if ivf is None:
+            ivf = IVFIndex.train(vectors)
+
+        picked = rng.choice(len(vectors), min(num_queries, len(vectors)), replace=False)
+        queries = vectors[picked]
+        print(
+            f"{name}: {len(vectors)} vectors in {len(ivf.centroids)} lists, "
+            f"{len(queries)} queries"
+        )
+        for nprobe in nprobes:
+            def probe(query: np.ndarray) -> np.ndarray:
+                rows = ivf.probe(query, nprobe)
+                return rows[top_k(vectors[rows] @ query, k)]
+
+            recall, ms = recall_at_k(vectors, queries, k, probe)
+            print(f"  nprobe {nprobe:>4}: recall@{k} {recall:.4f}, {ms:.2f} ms/query")
+
+
+def quantization_recall_command(
+    k: int,
+    num_queries: int,
+    modes: list[str],
+    rescore_factors: list[int],
+):
+    documents = open_documents()
+    css = ChunkedSemanticSearch()
+    css.load_or_create_embeddings(documents)
+    css.load_or_create_chunk_embeddings(documents)
+
+    rng = np.random.default_rng(0)
+    for name, vectors, quantized in [
+        ("Movies", css.embeddings, css.quantized),
+        ("Chunks", css.chunk_embeddings, css.chunk_quantized),
+    ]:
+        if len(vectors) == 0:
+            continue
+
+        picked = rng.choice(len(vectors), min(num_queries, len(vectors)), replace=False)
+        queries = vectors[picked]
+        rows = np.arange(len(vectors))
+        print(
+            f"{name}: {len(vectors)} vectors of {vectors.itemsize * vectors.shape[1]} bytes, "
+            f"{len(queries)} queries"
+        )
+        for mode in modes:
+            # Modes other than the engine's are trained just for the report
+            if quantized is None or quantized.quantizer.mode != mode:
+                quantized = QuantizedEmbeddings.train(mode, vectors)
+
+            print(f"  {mode}: {quantized.codes.shape[1]} bytes per vector")
+            for factor in [None, *rescore_factors]:
+                # Without a factor the codes' scores rank the rows as they
+                # are
+                count = None if factor is None else k * factor
+
+                def scan(query: np.ndarray) -> np.ndarray:
+                    kept, scores = rescore(
+                        vectors,
+                        query,
+                        rows,
+                        quantized.scores(query),
+                        count,
+                    )
+                    return kept[top_k(scores, k)]
+
+                recall, ms = recall_at_k(vectors, queries, k, scan)
+                label = "codes only" if factor is None else f"rescore {factor}x"
+                print(f"    {label:>12}: recall@{k} {recall:.4f}, {ms:.2f} ms/query")
@@ -1,12 +1,31 @@
-import numpy as np
 import os.path
+from collections.abc import Iterator
 
-from sentence_transformers import SentenceTransformer
+import numpy as np
 
-from .query_utils import cosine_similarity
+from .cache_manifest import CacheManifest
+from .constants import (
+    BATCH_SCORES,
+    EMBEDDING_DTYPE,
+    EMBEDDING_QUANTIZATION,
+    EMBEDDING_RESCORE,
+    IVF_NPROBE,
+)
+from .document_store import DocumentStore
+from .embedding_file import EmbeddingMatrix, open_embeddings, write_embeddings
+from .embedding_index import file_source
+from .embedding_pipeline import EmbeddingPipeline
+from .ivf import IVFIndex, open_ivf
+from .quantization import QuantizedEmbeddings, open_quantized, rescore
+from .query_embedding_cache import QueryEmbeddingCache, normalize_query
+from .query_utils import normalize_rows, top_k
 from .search_utils import CACHE_PATH
 
 
+# Fields of the documents that are embedded
+TEXT_FIELDS = {"title": None, "description": None}
+
+
 class SemanticResult:
     def __init__(self, id: int, title: str, desc: str, score: float):
         self.doc_id = id
@@ -18,70 +37,301 @@ class SemanticResult:
 
 class SemanticSearch:
     def __init__(self, model_name: str = "all-MiniLM-L6-v2"):
-        self.model = SentenceTransformer(model_name)
+        # Loaded on first use, see model
+        self.model_name = model_name
+        self.__model = None
+
+        # Unit-length embedding of each document, one row each, memory-mapped
+        # from a file storing them as embedding_dtype
         self.embeddings = None
+        self.embedding_dtype = EMBEDDING_DTYPE
+
+        # Number of processes encoding documents when building embeddings
+        self.encode_workers = 1
+
+        # Shared store of the embedded documents, in embedding order
         self.documents = None
-        self.document_map = {}
-        self.embeddings_path = os.path.join(CACHE_PATH, "movie_embeddings.npy")
+        self.embeddings_path = os.path.join(CACHE_PATH, "movie_embeddings.bin")
+
+        # Approximate nearest neighbour index of the embeddings, or None when
+        # there are few enough of them to always search exactly
+        self.ann = None
+        self.ann_path = os.path.join(CACHE_PATH, "movie_embeddings.ivf")
+
+        # Compressed codes of the embeddings scanned instead of them, or None
+        # to scan the float32 rows, see EMBEDDING_QUANTIZATION
+        self.quantization = EMBEDDING_QUANTIZATION
+        self.quantized = None
+        self.quantized_path = os.path.join(CACHE_PATH, "movie_embeddings.codes")
+
+        # Which documents, with which contents, the cached embeddings are of
+        self.cache_manifest = CacheManifest()
+
+        # Embeddings of recent queries, so repeated ones skip the model
+        self.query_cache = QueryEmbeddingCache(model_name)
+
+    @property
+    def model(self):
+        """
+        The embedding model, loaded on first use so that commands which
+        never encode do not import its libraries
+        """
+
+        if self.__model is None:
+            from sentence_transformers import SentenceTransformer
+
+            self.__model = SentenceTransformer(self.model_name)
+        return self.__model
 
     def generate_embedding(self, text: str):
-        if text.strip() == "":
-            raise ValueError("empty text")
+        return self.generate_embeddings([text])[0]
+
+    def generate_embeddings(self, texts: list[str]) -> np.ndarray:
+        """
+        Embeds queries, one row each, encoding those that are not cached in
+        a single call to the model
+        """
+
+        for text in texts:
+            if text.strip() == "":
+                raise ValueError("empty text")
+
+        queries = [normalize_query(text) for text in texts]
+        embeddings = {}
+        for query in queries:
+            if query not in embeddings:
+                embeddings[query] = self.query_cache.get(query)
 
-        return self.model.encode([text])[0]
+        missing = [query for query, embedding in embeddings.items() if embedding is None]
+        if len(missing) > 0:
+            for query, embedding in zip(missing, self.model.encode(missing)):
+                self.query_cache.put(query, embedding)
+                embeddings[query] = embedding
+
+        return np.stack([embeddings[query] for query in queries])
+
+    def build_embeddings(
+        self,
+        documents: DocumentStore,
+        reuse: np.ndarray | None = None,
+    ) -> EmbeddingMatrix:
+        """
+        Embeds the title and description of every document, normalized to
+        unit length. Documents with a reuse entry other than -1 keep that
+        row of the current embeddings instead of being encoded again.
+        """
 
-    def build_embeddings(self, documents: list[dict]) -> list:
         self.documents = documents
+        if reuse is None:
+            reuse = np.full(len(documents), -1, dtype=np.int64)
 
+        stale = np.flatnonzero(reuse < 0)
         doc_strs = []
-        for doc in documents:
-            self.document_map[doc["id"]] = doc
+        for i in stale.tolist():
+            doc = documents.document(i, TEXT_FIELDS)
             doc_strs.append(f'{doc["title"]}: {doc["description"]}')
 
-        self.embeddings = self.model.encode(doc_strs, show_progress_bar=True)
+        if len(stale) == len(reuse):
+            embeddings = normalize_rows(
+                self.encode_batches(doc_strs, "movie_embeddings"),
+            )
+        else:
+            embeddings = self.embeddings[np.maximum(reuse, 0)]
+            if len(stale) > 0:
+                embeddings[stale] = normalize_rows(
+                    self.encode_batches(doc_strs, "movie_embeddings"),
+                )
 
-        np.save(self.embeddings_path, self.embeddings)
+        old_source = file_source(self.embeddings_path)
+        write_embeddings(self.embeddings_path, embeddings, self.embedding_dtype)
+        self.embeddings = open_embeddings(self.embeddings_path, self.embedding_dtype)
+        self.__open_derived(reuse, old_source)
+        self.cache_manifest.record(
+            "movie_embeddings",
+            self.__embedding_params(),
+            documents.doc_ids,
+            documents.hashes,
+        )
 
         return self.embeddings
 
-    def load_or_create_embeddings(self, documents: list[dict]) -> list:
+    def __open_derived(
+        self,
+        rows: np.ndarray | None = None,
+        old_source: list | None = None,
+    ) -> None:
+        """
+        Opens the ANN index and codes of the embeddings, bringing them up to
+        date with the embeddings file
+        """
+
+        source = file_source(self.embeddings_path)
+        self.ann = open_ivf(self.ann_path, self.embeddings, source, rows, old_source)
+        self.quantized = open_quantized(
+            self.quantized_path,
+            self.quantization,
+            self.embeddings,
+            source,
+            rows,
+            old_source,
+        )
+
+    def __embedding_params(self) -> dict:
+        return {"model": self.model_name, "fields": list(TEXT_FIELDS)}
+
+    def encode_batches(self, texts: list[str], name: str) -> np.ndarray:
+        """
+        Encodes the texts through an EmbeddingPipeline checkpointed under the
+        cache directory, so an interrupted build of the named embeddings
+        picks up where it stopped
+        """
+
+        pipeline = EmbeddingPipeline(
+            self.model_name,
+            lambda: self.model,
+            os.path.join(CACHE_PATH, f"{name}.partial"),
+            self.encode_workers,
+        )
+        return pipeline.encode(texts)
+
+    def load_or_create_embeddings(self, documents: DocumentStore) -> EmbeddingMatrix:
+        """
+        Loads the cached embeddings, embedding again only the documents that
+        were added or changed since they were built, and everything when
+        they were built with another model
+        """
+
         self.documents = documents
 
-        doc_strs = []
-        for doc in documents:
-            self.document_map[doc["id"]] = doc
-            doc_strs.append(f'{doc["title"]}: {doc["description"]}')
+        reuse = None
+        self.embeddings = open_embeddings(self.embeddings_path, self.embedding_dtype)
+        if self.embeddings is not None:
+            reuse = self.cache_manifest.match_rows(
+                "movie_embeddings",
+                self.__embedding_params(),
+                documents.doc_ids,
+                documents.hashes,
+            )
 
-        if os.path.exists(self.embeddings_path):
-            self.embeddings = np.load(self.embeddings_path)
-            if len(self.documents) == len(self.embeddings):
+        if reuse is not None:
+            if reuse.max(initial=-1) >= len(self.embeddings):
+                reuse = None
+            elif (
+                len(self.embeddings) == len(reuse) and
+                np.array_equal(reuse, np.arange(len(reuse)))
+            ):
+                self.__open_derived()
                 return self.embeddings
 
-        return self.build_embeddings(documents)
+        return self.build_embeddings(documents, reuse)
+
+    def search(
+        self,
+        query: str,
+        limit: int,
+        nprobe: int | None = IVF_NPROBE,
+    ) -> list[SemanticResult]:
+        """
+        Returns the documents closest to the query, see score_candidates
+        """
+
+        return self.search_batch([query], limit, nprobe)[0]
+
+    def search_batch(
+        self,
+        queries: list[str],
+        limit: int,
+        nprobe: int | None = IVF_NPROBE,
+    ) -> list[list[SemanticResult]]:
+        """
+        Returns the search results of every query, in query order, encoding
+        the queries together and scoring them with matrix products
+        """
 
-    def search(self, query: str, limit: int) -> list[SemanticResult]:
         if self.embeddings is None:
             raise ValueError(
                 "No embeddings loaded. Call `load_or_create_embeddings` first."
             )
 
-        q_embedding = self.generate_embedding(query)
-        scores = []
-        for i, embedding in enumerate(self.embeddings):
-            scores.append((
-                cosine_similarity(q_embedding, embedding),
-                self.documents[i],
-            ))
-
-        scores.sort(key=lambda s: s[0], reverse=True)
-
-        results = []
-        for score in scores[:limit]:
-            results.append(SemanticResult(
-                score[1]["id"],
-                score[1]["title"],
-                score[1]["description"],
-                score[0],
-            ))
-
-        return results
+        # Rows are normalized, so their dot products with the normalized
+        # queries are the cosine similarities
+        q_embeddings = normalize_rows(self.generate_embeddings(queries))
+
+        batch = []
+        for rows, scores in score_candidates_batch(
+            self.embeddings,
+            q_embeddings,
+            self.ann,
+            self.quantized,
+            nprobe,
+            limit * EMBEDDING_RESCORE if EMBEDDING_RESCORE else None,
+        ):
+            results = []
+            for i in top_k(scores, limit).tolist():
+                doc = self.documents.document(int(rows[i]))
+                results.append(SemanticResult(
+                    doc["id"],
+                    doc["title"],
+                    doc["description"],
+                    float(scores[i]),
+                ))
+            batch.append(results)
+
+        return batch
+
+
+def score_candidates(
+    vectors: EmbeddingMatrix,
+    query: np.ndarray,
+    ann: IVFIndex | None,
+    quantized: QuantizedEmbeddings | None,
+    nprobe: int | None,
+    rescore_count: int | None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the rows worth ranking for a unit-length query, in ascending
+    order, and their scores. With an ANN index, only the rows in its nprobe
+    lists closest to the query are candidates; with nprobe None, every row
+    is. With quantized codes, the candidates are scored by their codes and
+    the top rescore_count of them scored again against the stored rows.
+    """
+
+    rows = None
+    if ann is not None and nprobe is not None:
+        rows = ann.probe(query, nprobe)
+
+    if quantized is not None:
+        if rows is None:
+            rows = np.arange(len(vectors))
+        return rescore(vectors, query, rows, quantized.scores(query, rows), rescore_count)
+
+    if rows is None:
+        return np.arange(len(vectors)), vectors @ query
+    return rows, vectors[rows] @ query
+
+
+def score_candidates_batch(
+    vectors: EmbeddingMatrix,
+    queries: np.ndarray,
+    ann: IVFIndex | None,
+    quantized: QuantizedEmbeddings | None,
+    nprobe: int | None,
+    rescore_count: int | None,
+) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+    """
+    Yields score_candidates of every query in order. When every row is
+    scored exactly, blocks of queries are scored with a single matrix
+    product, bounded to BATCH_SCORES scores at a time.
+    """
+
+    if quantized is not None or (ann is not None and nprobe is not None):
+        for query in queries:
+            yield score_candidates(vectors, query, ann, quantized, nprobe, rescore_count)
+        return
+
+    rows = np.arange(len(vectors))
+    block = max(1, BATCH_SCORES // max(len(vectors), 1))
+    for start in range(0, len(queries), block):
+        scores = np.ascontiguousarray((vectors @ queries[start:start + block].T).T)
+        for query_scores in scores:
+            yield rows, query_scores
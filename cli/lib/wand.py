@@ -0,0 +1,200 @@
+from collections.abc import Callable
+
+import numpy as np
+
+
+# Number of postings summarized by each block-max entry
+BLOCK_SIZE = 128
+
+# Headroom applied to score upper bounds so floating point rounding in the
+# order the bounds are summed can never prune a document that belongs in the
+# top-k
+BOUND_SLACK = 1 + 1e-9
+
+NO_MORE_DOCS = np.iinfo(np.int64).max
+
+
+def posting_blocks(offsets: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Splits every posting list into blocks of BLOCK_SIZE postings and returns
+    the block offsets of each term (in CSR layout, like the postings offsets)
+    and the index of the first posting of each block
+    """
+
+    docs = np.diff(offsets)
+    blocks = (docs + BLOCK_SIZE - 1) // BLOCK_SIZE
+
+    block_offsets = np.zeros(len(blocks) + 1, dtype=np.int64)
+    np.cumsum(blocks, out=block_offsets[1:])
+
+    total = int(block_offsets[-1])
+    nth_block = np.arange(total) - np.repeat(block_offsets[:-1], blocks)
+    starts = np.repeat(offsets[:-1], blocks) + nth_block * BLOCK_SIZE
+
+    return block_offsets, starts
+
+
+def block_max_scores(
+    offsets: np.ndarray,
+    postings: np.ndarray,
+    impacts: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns the block offsets of each term (see posting_blocks), the maximum
+    impact of each block, and the last document number of each block
+    """
+
+    block_offsets, starts = posting_blocks(offsets)
+    if len(starts) == 0:
+        return (
+            block_offsets,
+            np.zeros(0, dtype=impacts.dtype),
+            np.zeros(0, dtype=np.int32),
+        )
+
+    ends = np.append(starts[1:], len(postings))
+    block_max = np.maximum.reduceat(impacts, starts)
+    block_last = postings[ends - 1].astype(np.int32)
+
+    return block_offsets, block_max, block_last
+
+
+def block_max_top_k(
+    block_lasts: list[np.ndarray],
+    block_maxes: list[np.ndarray],
+    term_maxes: list[float],
+    score_blocks: Callable[[int, np.ndarray], tuple[np.ndarray, np.ndarray]],
+    size: int,
+    excluded: np.ndarray | None,
+    limit: int,
+) -> list[tuple[int, float]]:
+    """
+    Returns the (document number, score) pairs of the limit best scoring
+    documents out of size, highest score first with ties in document number
+    order.
+
+    Term i scores at most term_maxes[i] and has the blocks ending at the
+    document numbers block_lasts[i] and scoring at most block_maxes[i], and
+    score_blocks(i, blocks) returns the document numbers and scores of the
+    postings in the given blocks of term i. Documents flagged in the
+    optional excluded array are never returned.
+
+    Document numbers are split into intervals at the last document of every
+    block of every term, so each interval lies within a single block of each
+    term and the sum of those blocks' maxima bounds the score of every
+    document in it. The blocks of the limit intervals with the highest
+    bounds are scored first, which sets a top-k threshold. Terms whose
+    maxima add up to no more than the threshold cannot bring a document into
+    the top-k on their own (as in MaxScore), so candidates only come from the
+    blocks of the other terms in intervals that beat the threshold, and the
+    blocks of those terms are only scored where a candidate could still beat
+    it. The final scores are summed in term order, so the results are
+    identical to an exhaustive evaluation that adds up the terms in the same
+    order.
+    """
+
+    if limit <= 0 or len(block_lasts) == 0:
+        return []
+
+    ends = np.sort(np.concatenate(block_lasts))
+    ends = ends[np.append(True, ends[1:] != ends[:-1])]
+
+    # The block of each term holding each interval and its maximum, where
+    # intervals past the last block of a term are held by an empty block
+    covering = []
+    interval_maxes = []
+    bounds = np.zeros(len(ends), dtype=np.float64)
+    for last, maxes in zip(block_lasts, block_maxes):
+        blocks = np.searchsorted(last, ends)
+        covering.append(blocks)
+        interval_maxes.append(np.append(maxes, 0)[blocks])
+        bounds += interval_maxes[-1]
+
+    decoded = []
+    for last in block_lasts:
+        flags = np.zeros(len(last) + 1, dtype=bool)
+        flags[-1] = True
+        decoded.append(flags)
+
+    # Scores summed in the order blocks are decoded, which may differ from
+    # term order, so they only serve as lower bounds
+    partial = np.zeros(size, dtype=np.float64)
+    postings = [[] for _ in block_lasts]
+
+    def decode(i: int, intervals: np.ndarray) -> None:
+        # Intervals are in document order, so their blocks are too
+        blocks = covering[i][intervals]
+        blocks = blocks[np.append(True, blocks[1:] != blocks[:-1])]
+        blocks = blocks[~decoded[i][blocks]]
+        if len(blocks) > 0:
+            decoded[i][blocks] = True
+            docs, scores = score_blocks(i, blocks)
+            partial[docs] += scores
+            postings[i].append((docs, scores))
+
+    def kth_partial(matches: np.ndarray) -> float:
+        if excluded is not None:
+            matches = matches[~excluded[matches]]
+        if len(matches) < limit:
+            return -np.inf
+        return np.partition(partial[matches], len(matches) - limit)[-limit]
+
+    # Documents scored for every term are scored exactly
+    first = np.sort(np.argsort(-bounds, kind="stable")[:limit])
+    for i in range(len(covering)):
+        decode(i, first)
+    complete = np.logical_and.reduce(
+        [decoded[i][blocks] for i, blocks in enumerate(covering)],
+    )
+    matches = np.flatnonzero(partial)
+    threshold = kth_partial(matches[complete[np.searchsorted(ends, matches)]])
+
+    order = np.argsort(term_maxes, kind="stable")
+    sums = np.cumsum(np.asarray(term_maxes)[order])
+    optional = sums * BOUND_SLACK <= threshold
+    optional = order[optional].tolist()
+    essential = order[len(optional):].tolist()
+
+    live = np.flatnonzero(bounds * BOUND_SLACK > threshold)
+    found = np.zeros(size, dtype=bool)
+    for i in essential:
+        decode(i, live)
+        for docs, _ in postings[i]:
+            found[docs] = True
+
+    candidates = np.flatnonzero(found)
+    intervals = np.searchsorted(ends, candidates)
+    keep = bounds[intervals] * BOUND_SLACK > threshold
+    if excluded is not None:
+        keep &= ~excluded[candidates]
+    candidates = candidates[keep]
+    intervals = intervals[keep]
+
+    # Bound what the optional terms can still add to every candidate
+    threshold = max(threshold, kth_partial(candidates))
+    bound = partial[candidates]
+    for i in optional:
+        blocks = covering[i][intervals]
+        bound += np.where(decoded[i][blocks], 0, interval_maxes[i][intervals])
+    keep = bound * BOUND_SLACK > threshold
+    candidates = candidates[keep]
+    intervals = intervals[keep]
+    for i in optional:
+        decode(i, intervals)
+
+    totals = np.zeros(len(candidates), dtype=np.float64)
+    for term_postings in postings:
+        if len(term_postings) == 0:
+            continue
+
+        docs = np.concatenate([docs for docs, _ in term_postings])
+        scores = np.concatenate([scores for _, scores in term_postings])
+        sort = np.argsort(docs)
+        docs = docs[sort]
+        pos = np.minimum(np.searchsorted(docs, candidates), len(docs) - 1)
+        hit = docs[pos] == candidates
+        totals[hit] += scores[sort[pos[hit]]]
+
+    # Highest score first, ties in document number order
+    ordered = np.lexsort((candidates, -totals))[:limit]
+    return [(int(candidates[j]), float(totals[j])) for j in ordered]
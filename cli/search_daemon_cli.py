@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import argparse
+
+from lib.search_daemon import ENGINE_METHODS, DaemonUnavailable, SearchDaemon, request
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Search daemon that keeps search engines loaded between "
+        "CLI invocations",
+    )
+    subparsers = parser.add_subparsers(
+        dest="command",
+        help="Available commands",
+    )
+
+    start_parser = subparsers.add_parser(
+        "start",
+        help="Run the daemon in the foreground until stopped",
+    )
+    start_parser.add_argument(
+        "--warm",
+        nargs="*",
+        choices=sorted(ENGINE_METHODS),
+        default=["index", "chunked", "hybrid"],
+        help="Engines to load before serving, others load on first use",
+    )
+
+    subparsers.add_parser(
+        "status",
+        help="Show whether the daemon is running and what it has loaded",
+    )
+
+    subparsers.add_parser(
+        "stop",
+        help="Stop the running daemon",
+    )
+
+    args = parser.parse_args()
+
+    match args.command:
+        case "start":
+            daemon = SearchDaemon()
+            try:
+                daemon.serve(args.warm)
+            except KeyboardInterrupt:
+                pass
+        case "status" | "stop":
+            try:
+                status = request("daemon", args.command)
+            except DaemonUnavailable:
+                print("Search daemon is not running")
+                return
+
+            if args.command == "stop":
+                print(f"Stopped search daemon {status['pid']}")
+                return
+
+            print(f"Search daemon {status['pid']} up for {status['uptime']:.0f}s")
+            print(f"Loaded engines: {', '.join(status['engines']) or 'none'}")
+
+            cache = status.get("query_cache")
+            if cache is not None:
+                print(
+                    f"Query embedding cache: {cache['hit_rate']:.1%} hit rate, "
+                    f"{cache['memory_hits']} memory hits, "
+                    f"{cache['disk_hits']} disk hits, {cache['misses']} misses, "
+                    f"{cache['memory_entries']} in memory, "
+                    f"{cache['disk_entries']} on disk"
+                )
+        case _:
+            parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
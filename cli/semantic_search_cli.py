@@ -2,11 +2,15 @@
 
 import argparse
 
+from lib.constants import EMBEDDING_RESCORE, IVF_NPROBE
+from lib.quantization import QUANTIZERS
 from lib.semantic_commands import (
+    ann_recall_command,
     chunk_command,
     embed_chunks_command,
     embed_command,
     embedquery_command,
+    quantization_recall_command,
     search_command,
     search_chunked_command,
     semantic_chunk_command,
@@ -15,6 +19,34 @@ from lib.semantic_commands import (
 )
 
 
+def add_nprobe_arguments(parser: argparse.ArgumentParser):
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        "--nprobe",
+        type=int,
+        default=IVF_NPROBE,
+        help="Number of approximate index lists to search, more is slower "
+        "but finds more of the closest results",
+    )
+    group.add_argument(
+        "--exact",
+        action="store_const",
+        const=None,
+        dest="nprobe",
+        help="Score every embedding instead of using the approximate index",
+    )
+
+
+def add_workers_argument(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes encoding texts, each loading the model "
+        "and sharing the CPU cores",
+    )
+
+
 def main():
     parser = argparse.ArgumentParser(description="Semantic Search CLI")
 
@@ -58,16 +90,18 @@ def main():
         default=5,
         help="Maximum number of results",
     )
+    add_nprobe_arguments(search_parser)
 
     subparsers.add_parser(
         "verify",
         help="Verify semantic search model",
     )
 
-    subparsers.add_parser(
+    verify_embeddings_parser = subparsers.add_parser(
         "verify_embeddings",
         help="Build and verify embeddings",
     )
+    add_workers_argument(verify_embeddings_parser)
 
     chunk_parser = subparsers.add_parser(
         "chunk",
@@ -113,10 +147,11 @@ def main():
         help="Maximum number of sentences to overlap in each chunk",
     )
 
-    subparsers.add_parser(
+    embed_chunks_parser = subparsers.add_parser(
         "embed_chunks",
         help="Embed chunks",
     )
+    add_workers_argument(embed_chunks_parser)
 
     search_chunked_parser = subparsers.add_parser(
         "search_chunked",
@@ -132,22 +167,87 @@ def main():
         default=10,
         help="Max number of results to return",
     )
+    add_nprobe_arguments(search_chunked_parser)
+
+    ann_recall_parser = subparsers.add_parser(
+        "ann_recall",
+        help="Measure the recall and speed of the approximate index against exact search",
+    )
+    ann_recall_parser.add_argument(
+        "--k",
+        type=int,
+        default=10,
+        help="Number of nearest neighbours to compare",
+    )
+    ann_recall_parser.add_argument(
+        "--queries",
+        type=int,
+        default=200,
+        help="Number of embeddings to sample as queries",
+    )
+    ann_recall_parser.add_argument(
+        "--nprobe",
+        type=int,
+        nargs="+",
+        default=[1, 4, 16, IVF_NPROBE, 64],
+        help="Numbers of lists to probe",
+    )
+
+    quantization_recall_parser = subparsers.add_parser(
+        "quantization_recall",
+        help="Measure the recall and speed of compressed embeddings against exact search",
+    )
+    quantization_recall_parser.add_argument(
+        "--k",
+        type=int,
+        default=10,
+        help="Number of nearest neighbours to compare",
+    )
+    quantization_recall_parser.add_argument(
+        "--queries",
+        type=int,
+        default=200,
+        help="Number of embeddings to sample as queries",
+    )
+    quantization_recall_parser.add_argument(
+        "--mode",
+        nargs="+",
+        choices=sorted(QUANTIZERS),
+        default=sorted(QUANTIZERS),
+        help="Quantization modes to measure",
+    )
+    quantization_recall_parser.add_argument(
+        "--rescore",
+        type=int,
+        nargs="*",
+        default=[EMBEDDING_RESCORE or 4],
+        help="Multiples of k to re-score against the stored embeddings",
+    )
 
     args = parser.parse_args()
 
     match args.command:
+        case "ann_recall":
+            ann_recall_command(args.k, args.queries, args.nprobe)
         case "chunk":
             chunk_command(args.text, args.chunk_size, args.overlap)
         case "embed_chunks":
-            embed_chunks_command()
+            embed_chunks_command(args.workers)
         case "embed_text":
             embed_command(args.text)
         case "embedquery":
             embedquery_command(args.query)
+        case "quantization_recall":
+            quantization_recall_command(
+                args.k,
+                args.queries,
+                args.mode,
+                args.rescore,
+            )
         case "search":
-            search_command(args.query, args.limit)
+            search_command(args.query, args.limit, args.nprobe)
         case "search_chunked":
-            search_chunked_command(args.query, args.limit)
+            search_chunked_command(args.query, args.limit, args.nprobe)
         case "semantic_chunk":
             semantic_chunk_command(
                 args.text,
@@ -157,7 +257,7 @@ def main():
         case "verify":
             verify_command()
         case "verify_embeddings":
-            verify_embeddings_command()
+            verify_embeddings_command(args.workers)
         case _:
             parser.print_help()
 
@@ -0,0 +1,17 @@
+import pytest
+
+from lib.boolean_query import parse_query
+
+
+@pytest.mark.parametrize("query", ["", "   ", "\t\n"])
+def test_parse_query_without_words(query):
+    assert parse_query(query) is None
+
+
+def test_parse_query_only_stop_words():
+    assert parse_query("the AND a") is None
+
+
+def test_parse_query_unbalanced_parentheses():
+    with pytest.raises(RuntimeError):
+        parse_query("(")
@@ -0,0 +1,88 @@
+import os
+import random
+
+import pytest
+
+from lib.inverted_index import InvertedIndex
+
+WORDS = [f"word{chr(97 + i)}" for i in range(26)]
+
+
+@pytest.fixture(scope="module")
+def index(tmp_path_factory):
+    rnd = random.Random(1)
+    weights = [1 / (i + 1) for i in range(len(WORDS))]
+    movies = []
+    for id in range(1, 3001):
+        words = rnd.choices(WORDS, weights, k=rnd.randint(3, 40))
+        movies.append({
+            "id": id,
+            "title": f"Movie {id}",
+            "description": " ".join(words),
+        })
+
+    index = InvertedIndex()
+    index.index_dir = str(tmp_path_factory.mktemp("index"))
+    index.index_file = os.path.join(index.index_dir, "manifest.json")
+    index.stems_file = os.path.join(index.index_dir, "stems.pkl")
+    index.build(movies)
+    return index
+
+
+def search(index, query, limit, **kwargs):
+    index.results.clear()
+    results = index.bm25_search(query, limit, **kwargs)
+    return [(r.movie["id"], r.score) for r in results]
+
+
+@pytest.mark.parametrize("query", [
+    "worda",
+    "wordz",
+    "worda wordb",
+    "wordc wordx wordy",
+    "wordd wordd wordq",
+    'wordb "wordc wordd"',
+])
+@pytest.mark.parametrize("limit", [1, 10, 100])
+def test_bm25_search_prune_matches_exhaustive(index, query, limit):
+    pruned = search(index, query, limit, prune=True)
+    assert pruned == search(index, query, limit)
+
+
+def test_bm25_search_batch_matches_single_search(index):
+    queries = ['"worda wordb"', 'wordc "wordd worde" wordf', "worda wordb"]
+    index.results.clear()
+    batch = index.bm25_search_batch(queries, 50)
+    for query, results in zip(queries, batch):
+        batched = [(r.movie["id"], r.score) for r in results]
+        assert batched == search(index, query, 50)
+
+
+def test_save_keeps_files_it_did_not_replace(tmp_path):
+    def open_index():
+        index = InvertedIndex()
+        index.index_dir = str(tmp_path)
+        index.index_file = os.path.join(index.index_dir, "manifest.json")
+        index.stems_file = os.path.join(index.index_dir, "stems.pkl")
+        return index
+
+    movies = [
+        {"id": id, "title": f"Movie {id}", "description": "worda wordb"}
+        for id in range(1, 11)
+    ]
+    first = open_index()
+    first.build(movies)
+    first.save()
+
+    # Another process saves a segment and is writing a file meanwhile
+    second = open_index()
+    second.load()
+    second.add_documents([{"id": 11, "title": "B", "description": "wordc"}])
+    second.save()
+    (tmp_path / "manifest.json.tmp").write_text("{}")
+    written = set(os.listdir(tmp_path))
+
+    first.add_documents([{"id": 12, "title": "A", "description": "wordd"}])
+    first.save()
+
+    assert written <= set(os.listdir(tmp_path))